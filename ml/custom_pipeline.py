@@ -7,10 +7,17 @@ import logging
 #     stream=sys.stdout
 # )
 
+import os
+import copy
 import json
+import time
+import shutil
+import tempfile
 
-from joblib import Parallel, delayed
-from multiprocessing import cpu_count 
+import joblib
+import numpy as np
+import scipy.sparse
+from joblib import Parallel, delayed, effective_n_jobs
 
 from sklearn.preprocessing import LabelEncoder
 from keras.utils import to_categorical
@@ -35,6 +42,41 @@ def convert_to_NN_format(data):
     return data 
 
 
+# state of the run_jobs call whose jobs a worker process is running (see run_job)
+worker_state = {}
+
+
+def run_job(state_path: str, selected_columns: list, name: str): 
+    """
+    Running one model in a worker process of CustomPipeline.run_jobs 
+    The pipeline, classifier and dataset cache entry are the same for all the jobs of a call: 
+    they are dumped once in state_path and loaded once per worker (the dataset is memory mapped, 
+    shared by all the workers, and put in the cache of the worker so run_single_model does not have to read the input file again)
+    """
+    if worker_state.get("path") != state_path: 
+        if "cache_key" in worker_state: 
+            utils.dataset_cache.pop(worker_state["cache_key"], None)
+        pipeline, cache_key, cache_entry, clf, clf_params, model_base_path = joblib.load(state_path)
+        cache_entry["X"] = joblib.load(cache_entry["X"], mmap_mode='r')
+        utils.dataset_cache[cache_key] = cache_entry
+        worker_state.clear()
+        worker_state.update(
+            path=state_path, 
+            pipeline=pipeline, 
+            cache_key=cache_key, 
+            clf=clf, 
+            clf_params=clf_params, 
+            model_base_path=model_base_path, 
+        )
+    worker_state["pipeline"].run_single_model(
+        selected_columns, 
+        name, 
+        worker_state["clf"], 
+        worker_state["clf_params"], 
+        worker_state["model_base_path"], 
+    )
+
+
 class CustomPipeline(object):
     """
     A class helper because I'm tired of having to pass 42 arguments everytime I call anything
@@ -58,6 +100,9 @@ class CustomPipeline(object):
         models_dir,
         output_path,
         output_hyperparameters_json,
+        cached_columns: list = None,
+        hyperparameters_cache_dir: str = None,
+        force_search: bool = False,
     ):
         self.classifiers = classifiers 
         self.X_train = X_train 
@@ -76,6 +121,12 @@ class CustomPipeline(object):
         self.models_dir = models_dir
         self.output_path = output_path
         self.output_hyperparameters_json = output_hyperparameters_json
+        # all the columns used by the models of this run, loaded once (see utils.Dataset.prepare_data_from_cache)
+        self.cached_columns = cached_columns
+        # results of the hyperparameters searches, reused when the training data, the classifier, 
+        # its grid and the seed are the same (see get_search_key)
+        self.hyperparameters_cache_dir = hyperparameters_cache_dir
+        self.force_search = force_search
     
     def best_of_pipeline(self):
         """
@@ -134,6 +185,7 @@ class CustomPipeline(object):
         - self.selected_classifiers_names (only the classifiers we'd like to use later)
         """  
         self.hyperparameters_results = {}
+        self.train_data_hash = None
 
         nn_specifics = []
         debug_i=0
@@ -141,6 +193,13 @@ class CustomPipeline(object):
             logging.debug(f"--------") 
             logging.debug(f"[+] {name}")
             logging.debug(f"{cl['params_grid']}")
+
+            cached_results = self.load_search_results(name, cl)
+            if cached_results != None: 
+                self.hyperparameters_results[name] = cached_results
+                if "[NN]" in name: 
+                    nn_specifics.append(cached_results['score'])
+                continue 
             
             # using a temporary variable, as using a NN should not destroy original values
             tmp_y_train = self.y_train 
@@ -165,6 +224,7 @@ class CustomPipeline(object):
                 self.n_jobs
             )
             self.hyperparameters_results[name] = m.hyperparameters_search()
+            self.save_search_results(name, cl, self.hyperparameters_results[name])
             
             if is_nn: 
                 nn_specifics.append(self.hyperparameters_results[name]['score'])
@@ -176,6 +236,67 @@ class CustomPipeline(object):
             debug_i+=1
 
         logging.debug(f"[-] hyperparameters_results: {self.hyperparameters_results}")
+        logging.debug(f"[-] Comparison with NN (score): {nn_specifics}")
+        self.select_best_classifiers()
+
+    def get_search_key(self, cl: dict) -> str: 
+        """
+        Content hash of everything the result of a hyperparameters search depends on: 
+        training data, classifier (pipeline and its parameters), grid and seed
+        """
+        if self.train_data_hash == None: 
+            # same hash whatever the memory layout of X_train (eg: view of the cached dataset)
+            X_train = self.X_train
+            if scipy.sparse.issparse(X_train): 
+                X_train = scipy.sparse.csr_matrix(X_train, copy=True)
+                X_train.sort_indices()
+                X_train = (X_train.data, X_train.indices, X_train.indptr, X_train.shape)
+            else: 
+                X_train = np.ascontiguousarray(X_train)
+            self.train_data_hash = joblib.hash((X_train, np.asarray(self.y_train)))
+        return joblib.hash((self.train_data_hash, cl['clf'], cl['params_grid'], self.random_state))
+
+    def get_search_cache_path(self, cl: dict) -> str: 
+        return os.path.join(self.hyperparameters_cache_dir, f"{self.get_search_key(cl)}.json")
+
+    def load_search_results(self, name: str, cl: dict) -> dict: 
+        """
+        Results of a previous hyperparameters search (see get_search_key), None if there is none 
+        """
+        if self.hyperparameters_cache_dir == None or self.force_search: 
+            return None 
+        path = self.get_search_cache_path(cl)
+        if not os.path.isfile(path): 
+            return None 
+        with open(path, 'r') as f: 
+            results = json.load(f)
+        logging.info(f"[-] {name}: reusing the hyperparameters search from {path}")
+        return results
+
+    def save_search_results(self, name: str, cl: dict, results: dict): 
+        if self.hyperparameters_cache_dir == None: 
+            return 
+        os.makedirs(self.hyperparameters_cache_dir, exist_ok=True)
+        path = self.get_search_cache_path(cl)
+        # writing then renaming, so a concurrent run never reads half of a file
+        with open(f"{path}.{os.getpid()}.tmp", 'w') as f: 
+            json.dump(results, f)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+        logging.debug(f"[-] {name}: hyperparameters search saved in {path}")
+
+    def set_hyperparameters_results(self, hyperparameters_results: dict): 
+        """
+        Reusing the results of a previous pick_best_ml_method (eg: the one of another seed) 
+        instead of running the hyperparameters search again
+        """
+        self.hyperparameters_results = hyperparameters_results
+        self.select_best_classifiers()
+
+    def select_best_classifiers(self): 
+        """
+        Save self.hyperparameters_results (if output_hyperparameters_json) 
+        and the best classifier in self.selected_classifiers_names
+        """
         if self.output_hyperparameters_json: 
             with open(f"{self.output_hyperparameters_json}", 'w') as f:
                 json.dump(self.hyperparameters_results, f)    
@@ -189,7 +310,6 @@ class CustomPipeline(object):
                 best_name = cl_name
         
         logging.debug(f"[-] Best: {best_name} ({best_score})")
-        logging.debug(f"[-] Comparison with NN (score): {nn_specifics}")
 
         # By default, adding the best model
         # self.selected_classifiers_names = [best_name, "Finit"]
@@ -206,8 +326,10 @@ class CustomPipeline(object):
         model_base_path: str = "",
     ):
         """
-        Retrieves data from input_csv file, train and test a given classifier (usually a whole pipeline)
+        Retrieves data from input_csv file (in practice, from the dataset cache), 
+        train and test a given classifier (usually a whole pipeline)
         """
+        start = time.time()
         if "y" not in selected_columns: 
             # by default, "y" is excluded from the selected columns, but we need it to label
             selected_columns.append("y")
@@ -222,7 +344,7 @@ class CustomPipeline(object):
             self.random_state, 
         )
         
-        d.prepare_data()
+        d.prepare_data_from_cache(self.cached_columns)
         self.X_train = d.X_train
         self.X_test = d.X_test
         self.y_train = d.y_train
@@ -268,8 +390,30 @@ class CustomPipeline(object):
             m.load_model()
             m.test()
 
+        # wall time of the whole run (data selection, training/loading and testing)
+        m.results['wall_time'] = time.time() - start
+        logging.info(f"[{name}] Wall time: {m.results['wall_time']:.2f}s")
         m.save_results(f"{self.output_path}{name}.json")
 
+    def get_jobs(self, clf_name: str, resolver: str) -> list: 
+        """
+        All the (selected_columns, name) runs of a resolver, for all modes (and values of by_* modes)
+        """
+        jobs = []
+        for m in self.modes: 
+            if not m.startswith("by_"): 
+                jobs.append((
+                    self.ordered_columns[resolver][m], 
+                    f"{clf_name}-{resolver}-{m}-{self.random_state}", 
+                ))
+            else: 
+                for val in self.ordered_columns[resolver][m]: 
+                    jobs.append((
+                        self.ordered_columns[resolver][m][val], 
+                        f"{clf_name}-{resolver}-{m}_{val}-{self.random_state}", 
+                    ))
+        return jobs
+
     def run_with_modes(
         self, 
         clf_name: str,
@@ -281,41 +425,87 @@ class CustomPipeline(object):
         """
         Run all DNS resolvers and modes
         """
-        for m in self.modes: 
-            if not m.startswith("by_"): 
-                self.run_single_model(
-                    self.ordered_columns[resolver][m], 
-                    f"{clf_name}-{resolver}-{m}-{self.random_state}", 
-                    clf, 
-                    params,
-                    model_base_path,
-                )
-            else: 
-                for val in self.ordered_columns[resolver][m]: 
-                    self.run_single_model(
-                        self.ordered_columns[resolver][m][val], 
-                        f"{clf_name}-{resolver}-{m}_{val}-{self.random_state}", 
-                        clf, 
-                        params,
-                        model_base_path,
-                    ) 
+        self.run_jobs(self.get_jobs(clf_name, resolver), clf_name, clf, params, model_base_path)
+
+    def get_nb_workers(self, clf_name: str, clf, nb_jobs: int) -> int: 
+        """
+        Number of processes used to run jobs in parallel, so that 
+        (processes x threads of the estimator) stays within the cores allowed by self.n_jobs
+        """
+        nb_cores = effective_n_jobs(self.n_jobs)
+        if "[NN]" in clf_name: 
+            # tensorflow already uses all the cores
+            return 1 
+        threads = 1
+        for param, value in clf.get_params().items(): 
+            if param.endswith("n_jobs"): 
+                threads = max(threads, effective_n_jobs(value))
+        return max(1, min(nb_jobs, nb_cores // threads))
+
+    def run_jobs(self, jobs: list, clf_name: str, clf, params: dict, model_base_path: str = ""): 
+        """
+        Running (selected_columns, name) jobs, in parallel processes when possible
+        The dataset is loaded once (with the columns of all jobs) and memory mapped 
+        so it's shared by the workers instead of being pickled for each job
+        """
+        nb_workers = self.get_nb_workers(clf_name, clf, len(jobs))
+        logging.debug(f"[-] {len(jobs)} jobs, {nb_workers} workers")
+        if nb_workers <= 1: 
+            for selected_columns, name in jobs: 
+                self.run_single_model(selected_columns, name, clf, params, model_base_path)
+            return 
+
+        # loading (or reusing) the dataset with all the columns needed by the jobs
+        needed_columns = set()
+        for selected_columns, name in jobs: 
+            needed_columns.update(selected_columns)
+        if self.cached_columns != None: 
+            needed_columns.update(self.cached_columns)
+        d = utils.Dataset(
+            self.input_csv, 
+            self.labelcolumn,
+            list(jobs[0][0]) + [self.labelcolumn],
+            [],
+            self.selected_rows,
+            self.nrows, 
+            self.random_state, 
+        )
+        d.prepare_data_from_cache(list(needed_columns))
+        cache_key = d.get_cache_key()
+
+        # the workers don't need the data of the hyperparameters search, nor the columns and classifiers of the other runs
+        pipeline = copy.copy(self)
+        pipeline.X_train = pipeline.X_test = pipeline.y_train = pipeline.y_test = None
+        pipeline.ordered_columns = pipeline.classifiers = None
+        pipeline.hyperparameters_results = None
+        pipeline.cached_columns = list(needed_columns)
+
+        folder = tempfile.mkdtemp(prefix="custom_pipeline_")
+        try: 
+            # X is only sent as the name of its file (memory mapped by each worker, see run_job)
+            cache_entry = utils.dump_cache_entry(cache_key, folder)
+            state_path = os.path.join(folder, "state.joblib")
+            joblib.dump((pipeline, cache_key, cache_entry, clf, params, model_base_path), state_path)
+            start = time.time()
+            # each job only gets its columns, the rest is loaded once per worker (see run_job)
+            Parallel(n_jobs=nb_workers, backend="loky")(
+                delayed(run_job)(state_path, selected_columns, name)
+                for selected_columns, name in jobs
+            )
+            logging.info(f"[-] {len(jobs)} jobs run in {time.time() - start:.2f}s ({nb_workers} workers)")
+        finally: 
+            shutil.rmtree(folder, ignore_errors=True)
 
     def run_best_methods(self): 
         """
         Actual runs using the best model(s)
+        All the (resolver, mode, value) runs are independent: running them in parallel 
         """
         for clf_name in self.selected_classifiers_names: 
             clf = self.classifiers[clf_name]['clf']
             params = self.hyperparameters_results[clf_name]['params']
-            # parallelizing just a notch for the last by_... modes to be faster
-            n_jobs = int(cpu_count()//4)
-            # Parallel(n_jobs=n_jobs)(
-            #     delayed(self.run_with_modes)(clf_name, clf, params, resolver)
-            #     for resolver in self.ordered_columns
-            # )
+            jobs = []
             for resolver in self.ordered_columns:
                 if "doh" in resolver: 
-                    self.run_with_modes(clf_name, clf, params, resolver)
-
-
-
+                    jobs += self.get_jobs(clf_name, resolver)
+            self.run_jobs(jobs, clf_name, clf, params)
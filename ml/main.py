@@ -20,16 +20,21 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import glob
 import copy
 import json 
+import shutil
+import tempfile
 import argparse 
 
 import numpy as np 
 import pandas as pd
+import scipy.sparse
 
 from sklearn import metrics
+from joblib import Parallel, delayed, effective_n_jobs
 
 # useful for SVC https://scikit-learn.org/stable/modules/svm.html#tips-on-practical-use
 from sklearn.preprocessing import StandardScaler
 from sklearn.preprocessing import MinMaxScaler
+from sklearn.preprocessing import MaxAbsScaler
 
 # Resampler (dataset imbalance) 
 from imblearn.over_sampling import RandomOverSampler 
@@ -85,14 +90,11 @@ def create_NN_model(input_dimensions, nb_labels):
     return model
 
 
-def get_modes(modes: str, resolvers_config: dict, is_dns_str: bool) -> list[str]: 
+def get_modes(modes: str, resolvers_config: dict, is_dns_str: bool, extract_config: dict) -> list[str]: 
     modes = modes.split(',')
     if is_dns_str: 
-        possible_modes = [
-            "complete", 
-            "4",
-            "3"
-        ]
+        # eg: complete, 4, 3 (see PcapExtractString)
+        possible_modes = list(extract_config["qname_types"].keys())
     else: 
         possible_modes = [
             "all_both",
@@ -119,94 +121,44 @@ def get_modes(modes: str, resolvers_config: dict, is_dns_str: bool) -> list[str]
     return actual_modes
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Read a pcap file, extract relevant features and draw their distribution")
-    parser.add_argument('--input_csv', '-i', help='CSV dataset used as input', required=True)
-    parser.add_argument('--output_path', '-o', help='Output JSON file', required=True)
-    parser.add_argument('--output_hyperparameters_json', '-oh', help='Output JSON file for timings')
-    parser.add_argument('--models_dir', '-md', help='Where to save models', default="./data/models/")
-    parser.add_argument('--random', '-r', default=42, help='Seed to instantiate random state (default: 42)')
-    parser.add_argument('--labelcolumn', '-lc', default="y", help='The y column in the input CSV file')
-    parser.add_argument('--nrows', '-n', default=None, help='Number of lines to use from the CSV')
-    parser.add_argument('--extract_config', '-ec', help='Config file containing stable parameters used for extraction', required=True)
-    parser.add_argument('--resolvers_config', '-rc', help='Config file containing stable parameters used for resovlers', required=True)
-    parser.add_argument('--modes', '-m', help='A comma separated list of modes to run', default="everything")
-    parser.add_argument('--is_dns_str', '-ds', help='If the current dataset contains one-hot encoded clear text DNS features', action=argparse.BooleanOptionalAction, default=False)
-    parser.add_argument('--n_jobs', '-nj', help='n_jobs parameter used for sklearn (https://scikit-learn.org/stable/glossary.html#term-n_jobs)', default=-2, type=int)
-    parser.add_argument('--load_model_glob', '-lm', help='The glob path to one or multiple models to use on data in input_csv')
-    parser.add_argument('--previous_run_id', '-prid', help='The RUN_ID of reference for the loaded model(s)', default="rerun")
-    parser.add_argument('--devices_config', '-dc', help='The JSON configuration file with devices names used to train the loaded model')
-
-    args = parser.parse_args()
-
-    random_state = int(args.random)
-    excluded_columns = []
-    nrows = None
-    if(args.nrows):
-        nrows = int(args.nrows)
-    
-    scoring = metrics.make_scorer(custom_balanced_accuracy)
-
-    # doing so is *much* faster than going for pd.read_csv(args.input_csv, index_col=0, nrows=0).columns.tolist()
-    with open(args.input_csv) as f: 
-        for line in f: 
-            all_columns = line.split(',')[1:] # removing the 'y'
-            break 
-    # remove the \n on the last column name, as it's not removed by default
-    all_columns[-1] = all_columns[-1].replace('\n', '')
-    
-    extract_config = utils.read_conf(args.extract_config)
-    resolvers_config = utils.read_conf(args.resolvers_config)
-
+def get_seeds(seeds: str) -> list[int]: 
     """
-    If we want to rerun a previously trained model on new data, 
-    we select only the rows with the devices  present when training the model, 
-    so we keep trying what the model *can* guess 
-    (if we test for completely unknown classes, the model *can not* predict them)
+    A comma separated list of seeds and/or ranges (start:stop[:step], stop excluded), 
+    eg: "42", "0,3,6", "0:16:3" or "1,10:12"
     """
-    devices_config = utils.read_conf(args.devices_config)
-    selected_rows = devices_config['all_devices']
+    actual_seeds = []
+    for s in seeds.split(','): 
+        if ':' in s: 
+            actual_seeds += list(range(*[int(v) for v in s.split(':')]))
+        else: 
+            actual_seeds.append(int(s))
 
-    modes = get_modes(args.modes, resolvers_config, args.is_dns_str)
-    logging.debug(f"[+] Running with mode(s): {modes}")
+    if len(actual_seeds) == 0: 
+        logging.error(f"No seed? {seeds}")
+        raise ValueError 
 
-    """
-    ordered_columns: 
-    {
-        "dns_resolver": {
-            "mode": ["col_a", "col_b", ...]
-        }
-    }
-    """
-    ordered_columns = utils.prepare_columns(all_columns, extract_config, resolvers_config, is_dns_str=args.is_dns_str)
-    
-    # The hyper-parameters selection is done on the first resolver, using complete DNS names or all_both mode (up+down+IAT)
-    if args.is_dns_str: 
-        first_resolvers_columns = ordered_columns[sorted(list(ordered_columns.keys()))[0]]['complete']
-    else:   
-        first_resolvers_columns = ordered_columns[sorted(list(ordered_columns.keys()))[0]]['all_both']
-    first_resolvers_columns.append("y")
+    return actual_seeds
 
-    # X_test and y_test should only be used as held-out data 
-    # naming convention: https://en.wikipedia.org/wiki/Training,_validation,_and_test_data_sets
-    d = utils.Dataset(
-        args.input_csv,
-        args.labelcolumn,
-        first_resolvers_columns,
-        [], # no excluded columns
-        selected_rows, 
-        nrows, 
-        random_state,
-    )
-    d.prepare_data()
 
+def format_seed_path(path: str, seed: int) -> str: 
+    if path == None: 
+        return None 
+    return path.replace("{seed}", str(seed))
+
+
+def get_classifiers(random_state: int, input_dimensions: int, nb_labels: int, sparse: bool = False) -> dict: 
     resampler= None
     resampler = RandomOverSampler(random_state=random_state) 
     logging.debug(f"--- Resampler:{resampler}")
 
+    # MinMaxScaler does not support sparse data (eg: qname store), 
+    # MaxAbsScaler is the same for the one-hot encoded qnames (min: 0, max: 1)
+    def get_min_max_scaler(): 
+        return MaxAbsScaler() if sparse else MinMaxScaler()
+
     # "Support Vector Machine algorithms are not scale invariant, so it is highly recommended to scale your data"
     # https://scikit-learn.org/stable/modules/svm.html#tips-on-practical-use
-    scaler = StandardScaler()
+    scaler = StandardScaler(with_mean=not sparse) # (centering sparse data would make it dense)
 
     # Grids based on: 
     # https://towardsdatascience.com/hyperparameter-tuning-the-random-forest-in-python-using-scikit-learn-28d2aa77dd74
@@ -214,9 +166,9 @@ if __name__ == "__main__":
     classifiers = {
         "[NN]NeuralNetwork": {
             "clf": Pipeline([
-                ('scaling', MinMaxScaler()),
+                ('scaling', get_min_max_scaler()),
                 ('sampling', resampler),
-                ('classification', KerasClassifier(model=create_NN_model, model__input_dimensions=d.input_dimensions, model__nb_labels=d.nb_labels, random_state=random_state, verbose=0))
+                ('classification', KerasClassifier(model=create_NN_model, model__input_dimensions=input_dimensions, model__nb_labels=nb_labels, random_state=random_state, verbose=0))
             ]),
             "params_grid": {
                 'classification__epochs':[5, 10, 15, 20],
@@ -251,7 +203,7 @@ if __name__ == "__main__":
         },
         "ComplementNB": { 
             "clf": Pipeline([
-                ('scaling', MinMaxScaler()),
+                ('scaling', get_min_max_scaler()),
                 ('sampling', resampler),
                 ('classification', ComplementNB())
             ]),
@@ -306,24 +258,54 @@ if __name__ == "__main__":
         }
     }
 
+    return classifiers
+
+
+def run_seed(args, seed: int, n_jobs: int, conf: dict, hyperparameters_results: dict = None, cache: tuple = None) -> dict: 
+    """
+    A whole run (hyperparameters search + best methods, or previous models) with a given seed 
+
+    conf contains what is shared by all seeds (columns, configs...)
+    hyperparameters_results: results of the search of another seed (see --share_search)
+    cache: (key, entry) of the dataset loaded by the main process (see utils.share_cache_entry)
+    """
+    if cache != None: 
+        utils.dataset_cache[cache[0]] = cache[1]
+
+    # X_test and y_test should only be used as held-out data 
+    # naming convention: https://en.wikipedia.org/wiki/Training,_validation,_and_test_data_sets
+    d = utils.Dataset(
+        args.input_csv,
+        args.labelcolumn,
+        list(conf["first_resolvers_columns"]),
+        [], # no excluded columns
+        conf["selected_rows"], 
+        conf["nrows"], 
+        seed,
+    )
+    d.prepare_data_from_cache(conf["cached_columns"])
+
     p = CustomPipeline(
-        classifiers, 
+        get_classifiers(seed, d.input_dimensions, d.nb_labels, sparse=scipy.sparse.issparse(d.X_train)), 
         d.X_train, 
         d.y_train, 
         d.X_test, 
         d.y_test, 
-        scoring, 
-        ordered_columns,
-        selected_rows,
-        modes,
+        metrics.make_scorer(custom_balanced_accuracy), 
+        conf["ordered_columns"],
+        conf["selected_rows"],
+        conf["modes"],
         args.input_csv,
         args.labelcolumn,
-        nrows,
-        random_state,
-        args.n_jobs, 
+        conf["nrows"],
+        seed,
+        n_jobs, 
         args.models_dir,
         args.output_path,
-        args.output_hyperparameters_json
+        format_seed_path(args.output_hyperparameters_json, seed),
+        cached_columns=conf["cached_columns"],
+        hyperparameters_cache_dir=args.hyperparameters_cache,
+        force_search=args.force_search,
     )
 
     if not args.load_model_glob:
@@ -331,27 +313,139 @@ if __name__ == "__main__":
         Going for a default ML pipeline, testing multiple ML methods and picking 
         the best one before training/testing on held-out data 
         """
-        p.best_of_pipeline()
+        if hyperparameters_results == None: 
+            p.pick_best_ml_method()
+        else: 
+            p.set_hyperparameters_results(hyperparameters_results)
+        p.run_best_methods()
+        return p.hyperparameters_results
     else: 
         """
         Loading a previously trained model and using some *unseen* data 
         For eg: test model trained in August with data obtained in September  
         """
-        ordered_columns_dns_str = utils.prepare_columns(all_columns, extract_config, resolvers_config, is_dns_str=True)
+        ordered_columns_dns_str = utils.prepare_columns(conf["all_columns"], conf["extract_config"], conf["resolvers_config"], is_dns_str=True)
         
         if args.is_dns_str:                 
             p.ordered_columns = ordered_columns_dns_str
-        else: 
-            p.ordered_columns = ordered_columns
-                # updating the output path 
                 
         # saving the results in <RESULTS_PATH>/<PREVIOUS_RUN_ID>/<MODEL_NAME>
         p.output_path = f"{p.output_path}{args.previous_run_id}/"
-        for f in glob.glob(args.load_model_glob):
+        for f in glob.glob(format_seed_path(args.load_model_glob, seed)):
             if "dns_str" in f and not args.is_dns_str:
                 # just making sure a loose glob path doesn't create impossible situations  
                 continue
             p.load_previous_pipeline(f)
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read a pcap file, extract relevant features and draw their distribution")
+    parser.add_argument('--input_csv', '-i', help='CSV dataset (or feature store, see pcap_manipulation/FeatureStore.py) used as input', required=True)
+    parser.add_argument('--output_path', '-o', help='Output JSON file', required=True)
+    parser.add_argument('--output_hyperparameters_json', '-oh', help='Output JSON file for timings ({seed} is replaced by the seed, required with multiple seeds)')
+    parser.add_argument('--models_dir', '-md', help='Where to save models', default="./data/models/")
+    parser.add_argument('--random', '-r', default="42", help='Seed(s) to instantiate random state, comma separated, ranges as start:stop[:step] (default: 42)')
+    parser.add_argument('--share_search', '-ss', help='With multiple seeds, only run the hyperparameters search with the first seed and reuse its results', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--hyperparameters_cache', '-hc', help='Directory where the results of the hyperparameters searches are kept and reused (same data, classifier, grid and seed)')
+    parser.add_argument('--force_search', '-fs', help='Run the hyperparameters searches even if their results are in --hyperparameters_cache', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--seed_jobs', '-sj', help='Number of seeds run in parallel (sharing the n_jobs cores)', default=1, type=int)
+    parser.add_argument('--labelcolumn', '-lc', default="y", help='The y column in the input CSV file')
+    parser.add_argument('--nrows', '-n', default=None, help='Number of lines to use from the CSV')
+    parser.add_argument('--extract_config', '-ec', help='Config file containing stable parameters used for extraction', required=True)
+    parser.add_argument('--resolvers_config', '-rc', help='Config file containing stable parameters used for resovlers', required=True)
+    parser.add_argument('--modes', '-m', help='A comma separated list of modes to run', default="everything")
+    parser.add_argument('--is_dns_str', '-ds', help='If the current dataset contains one-hot encoded clear text DNS features', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--n_jobs', '-nj', help='n_jobs parameter used for sklearn (https://scikit-learn.org/stable/glossary.html#term-n_jobs)', default=-2, type=int)
+    parser.add_argument('--load_model_glob', '-lm', help='The glob path to one or multiple models to use on data in input_csv ({seed} is replaced by the seed)')
+    parser.add_argument('--previous_run_id', '-prid', help='The RUN_ID of reference for the loaded model(s)', default="rerun")
+    parser.add_argument('--devices_config', '-dc', help='The JSON configuration file with devices names used to train the loaded model')
 
+    args = parser.parse_args()
 
+    seeds = get_seeds(str(args.random))
+    if len(seeds) > 1 and args.output_hyperparameters_json and "{seed}" not in args.output_hyperparameters_json: 
+        parser.error("--output_hyperparameters_json requires {seed} with multiple seeds")
+
+    nrows = None
+    if(args.nrows):
+        nrows = int(args.nrows)
+    
+    all_columns = utils.read_columns(args.input_csv)
+    
+    extract_config = utils.read_conf(args.extract_config)
+    resolvers_config = utils.read_conf(args.resolvers_config)
 
+    """
+    If we want to rerun a previously trained model on new data, 
+    we select only the rows with the devices  present when training the model, 
+    so we keep trying what the model *can* guess 
+    (if we test for completely unknown classes, the model *can not* predict them)
+    """
+    devices_config = utils.read_conf(args.devices_config)
+    selected_rows = devices_config['all_devices']
+
+    modes = get_modes(args.modes, resolvers_config, args.is_dns_str, extract_config)
+    logging.debug(f"[+] Running with mode(s): {modes}")
+
+    """
+    ordered_columns: 
+    {
+        "dns_resolver": {
+            "mode": ["col_a", "col_b", ...]
+        }
+    }
+    """
+    ordered_columns = utils.prepare_columns(all_columns, extract_config, resolvers_config, is_dns_str=args.is_dns_str)
+    
+    # The hyper-parameters selection is done on the first resolver, using complete DNS names or all_both mode (up+down+IAT)
+    if args.is_dns_str: 
+        first_resolvers_columns = ordered_columns[sorted(list(ordered_columns.keys()))[0]]['complete']
+    else:   
+        first_resolvers_columns = ordered_columns[sorted(list(ordered_columns.keys()))[0]]['all_both']
+    first_resolvers_columns.append("y")
+
+    # all the columns used by the models of this run: the dataset is only loaded once, with all of them
+    if args.load_model_glob: 
+        cached_resolvers = list(ordered_columns.keys())
+    else: 
+        # see CustomPipeline.run_best_methods
+        cached_resolvers = [resolver for resolver in ordered_columns if "doh" in resolver]
+    cached_columns = utils.get_columns_of_modes(ordered_columns, cached_resolvers, modes) + first_resolvers_columns
+
+    # everything the seeds have in common (the dataset itself is shared through utils.dataset_cache)
+    conf = {
+        "all_columns": all_columns, 
+        "extract_config": extract_config, 
+        "resolvers_config": resolvers_config, 
+        "selected_rows": selected_rows, 
+        "nrows": nrows, 
+        "modes": modes, 
+        "ordered_columns": ordered_columns, 
+        "first_resolvers_columns": first_resolvers_columns, 
+        "cached_columns": cached_columns, 
+    }
+
+    hyperparameters_results = None
+    if args.share_search and not args.load_model_glob: 
+        # the following seeds reuse the search of the first one
+        hyperparameters_results = run_seed(args, seeds[0], args.n_jobs, conf)
+        seeds = seeds[1:]
+
+    seed_jobs = max(1, min(args.seed_jobs, len(seeds)))
+    if seed_jobs == 1: 
+        for seed in seeds: 
+            run_seed(args, seed, args.n_jobs, conf, hyperparameters_results)
+    else: 
+        # loading the dataset once and sharing it (memory mapped) with the processes of the seeds
+        d = utils.Dataset(args.input_csv, args.labelcolumn, list(first_resolvers_columns), [], selected_rows, nrows, seeds[0])
+        d.prepare_data_from_cache(cached_columns)
+        n_jobs = max(1, effective_n_jobs(args.n_jobs) // seed_jobs)
+        folder = tempfile.mkdtemp(prefix="ml_seeds_")
+        try: 
+            cache = (d.get_cache_key(), utils.share_cache_entry(d.get_cache_key(), folder))
+            Parallel(n_jobs=seed_jobs, backend="loky")(
+                delayed(run_seed)(args, seed, n_jobs, conf, hyperparameters_results, cache) for seed in seeds
+            )
+        finally: 
+            shutil.rmtree(folder, ignore_errors=True)
@@ -15,7 +15,6 @@ import json
 import argparse 
 
 import numpy as np 
-import pandas as pd
 
 # locals 
 import utils 
@@ -37,7 +36,7 @@ if __name__ == "__main__":
     
 
     # somehow, this call does *not* read the first column 'y'
-    all_columns = pd.read_csv(args.input_csv, index_col=0, nrows=0).columns.tolist()
+    all_columns = utils.read_columns(args.input_csv)
     extract_config = utils.read_conf(args.extract_config)
     resolvers_config = utils.read_conf(args.resolvers_config)
 
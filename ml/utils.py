@@ -8,9 +8,12 @@ import logging
 #     stream=sys.stdout
 # )
 
+import os
 import json
+import joblib
 import numpy as np
 import pandas as pd
+import scipy.sparse
 from collections import Counter
 
 from sklearn.model_selection import train_test_split
@@ -24,6 +27,62 @@ def read_conf(filename):
         return json.load(jf)
 
 
+# Binary, columnar version of the CSV dataset (see pcap_manipulation/FeatureStore.py)
+FEATURE_STORE_EXTENSION = ".features"
+
+
+def is_feature_store(filename: str) -> bool: 
+    return filename.rstrip("/").endswith(FEATURE_STORE_EXTENSION)
+
+
+# Sparse one-hot encoded qnames, for the is_dns_str modes (see pcap_manipulation/QnameStore.py)
+QNAME_STORE_EXTENSION = ".dns_str"
+
+
+def is_qname_store(filename: str) -> bool: 
+    return filename.rstrip("/").endswith(QNAME_STORE_EXTENSION)
+
+
+def get_qname_store_columns(meta: dict) -> list[str]: 
+    """
+    The same qname can be in multiple qname types (eg: pool.ntp.org in complete, 4 and 3): 
+    the columns of a qname store are named <qname type>-<qname> 
+    (in the order of the qname types, then of the vocabulary IDs, see prepare_columns_dns_str)
+    """
+    return [f"{qt}-{qname}" for qt in meta["qname_types"] for qname in meta["vocabulary"][qt]]
+
+
+def read_columns(filename: str) -> list[str]: 
+    """
+    Names of the feature columns (without the label) of a CSV file, a feature store or a qname store
+    """
+    if is_feature_store(filename): 
+        return read_conf(os.path.join(filename, "meta.json"))["columns"]
+    if is_qname_store(filename): 
+        return get_qname_store_columns(read_conf(os.path.join(filename, "meta.json")))
+
+    # doing so is *much* faster than going for pd.read_csv(filename, index_col=0, nrows=0).columns.tolist()
+    with open(filename) as f: 
+        for line in f: 
+            all_columns = line.split(',')[1:] # removing the 'y'
+            break 
+    # remove the \n on the last column name, as it's not removed by default
+    all_columns[-1] = all_columns[-1].replace('\n', '')
+    return all_columns
+
+
+# Datasets kept in memory by prepare_data_from_cache, so a file is only read once per process
+# (filename, label_column, selected_rows, nrows) -> {
+#   "X": the rows of the dataset, in the order of the file (never modified: may be memory mapped, see share_cache_entry), 
+#   "y": the labels, in the order of the file, 
+#   "columns": the names of the columns of X, in the order of the file,
+#   "index": column name -> index in X, 
+#   "all": if X contains all the columns of the file, 
+#   "splits": seed -> (train rows, test rows), as indexes in the file
+# }
+dataset_cache = {}
+
+
 class Dataset(object):
     """
     Helper class to retrieve a dataset from a CSV file
@@ -47,10 +106,7 @@ class Dataset(object):
         self.nrows = nrows
         self.random_state = random_state 
 
-    def load_data_from_csv(self):
-        logging.debug(f"[-] Getting features from the following csv: {self.filename}")
-
-        cols = list(pd.read_csv(self.filename, nrows=1))
+    def get_usecols(self, cols: list) -> list: 
         usecols = cols
     
         if len(self.selected_columns) > 0 and self.selected_columns[0] != "": 
@@ -62,6 +118,24 @@ class Dataset(object):
         # if the use forgot (skull emoji) to select the label column, we happily add it to the mix :)
         if self.label_column not in usecols: 
             usecols.append(self.label_column)
+        return usecols
+
+    def load_data_from_csv(self):
+        if is_feature_store(self.filename): 
+            X, y, column_names = self.load_features_from_store()
+            self.data = pd.DataFrame(X, columns=column_names)
+            self.data.insert(0, self.label_column, y)
+            return 
+        if is_qname_store(self.filename): 
+            X, y, column_names = self.load_features_from_qname_store()
+            self.data = pd.DataFrame.sparse.from_spmatrix(X, columns=column_names)
+            self.data.insert(0, self.label_column, y)
+            return 
+
+        logging.debug(f"[-] Getting features from the following csv: {self.filename}")
+
+        cols = list(pd.read_csv(self.filename, nrows=1))
+        usecols = self.get_usecols(cols)
 
         self.data = pd.read_csv(
             self.filename,
@@ -71,7 +145,79 @@ class Dataset(object):
             low_memory=False,
         )
 
+    def load_features_from_store(self) -> tuple: 
+        """
+        Same as load_data_from_csv, for a feature store: 
+        only the selected columns are read from disk (X.npy is column-major and memory mapped)
+        Returns X (float32), y and the names of the columns of X
+        """
+        logging.debug(f"[-] Getting features from the following feature store: {self.filename}")
+
+        meta = read_conf(os.path.join(self.filename, "meta.json"))
+        usecols = set(self.get_usecols([self.label_column] + meta["columns"]))
+        # same as pd.read_csv: the columns are kept in the order of the file, not the order of usecols
+        indexes = [i for i, col in enumerate(meta["columns"]) if col in usecols]
+        
+        X = np.load(os.path.join(self.filename, "X.npy"), mmap_mode='r')
+        y = np.load(os.path.join(self.filename, "y.npy"))
+        if self.nrows != None: 
+            X = X[:self.nrows]
+            y = y[:self.nrows]
+        y = np.array(meta["categories"], dtype=object)[y]
+
+        # only keeping the rows we're interested in
+        if len(self.selected_rows) != 0: 
+            rows = np.isin(y, self.selected_rows)
+            X = X[:, indexes][rows]
+            y = y[rows]
+        else: 
+            X = X[:, indexes]
+        
+        return X, y, pd.Index([meta["columns"][i] for i in indexes])
+
+    def load_features_from_qname_store(self) -> tuple: 
+        """
+        Same as load_features_from_store, for a qname store: 
+        X stays sparse (CSR, float32), only the selected columns are kept
+        """
+        logging.debug(f"[-] Getting features from the following qname store: {self.filename}")
+
+        meta = read_conf(os.path.join(self.filename, "meta.json"))
+        columns = get_qname_store_columns(meta)
+        usecols = set(self.get_usecols([self.label_column] + columns))
+        indexes = [i for i, col in enumerate(columns) if col in usecols]
+
+        X = scipy.sparse.hstack(
+            [scipy.sparse.load_npz(os.path.join(self.filename, f"X_{qt}.npz")) for qt in meta["qname_types"]], 
+            format="csr", 
+            dtype=np.float32
+        )
+        y = np.load(os.path.join(self.filename, "y.npy"))
+        if self.nrows != None: 
+            X = X[:self.nrows]
+            y = y[:self.nrows]
+        y = np.array(meta["categories"], dtype=object)[y]
+
+        # only keeping the rows we're interested in
+        if len(self.selected_rows) != 0: 
+            rows = np.isin(y, self.selected_rows)
+            X = X[:, indexes][rows]
+            y = y[rows]
+        else: 
+            X = X[:, indexes]
+
+        return X, y, pd.Index([columns[i] for i in indexes])
+
     def load_dataset_from_csv(self):
+        if is_feature_store(self.filename) or is_qname_store(self.filename): 
+            if is_qname_store(self.filename): 
+                self.X, self.y, self.column_names = self.load_features_from_qname_store()
+            else: 
+                self.X, self.y, self.column_names = self.load_features_from_store()
+            self.input_dimensions = self.X.shape[1]
+            self.nb_labels = len(set(self.y))
+            return 
+
         self.load_data_from_csv()
         # only keeping the rows we're interested in
         if len(self.selected_rows) != 0: 
@@ -116,6 +262,101 @@ class Dataset(object):
             print(err)
             raise 
 
+    def prepare_data_from_cache(self, cached_columns: list = None): 
+        """
+        Same as prepare_data, but the file is only read once per process (see dataset_cache): 
+        - with cached_columns (all the columns needed by the following calls), or all the columns if None
+        - the train/test split is only computed once per seed (indexes of the rows), 
+        the train/test sets only copy the selected columns of their rows
+        """
+        key = self.get_cache_key()
+        cols = []
+        if len(self.excluded_columns) > 0 and self.excluded_columns[0] != "": 
+            cols = read_columns(self.filename)
+        # eg: when no column is selected (nor excluded), usecols only contains the label (= all columns)
+        selected_columns = [col for col in self.get_usecols(cols) if col != self.label_column]
+        all_columns = len(selected_columns) == 0
+
+        entry = dataset_cache.get(key)
+        if entry == None or (all_columns and not entry["all"]) or any(col not in entry["index"] for col in selected_columns): 
+            columns = []
+            if not all_columns and cached_columns != None: 
+                # keeping what was already there (eg: when a mode was not in cached_columns)
+                columns = set(cached_columns).union(selected_columns)
+                if entry != None: 
+                    columns = columns.union(entry["columns"])
+                columns = list(columns) + [self.label_column]
+            # freeing the previous version before loading the new one
+            dataset_cache.pop(key, None)
+            entry = self.load_cache_entry(columns)
+            dataset_cache[key] = entry
+
+        if self.random_state not in entry["splits"]: 
+            self.split_cache_entry(entry)
+        train, test = entry["splits"][self.random_state]
+
+        X = entry["X"]
+        if all_columns: 
+            indexes = list(range(len(entry["columns"])))
+            columns = slice(None)
+        else: 
+            # same as pd.read_csv: the columns are kept in the order of the file
+            indexes = sorted(set(entry["index"][col] for col in selected_columns))
+            if indexes[-1] - indexes[0] + 1 == len(indexes): 
+                columns = slice(indexes[0], indexes[-1]+1)
+            else: 
+                columns = indexes
+        self.X_train = take_rows(X, train, columns)
+        self.X_test = take_rows(X, test, columns)
+
+        self.y = entry["y"]
+        self.y_train = self.y[train]
+        self.y_test = self.y[test]
+        self.column_names = pd.Index([entry["columns"][i] for i in indexes])
+        self.input_dimensions = len(indexes)
+        self.nb_labels = len(set(self.y))
+
+    def get_cache_key(self) -> tuple: 
+        return (self.filename, self.label_column, tuple(self.selected_rows), self.nrows)
+
+    def load_cache_entry(self, columns: list) -> dict: 
+        d = Dataset(
+            self.filename, 
+            self.label_column, 
+            columns, 
+            [], 
+            self.selected_rows, 
+            self.nrows, 
+            self.random_state
+        )
+        d.load_dataset_from_csv()
+        logging.debug(f"[-] Dataset cached: {self.filename} {d.X.shape}")
+        return {
+            "X": d.X, 
+            "y": d.y, 
+            "columns": list(d.column_names), 
+            "index": {col: i for i, col in enumerate(d.column_names)}, 
+            "all": len(columns) == 0, 
+            "splits": {}, 
+        }
+
+    def split_cache_entry(self, entry: dict): 
+        """
+        Same split as in prepare_data (the split only depends on the number of rows, the labels and the seed)
+        """
+        try: 
+            train, test = train_test_split(
+                np.arange(len(entry["y"])),
+                test_size=0.2,
+                random_state=self.random_state,
+                stratify=entry["y"],
+            )
+        except ValueError as err:
+            logging.error(f"[ValueError] {self.filename}")
+            print(err)
+            raise 
+        entry["splits"][self.random_state] = (train, test)
+
     def print_dataset_info(self): 
         logging.debug(f"\n[+] New dataset:")
         logging.debug(f"Training Features Shape: {self.X_train.shape}")
@@ -124,6 +365,58 @@ class Dataset(object):
         logging.debug(f"Testing Labels Shape: {self.y_test.shape} ({len(set(self.y_test))})")
 
 
+def take_rows(X, rows: np.ndarray, columns): 
+    """
+    X[rows][:, columns] (columns: slice or list of indexes), only copying the selected columns of the rows
+    (X is not copied as a whole, eg: when memory mapped)
+    """
+    if scipy.sparse.issparse(X): 
+        return X[rows][:, columns]
+    if isinstance(columns, slice): 
+        return X[:, columns][rows]
+    return X[np.ix_(rows, columns)]
+
+
+def dump_cache_entry(key: tuple, folder: str) -> dict: 
+    """
+    Copy of a dataset_cache entry with X dumped in folder (X is replaced by the name of its file)
+    """
+    entry = dict(dataset_cache[key])
+    filename = os.path.join(folder, "X.joblib")
+    joblib.dump(entry["X"], filename)
+    entry["X"] = filename
+    return entry
+
+
+def share_cache_entry(key: tuple, folder: str) -> dict: 
+    """
+    Copy of a dataset_cache entry with X memory mapped (dumped in folder), 
+    so it can be given to other processes (joblib does not pickle memory maps, only their filename)
+    """
+    entry = dump_cache_entry(key, folder)
+    entry["X"] = joblib.load(entry["X"], mmap_mode='r')
+    return entry
+
+
+def get_columns_of_modes(ordered_columns: dict, resolvers: list, modes: list) -> list: 
+    """
+    All the columns used by the given resolvers and modes (see prepare_columns), 
+    eg: to load them all at once with Dataset.prepare_data_from_cache
+    """
+    columns = set()
+    for resolver in resolvers: 
+        for m in modes: 
+            if m not in ordered_columns[resolver]: 
+                continue
+            if isinstance(ordered_columns[resolver][m], dict): 
+                # by_* modes
+                for val in ordered_columns[resolver][m]: 
+                    columns.update(ordered_columns[resolver][m][val])
+            else: 
+                columns.update(ordered_columns[resolver][m])
+    return list(columns)
+
+
 def prepare_columns_dns_str(all_columns: list, extract_config) -> dict: 
     """
     Separating columns based on the number of unique DNS qname encountered 
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import sys
+import logging
+
+# required before other imports (yes; see: https://stackoverflow.com/a/20280587)
+logging.basicConfig(
+    format='%(message)s',
+    level=logging.WARN,
+    stream=sys.stdout
+)
+
+import warnings
+warnings.filterwarnings("ignore", category=RuntimeWarning)
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import *
+from PcapHelper import *
+from PcapExtract import *
+from ExtractSinks import *
+
+# Configuration shared by all the workers of the process pool (see init_engine_worker)
+engine_worker_conf = {}
+
+class ExtractEngine(PcapExtract):
+    """
+    Single pass extraction: each (clear, enc) pair of pcap files is read once,
+    and its features are sent to all the outputs (sinks, see ExtractSinks.py) at once:
+    - RowSink: the CSV lines of PcapExtract (and its feature store)
+    - RecordsSink: the per-message records of PcapExtractAll
+    - DistributionSink: the distributions of PcapDistribution
+    The encrypted capture is only read if a sink needs it (eg: not for RecordsSink alone)
+    """
+    def __init__(self,
+        resolvers: dict,
+        padding_strategies: dict,
+        clear_input_pcap: str,
+        input_pcap_enc: str,
+        max_nb_query: int,
+        length_multiplier: int,
+        device_name: str,
+        sinks: list,
+        manual_resolvers_IP: bool = False,
+        tls_parser: str = "scapy",
+        resolvers_cache: str = None,
+    ):
+        PcapExtract.__init__(
+            self,
+            resolvers,
+            padding_strategies,
+            clear_input_pcap,
+            input_pcap_enc,
+            max_nb_query,
+            length_multiplier,
+            "",
+            "a",
+            device_name,
+            manual_resolvers_IP=manual_resolvers_IP,
+            tls_parser=tls_parser,
+            resolvers_cache=resolvers_cache
+        )
+        self.sinks = sinks
+        self.needs_enc = any(sink.needs_enc for sink in self.sinks)
+        # (time, DnsMessage) of all the DNS messages of the clear-text capture, if a sink needs them
+        self.keep_dns_messages = any(sink.needs_dns_messages for sink in self.sinks)
+        self.dns_messages = []
+        self.debug_file = None
+
+    def extract_features_clear(self):
+        """
+        Same as PcapExtract.extract_features_clear, also keeping the DNS messages in the same pass if needed
+        """
+        if not self.keep_dns_messages:
+            return PcapExtract.extract_features_clear(self)
+
+        for ts, buf, linktype in self.pcap_helper_clear.stream_frames():
+            record = self.get_packet_record(ts, buf, linktype)
+            if record != None:
+                self.add_clear_record(record)
+            # (also DNS over IPv6, and DNS quoted in ICMP errors: same as Scapy in PcapExtractAll)
+            record = self.get_dns_record(ts, buf, linktype)
+            if record != None:
+                message = self.get_dns_message(record)
+                if message != None:
+                    self.dns_messages.append((ts, message))
+
+    def extract_partials(self) -> list:
+        """
+        Reading the pair of captures, then getting the partial result of each sink (in the order of self.sinks)
+        """
+        self.extract_features_clear()
+        if self.needs_enc:
+            self.extract_features_enc()
+        return [sink.extract(self) for sink in self.sinks]
+
+    def get_worker_conf(self) -> dict:
+        return {
+            "resolvers": self.resolvers,
+            "padding_strategies": {p: self.padding_strategies[p]["padding"] for p in self.padding_strategies},
+            "max_nb_query": self.max_nb_query,
+            "length_multiplier": self.length_multiplier,
+            "device_name": self.device_name,
+            "tls_parser": self.tls_parser,
+            "debug_file": self.debug_file,
+            # already resolved (or set manually) once, here
+            "IPs_to_resolvers": self.IPs_to_resolvers,
+            "resolvers_IPs": self.resolvers_IPs,
+            "sinks": self.sinks,
+        }
+
+    def extract_pairs(self, pairs: list, max_workers: int = None):
+        """
+        Extracting multiple (clear, enc) pairs of pcap files with a pool of processes,
+        the partial results are added to the sinks in the order of pairs
+        (max_workers = 1: in this process, without any pool)
+
+        The pairs whose partial results were saved by a previous run for all the sinks (see load_partials) are not read again
+        """
+        conf = self.get_worker_conf()
+        saved = [self.load_partials(pair) for pair in pairs]
+        new_pairs = [pairs[i] for i in range(len(pairs)) if saved[i] == None]
+        logging.debug(f"Single pass extraction of {len(new_pairs)} files ({len(pairs) - len(new_pairs)} already done, {max_workers} workers, {len(self.sinks)} outputs)")
+        if max_workers == 1:
+            results = (extract_pair_partials(conf, pair) for pair in new_pairs)
+            self.add_results(self.merge_results(saved, results))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=init_engine_worker, initargs=(conf,)) as executor:
+                # (all the pairs are submitted, thus the sinks sent to the workers, before opening the sinks)
+                self.add_results(self.merge_results(saved, executor.map(extract_pair, new_pairs)))
+
+    def load_partials(self, pair: tuple) -> list:
+        """
+        Partial results of the sinks saved by a previous run for the pair, None if one of the sinks has none
+        """
+        partials = [sink.load_partial(self, pair) for sink in self.sinks]
+        if any(partial == None for partial in partials):
+            return None
+        return partials
+
+    def merge_results(self, saved: list, results):
+        """
+        The partial results of all the pairs, in their order: the saved ones, or the next of the new ones
+        """
+        for partials in saved:
+            if partials == None:
+                yield next(results)
+            else:
+                yield partials
+
+    def add_results(self, results):
+        for sink in self.sinks:
+            sink.open(self)
+        for partials in results:
+            if partials == None:
+                continue
+            for sink, partial in zip(self.sinks, partials):
+                sink.add(partial)
+        for sink in self.sinks:
+            sink.close()
+
+
+def init_engine_worker(conf: dict):
+    """
+    Called once when a worker of the process pool starts
+    """
+    global engine_worker_conf
+    engine_worker_conf = conf
+
+
+def extract_pair(pair: tuple) -> list:
+    return extract_pair_partials(engine_worker_conf, pair)
+
+
+def extract_pair_partials(conf: dict, pair: tuple) -> list:
+    """
+    Partial results of the sinks for one (clear, enc) pair of pcap files (None if the extraction failed)
+    """
+    input_pcap_clear, input_pcap_enc = pair
+    try:
+        p = ExtractEngine(
+            conf["resolvers"],
+            conf["padding_strategies"],
+            input_pcap_clear,
+            input_pcap_enc,
+            conf["max_nb_query"],
+            conf["length_multiplier"],
+            conf["device_name"],
+            conf["sinks"],
+            manual_resolvers_IP=True,
+            tls_parser=conf["tls_parser"],
+        )
+        p.IPs_to_resolvers = conf["IPs_to_resolvers"]
+        p.resolvers_IPs = conf["resolvers_IPs"]
+        p.debug_file = conf["debug_file"]
+        return p.extract_partials()
+    except Exception as e:
+        # one broken file should not stop the whole batch
+        logging.error(f"Extraction failed for: {input_pcap_enc} ({repr(e)})")
+        if conf["debug_file"] != None:
+            with open(conf["debug_file"], "a") as f:
+                f.write(f"Extraction failed for: {input_pcap_enc} ({repr(e)})\n")
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read each pair of pcap files once, and save the features for all the outputs (ML CSV, per-message CSV, distributions)")
+    parser.add_argument('--resolvers_config', '-rc', help='Config file containing the IP address of DNS resolvers', required=True)
+    parser.add_argument('--extract_config', '-ec', help='Config file containing stable parameters used for extraction', required=True)
+    parser.add_argument('--input_dir_clear', '-idc', help='Directory of the DNS only input pcap files (same filenames as in --input_dir_enc)')
+    parser.add_argument('--input_dir_enc', '-ide', help='Directory of the replayed (encrypted) input pcap files')
+    parser.add_argument('--manifest', '-mf', help='JSON file containing a list of [clear, enc] pcap files')
+    parser.add_argument('--output_csv', '-o', help='Path of the output CSV file containing the ML data (see PcapExtract)')
+    parser.add_argument('--csv_file_mode', '-cm', help='The mode to write into the ML CSV file (default: append)', default="a")
+    parser.add_argument('--output_features', '-of', help='Also save the ML data into a feature store (directory ending with .features, see FeatureStore.py)')
+    parser.add_argument('--output_all_csv', '-oa', help='Path of the output CSV file containing all the DNS messages (see PcapExtractAll, appended)')
+    parser.add_argument('--output_distribution', '-od', help='Path of the output JSON file containing the distributions (see PcapDistribution)')
+    parser.add_argument('--partials_dir', '-pd', help='Directory where the distributions of each pair of files are saved, and reused by the next runs (see DistributionSink)')
+    parser.add_argument('--device_name', '-d', help="The device's name (used as label in CSV)", default="generic_device_name")
+    parser.add_argument('--debug_file', '-df', help="Sometimes, the console logs are not clear enough")
+    parser.add_argument('--max_workers', '-w', help='Number of worker processes (default: number of CPUs, 1: no pool)', type=int)
+    parser.add_argument('--manual_resolvers_IP', '-mr', help="Use the hardcoded IPs of the resolvers instead of resolving them", action=argparse.BooleanOptionalAction)
+    parser.add_argument('--resolvers_cache', '-rca', help="Use the IPs of the resolvers saved at replay time (JSON file of the run, see ResolversCache)")
+
+    args = parser.parse_args()
+
+    sinks = []
+    if args.output_csv != None:
+        sinks.append(RowSink(args.output_csv, args.csv_file_mode, args.output_features))
+    elif args.output_features != None:
+        parser.error("--output_features requires --output_csv")
+    if args.output_all_csv != None:
+        sinks.append(RecordsSink(args.output_all_csv))
+    if args.output_distribution != None:
+        sinks.append(DistributionSink(args.output_distribution, args.partials_dir))
+    if len(sinks) == 0:
+        parser.error("at least one output is required (--output_csv, --output_all_csv, --output_distribution)")
+
+    if args.manifest != None:
+        pairs = [tuple(pair) for pair in read_conf(args.manifest)]
+    elif args.input_dir_enc != None and args.input_dir_clear != None:
+        pairs = get_batch_pairs(args.input_dir_clear, args.input_dir_enc)
+    else:
+        parser.error("--manifest, or --input_dir_clear and --input_dir_enc, are required")
+
+    resolvers_config = read_conf(args.resolvers_config)
+    extract_config = read_conf(args.extract_config)
+    p = ExtractEngine(
+        resolvers_config['resolvers'],
+        resolvers_config['padding_strategies'],
+        None,
+        None,
+        extract_config["max_nb_query"],
+        extract_config["length_multiplier"],
+        args.device_name,
+        sinks,
+        manual_resolvers_IP=args.manual_resolvers_IP == True,
+        resolvers_cache=args.resolvers_cache,
+    )
+    p.debug_file = args.debug_file
+    p.extract_pairs(pairs, args.max_workers)
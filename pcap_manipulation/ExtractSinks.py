@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import logging
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from utils import *
+from PcapExtract import *
+from PcapExtractAll import *
+from FeatureStore import *
+
+# Outputs of ExtractEngine: each sink turns the features of a (clear, enc) pair into a partial result
+# and gathers the partial results of all the pairs into its output file
+# - extract(p): in the worker that parsed the pair (p is the ExtractEngine of the pair),
+#   returns the partial result (sent back to the main process, None to ignore the pair)
+# - open(engine): in the main process, before the first partial result
+# - add(partial): in the main process, in the order of the pairs
+# - close(): once all the pairs are done
+# - load_partial(engine, pair): in the main process, the partial result of the pair saved by a previous run
+#   (None if there is none: the pair is extracted again, see ExtractEngine.extract_pairs)
+# - needs_enc: if the encrypted capture has to be parsed
+# - needs_dns_messages: if the DNS messages of the clear-text capture have to be kept (p.dns_messages)
+# The sinks are sent to the workers before being opened: nothing opened in open() is pickled
+
+
+class RowSink(object):
+    """
+    The CSV lines of PcapExtract (ML data), and the feature store if output_features is set (see FeatureStore.py)
+    """
+    needs_enc = True
+    needs_dns_messages = False
+
+    def __init__(self, output_csv: str, csv_file_mode: str = "a", output_features: str = None):
+        self.output_csv = output_csv
+        self.csv_file_mode = csv_file_mode
+        self.output_features = output_features
+        self.file = None
+        self.writer = None
+
+    def extract(self, p) -> tuple:
+        row = p.get_row_from_features()
+        if row is None:
+            return None
+        csv = f"{p.device_name},{format_csv_row(row)}"
+        if self.output_features == None:
+            return csv, None
+        return csv, row.astype(np.float32)
+
+    def load_partial(self, engine, pair: tuple):
+        return None
+
+    def open(self, engine):
+        self.device_name = engine.device_name
+        self.file = open(self.output_csv, self.csv_file_mode)
+        if self.output_features != None:
+            self.writer = FeatureStoreWriter(self.output_features, engine.get_csv_header().split(",")[1:]) # removing the 'y'
+
+    def add(self, partial: tuple):
+        if partial == None:
+            return
+        csv, row = partial
+        self.file.write("\n" + csv)
+        self.file.write("\n")
+        if self.writer != None:
+            self.writer.append(row, self.device_name)
+
+    def close(self):
+        self.file.close()
+        if self.writer != None:
+            self.writer.close()
+
+
+class RecordsSink(object):
+    """
+    The per-message records of PcapExtractAll (one CSV line per DNS message of the clear-text capture, no header)
+    """
+    needs_enc = False
+    needs_dns_messages = True
+
+    def __init__(self, output_csv: str):
+        self.output_csv = output_csv
+
+    def extract(self, p) -> dict:
+        """
+        Same as PcapExtractAll.extract_features_all, from the DNS messages kept by the engine
+        """
+        features = {
+            "device_name": [],
+            "device_class": [],
+            "length": [],
+            "iat": [],
+            "nb_queries": [],
+            "type": [],
+            "ancount": [],
+            "direction": [],
+        }
+        previous_time = None
+        iat = 0
+        nb_queries = 0
+        for t, message in p.dns_messages:
+            ancount = 0
+            if not message.has_rr:
+                nb_queries += 1
+                # computing the IAT only for the request
+                # the same value is used for the answer
+                if previous_time != None:
+                    # Rounding the time to keep a 100ms precision
+                    iat = round_time_delta(t - previous_time, 1)
+                else:
+                    iat = 0
+                previous_time = t
+                features["direction"].append("query")
+            else:
+                features["direction"].append("answer")
+                ancount = message.ancount
+
+            features["length"].append(message.length)
+            features["iat"].append(iat)
+            features["type"].append(message.qtype)
+            features["ancount"].append(ancount)
+
+        cls = DEVICE_CLASSES.get(p.device_name, "Appliance")
+        features["device_name"] = [p.device_name] * len(features["length"])
+        features["device_class"] = [cls] * len(features["length"])
+        features["nb_queries"] = [nb_queries] * len(features["length"])
+        return features
+
+    def load_partial(self, engine, pair: tuple):
+        return None
+
+    def open(self, engine):
+        pass
+
+    def add(self, partial: dict):
+        if partial == None:
+            return
+        df = pd.DataFrame.from_dict(partial)
+        df.to_csv(self.output_csv, index=False, header=False, mode="a")
+
+    def close(self):
+        pass
+
+
+class DistributionSink(object):
+    """
+    The distributions of PcapDistribution: number of occurrences of each IAT (all resolvers)
+    and of each TLS application data length (by resolver and padding strategy), for the biggest time window
+
+    The partial result of each pair is a Counter of its values (summed by add). With a partials_dir,
+    the partial result of each pair is also saved there (one JSON file per pair), so that the next runs
+    on the same files (eg: with a new day of captures) only extract the new pairs
+    """
+    needs_enc = True
+    needs_dns_messages = False
+
+    def __init__(self, output_json: str, partials_dir: str = None):
+        self.output_json = output_json
+        self.partials_dir = partials_dir
+
+    def extract(self, p) -> dict:
+        # using the biggest time window to only select the highest features
+        max_time_window = max(p.incremental_seconds.keys())
+        lengths = {}
+        for resolver in p.features_enc:
+            lengths[resolver] = {}
+            for padding_strat in p.padding_strategies:
+                if padding_strat in p.features_enc[resolver][max_time_window]['length']:
+                    lengths[resolver][padding_strat] = Counter(p.features_enc[resolver][max_time_window]['length'][padding_strat])
+        partial = {"iat": Counter(p.features_clear[max_time_window]['iat']), "length": lengths}
+        if self.partials_dir != None:
+            self.save_partial(p, (p.pcap_helper_clear.input_pcap, p.pcap_helper_enc.input_pcap), partial)
+        return partial
+
+    def get_partial_path(self, pair: tuple) -> str:
+        input_pcap_clear, input_pcap_enc = pair
+        return os.path.join(self.partials_dir, hashlib.sha1(os.path.abspath(input_pcap_enc).encode()).hexdigest() + ".json")
+
+    def get_partial_key(self, engine, pair: tuple) -> str:
+        """
+        What the partial result of a pair depends on: the files (path, size, modification time),
+        the resolvers (and their IPs), the padding strategies and the TLS parser
+        """
+        files = []
+        for pcap_file in pair:
+            stat = os.stat(pcap_file)
+            files.append([os.path.abspath(pcap_file), stat.st_size, stat.st_mtime_ns])
+        key = [files, engine.resolvers, engine.IPs_to_resolvers, engine.padding_strategies, engine.tls_parser]
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def save_partial(self, engine, pair: tuple, partial: dict):
+        os.makedirs(self.partials_dir, exist_ok=True)
+        path = self.get_partial_path(pair)
+        # (Counter -> [value, count] pairs: JSON keys would turn the values into strings)
+        lengths = {}
+        for resolver in partial["length"]:
+            lengths[resolver] = {padding_strat: list(counter.items()) for padding_strat, counter in partial["length"][resolver].items()}
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({
+                "pair": list(pair),
+                "key": self.get_partial_key(engine, pair),
+                "iat": list(partial["iat"].items()),
+                "length": lengths,
+            }, f)
+        os.replace(f"{path}.tmp", path)
+
+    def load_partial(self, engine, pair: tuple) -> dict:
+        if self.partials_dir == None:
+            return None
+        path = self.get_partial_path(pair)
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["key"] != self.get_partial_key(engine, pair):
+                # the files (or the config) changed since
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        lengths = {}
+        for resolver in saved["length"]:
+            lengths[resolver] = {padding_strat: Counter(dict(values)) for padding_strat, values in saved["length"][resolver].items()}
+        return {"iat": Counter(dict(saved["iat"])), "length": lengths}
+
+    def open(self, engine):
+        self.distributions = {
+            "ALL_RESOLVERS": {
+                "iat": Counter()
+            }
+        }
+        for resolver in engine.get_resolvers_names():
+            self.distributions[resolver] = {}
+            for padding_strat in engine.padding_strategies:
+                self.distributions[resolver][padding_strat] = Counter()
+
+    def add(self, partial: dict):
+        if partial == None:
+            return
+        self.distributions["ALL_RESOLVERS"]['iat'].update(partial["iat"])
+        for resolver in partial["length"]:
+            for padding_strat in partial["length"][resolver]:
+                self.distributions[resolver][padding_strat].update(partial["length"][resolver][padding_strat])
+
+    def close(self):
+        with open(self.output_json, 'w') as f:
+            json.dump(self.distributions, f)
+        logging.debug(f"Distributions saved: {self.output_json}")
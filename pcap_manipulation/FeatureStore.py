@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import sys
+import logging
+
+# required before other imports (yes; see: https://stackoverflow.com/a/20280587)
+logging.basicConfig(
+    format='%(message)s',
+    level=logging.WARN,
+    stream=sys.stdout
+)
+
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+
+# A feature store is a directory (eg: data/csv/<RUN_ID>/all.features) containing:
+# - X.npy: the features as float32, column-major (Fortran order), so a subset of columns
+#   can be read (memory mapped) without reading the whole file
+# - y.npy: the label of each row, as an index in the categories
+# - meta.json: {"columns": [...], "categories": [...]} (the columns do not include the label)
+# See ml/utils.py (Dataset) for the reading part
+FEATURE_STORE_EXTENSION = ".features"
+
+# number of columns copied at once when transposing/merging (limits the memory used)
+COLUMNS_CHUNK_SIZE = 2048
+
+
+def is_feature_store(path: str) -> bool:
+    return path.rstrip("/").endswith(FEATURE_STORE_EXTENSION)
+
+
+def read_feature_store_meta(path: str) -> dict:
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        return json.load(f)
+
+
+def write_feature_store_meta(path: str, columns: list, categories: list):
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"columns": columns, "categories": categories}, f)
+
+
+def open_features_matrix(path: str, nb_rows: int, nb_columns: int) -> np.ndarray:
+    """
+    Creates X.npy (column-major) and returns it as a writable memory map
+    """
+    filename = os.path.join(path, "X.npy")
+    if nb_rows == 0 or nb_columns == 0:
+        # an empty file can not be memory mapped
+        np.save(filename, np.zeros((nb_rows, nb_columns), dtype=np.float32, order='F'))
+        return None
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(nb_rows, nb_columns), fortran_order=True)
+
+
+class FeatureStoreWriter(object):
+    """
+    Writes rows of features into a feature store, one row at a time
+
+    The rows are appended to a temporary row-major file,
+    which is transposed once into X.npy when closing the writer
+    """
+    def __init__(self, path: str, columns: list):
+        self.path = path
+        self.columns = columns
+        self.categories = []
+        self.labels = []
+
+        # starting from scratch (same as "cat /dev/null > file.csv")
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.rows_filename = os.path.join(self.path, "X.tmp")
+        self.rows_file = open(self.rows_filename, "wb")
+
+    def append(self, row, label: str):
+        row = np.asarray(row, dtype=np.float32)
+        if len(row) != len(self.columns):
+            logging.error(f"Wrong number of columns: {len(row)} != {len(self.columns)} ({label})")
+            raise ValueError
+        if label not in self.categories:
+            self.categories.append(label)
+        self.labels.append(self.categories.index(label))
+        self.rows_file.write(row.tobytes())
+
+    def close(self):
+        self.rows_file.close()
+        nb_rows = len(self.labels)
+        nb_columns = len(self.columns)
+
+        X = open_features_matrix(self.path, nb_rows, nb_columns)
+        if X is not None:
+            rows = np.memmap(self.rows_filename, dtype=np.float32, mode='r', shape=(nb_rows, nb_columns))
+            for start in range(0, nb_columns, COLUMNS_CHUNK_SIZE):
+                X[:, start:start+COLUMNS_CHUNK_SIZE] = rows[:, start:start+COLUMNS_CHUNK_SIZE]
+            X.flush()
+            del rows
+        os.remove(self.rows_filename)
+
+        np.save(os.path.join(self.path, "y.npy"), np.array(self.labels, dtype=np.int32))
+        write_feature_store_meta(self.path, self.columns, self.categories)
+        logging.debug(f"Feature store saved: {self.path} ({nb_rows} rows, {nb_columns} columns)")
+
+
+def merge_feature_stores(input_paths: list, output_path: str):
+    """
+    Concatenates the rows of multiple feature stores (eg: one per device)
+    into a single one, in the order of input_paths
+    """
+    metas = [read_feature_store_meta(path) for path in input_paths]
+    columns = metas[0]["columns"]
+    for path, meta in zip(input_paths, metas):
+        if meta["columns"] != columns:
+            logging.error(f"The columns of {path} are not the same as the ones of {input_paths[0]}")
+            raise ValueError
+
+    categories = []
+    labels = []
+    inputs = []
+    for path, meta in zip(input_paths, metas):
+        for category in meta["categories"]:
+            if category not in categories:
+                categories.append(category)
+        # going from the categories of the input to the merged ones
+        codes = np.array([categories.index(category) for category in meta["categories"]], dtype=np.int32)
+        y = np.load(os.path.join(path, "y.npy"))
+        labels.append(codes[y] if len(y) > 0 else y)
+        if len(y) > 0:
+            inputs.append(np.load(os.path.join(path, "X.npy"), mmap_mode='r'))
+
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.makedirs(output_path)
+
+    nb_rows = sum(len(y) for y in labels)
+    X = open_features_matrix(output_path, nb_rows, len(columns))
+    if X is not None:
+        for start in range(0, len(columns), COLUMNS_CHUNK_SIZE):
+            row = 0
+            for input_X in inputs:
+                X[row:row+len(input_X), start:start+COLUMNS_CHUNK_SIZE] = input_X[:, start:start+COLUMNS_CHUNK_SIZE]
+                row += len(input_X)
+        X.flush()
+
+    np.save(os.path.join(output_path, "y.npy"), np.concatenate(labels).astype(np.int32))
+    write_feature_store_meta(output_path, columns, categories)
+    logging.debug(f"Feature store saved: {output_path} ({nb_rows} rows, {len(columns)} columns)")
+
+
+def csv_to_feature_store(input_csv: str, output_path: str):
+    """
+    Converts a CSV dataset (label in the first column, see PcapExtract) into a feature store
+    """
+    with open(input_csv, "r") as f:
+        columns = f.readline().rstrip("\n").split(",")[1:] # removing the 'y'
+        writer = FeatureStoreWriter(output_path, columns)
+        for line in f:
+            line = line.rstrip("\n")
+            # the CSV files contain empty lines between devices
+            if line == "":
+                continue
+            label, values = line.split(",", 1)
+            writer.append(np.array(values.split(","), dtype=np.float32), label)
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a feature store (binary, columnar version of the CSV dataset)")
+    parser.add_argument('--input_stores', '-i', help='Feature stores to merge (eg: one per device)', nargs='+')
+    parser.add_argument('--input_csv', '-ic', help='CSV dataset to convert')
+    parser.add_argument('--output', '-o', help=f'Path of the output feature store (directory ending with {FEATURE_STORE_EXTENSION})', required=True)
+
+    args = parser.parse_args()
+
+    if not is_feature_store(args.output):
+        parser.error(f"The output must end with {FEATURE_STORE_EXTENSION}")
+
+    if args.input_stores != None:
+        merge_feature_stores(args.input_stores, args.output)
+    elif args.input_csv != None:
+        csv_to_feature_store(args.input_csv, args.output)
+    else:
+        parser.error("--input_stores or --input_csv is required")
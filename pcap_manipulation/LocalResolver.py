@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+import sys
+import logging
+
+# required before other imports (yes; see: https://stackoverflow.com/a/20280587)
+logging.basicConfig(
+    format='%(message)s',
+    level=logging.INFO,
+    stream=sys.stdout
+)
+
+import os
+import ssl
+import json
+import base64
+import hashlib
+import functools
+import argparse
+import ipaddress
+import tempfile
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs
+
+import trio
+import h11
+
+import dns.edns
+import dns.name
+import dns.zone
+import dns.exception
+import dns.flags
+import dns.rcode
+import dns.message
+import dns.rdatatype
+import dns.rdataclass
+import dns.rrset
+
+# HTTP/2 and certificate generation are optional (same as dnspython with h2)
+try:
+    import h2.config
+    import h2.events
+    import h2.exceptions
+    import h2.connection
+    _have_h2 = True
+except ImportError:
+    _have_h2 = False
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    _have_cryptography = True
+except ImportError:
+    _have_cryptography = False
+
+from utils import *
+
+
+class LocalResolver(object):
+    """
+    Local stand-in for the DoH/DoT resolvers, to benchmark the replay without the internet
+    (and without being rate limited / blocked by the real resolvers)
+
+    Each resolver of the resolvers config gets its own loopback address (DoH on 443, DoT on 853,
+    so PcapExtract handles the flows as usual) and answers from a zone file,
+    or with synthetic records (deterministic addresses derived from the qname).
+
+    The profiles (see configs/local_resolvers.json) emulate what differs between resolvers
+    on the wire:
+    - `padding`: EDNS padding block size of the answers (0: no padding),
+      only applied if the query is padded (RFC 8467), unless `pad_all`;
+    - `nb_answers`, `ttl`: size of the synthetic answers;
+    - `num_tickets`: number of TLS 1.3 session tickets sent after the handshake
+      (they are Application Data records on the wire, shifting down_index);
+    - `split_writes`: HTTP headers and body (DoH), or length and message (DoT), in separate TLS records;
+    - `http2`: offering h2 in ALPN (DoH, if h2 is installed), HTTP/1.1 otherwise;
+    - `up_index`, `down_index`: to override the ones written in the local resolvers config
+      (by default, computed from the profile, see get_indexes).
+    """
+    def __init__(self, resolvers: dict, profiles: dict, first_address: str = "127.0.1.1", doh_port: int = 443, dot_port: int = 853, zone_path: str = None, origin: str = None):
+        self.resolvers = resolvers
+        self.profiles = profiles
+        self.doh_port = doh_port
+        self.dot_port = dot_port
+        self.zone = None
+        if zone_path != None:
+            self.zone = dns.zone.from_file(zone_path, origin=origin, relativize=False)
+
+        # resolver name -> loopback address (the same name uses the same address for DoH and DoT)
+        self.addresses = {}
+        address = ipaddress.ip_address(first_address)
+        for resolver_type in self.resolvers:
+            for r in self.resolvers[resolver_type]:
+                if r['name'] not in self.addresses:
+                    self.addresses[r['name']] = str(address)
+                    address += 1
+
+        self.cert_path = None
+        self.key_path = None
+        self.tmp_dir = None
+        self.nb_queries = 0
+
+    def get_profile(self, resolver_type: str, name: str) -> dict:
+        profile = deepcopy(self.profiles.get('default', {}))
+        profile.update(self.profiles.get(resolver_type, {}).get(name, {}))
+        return profile
+
+    def get_indexes(self, resolver_type: str, profile: dict) -> tuple:
+        """
+        (up_index, down_index) of the query and of its answer in the TLS application data lengths
+        of a replayed connection (as read by PcapExtract, Scapy parser), measured on lo:
+        - DoT: [ChangeCipherSpec + Finished (client), query, tickets, (length), answer, close_notify]
+        - DoH, HTTP/1.1: [ChangeCipherSpec + Finished, request headers, query, tickets, (response headers), answer]
+        - DoH, h2: [ChangeCipherSpec + Finished, tickets, SETTINGS (server), preface + SETTINGS (client),
+          SETTINGS ack, request headers, query, SETTINGS ack, (response headers), answer]
+        (the answer is the record of the DNS message: the last one if split_writes)
+        """
+        num_tickets = profile.get('num_tickets', 2)
+        split = 1 if profile.get('split_writes', False) else 0
+        if resolver_type == "dot":
+            up_index, down_index = 2, 3 + num_tickets + split
+        elif _have_h2 and profile.get('http2', True):
+            up_index, down_index = 6 + num_tickets, 8 + num_tickets + split
+        else:
+            up_index, down_index = 3, 4 + num_tickets + split
+        return profile.get('up_index', up_index), profile.get('down_index', down_index)
+
+    def get_local_resolvers(self) -> dict:
+        """
+        The resolvers config to give to PcapReplay/PcapExtract (same names, local endpoints)
+        """
+        local_resolvers = {}
+        for resolver_type in self.resolvers:
+            local_resolvers[resolver_type] = []
+            for r in self.resolvers[resolver_type]:
+                profile = self.get_profile(resolver_type, r['name'])
+                address = self.addresses[r['name']]
+                # (not the indexes of the real resolver: the TLS records sent by this server are not the same)
+                up_index, down_index = self.get_indexes(resolver_type, profile)
+                local_resolvers[resolver_type].append({
+                    "name": r['name'],
+                    "endpoint": address,
+                    "ips": [address],
+                    "up_index": up_index,
+                    "down_index": down_index,
+                })
+        return local_resolvers
+
+    def set_certificate(self, cert_path: str = None, key_path: str = None):
+        """
+        Self-signed certificate for all the local addresses, unless one is given
+        (the replay then has to be run with --no-verify)
+        """
+        if cert_path != None:
+            self.cert_path, self.key_path = cert_path, key_path
+            return
+        if not _have_cryptography:
+            logging.error("cryptography is required to generate a certificate, use --cert/--key instead")
+            raise RuntimeError
+        key = ec.generate_private_key(ec.SECP256R1())
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "local resolver")])
+        now = datetime.now(timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(days=1))
+            .not_valid_after(now + timedelta(days=30))
+            .add_extension(x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address(a)) for a in self.addresses.values()]
+            ), critical=False)
+            .sign(key, hashes.SHA256())
+        )
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cert_path = os.path.join(self.tmp_dir.name, "cert.pem")
+        self.key_path = os.path.join(self.tmp_dir.name, "key.pem")
+        with open(self.cert_path, "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(self.key_path, "wb") as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ))
+
+    def get_ssl_context(self, profile: dict, alpn: list) -> ssl.SSLContext:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(self.cert_path, self.key_path)
+        ssl_context.num_tickets = profile.get('num_tickets', 2)
+        if alpn != None:
+            ssl_context.set_alpn_protocols(alpn)
+        return ssl_context
+
+    def get_records(self, qname: dns.name.Name, rdtype: int, profile: dict) -> dns.rrset.RRset:
+        if self.zone != None:
+            rrset = self.zone.get_rrset(qname, rdtype)
+            if rrset != None:
+                return rrset
+            if qname.is_subdomain(self.zone.origin):
+                return None
+        # synthetic answer, always the same for a given qname
+        digests = [hashlib.sha256(f"{qname.to_text().lower()}{i}".encode()).digest() for i in range(profile.get('nb_answers', 1))]
+        if rdtype == dns.rdatatype.A:
+            rdatas = [str(ipaddress.IPv4Address(bytes([10]) + d[:3])) for d in digests]
+        elif rdtype == dns.rdatatype.AAAA:
+            rdatas = [str(ipaddress.IPv6Address(bytes([0xfd, 0]) + d[:14])) for d in digests]
+        else:
+            # NOERROR without answer (NODATA)
+            return None
+        return dns.rrset.from_text_list(qname, profile.get('ttl', 300), dns.rdataclass.IN, rdtype, rdatas)
+
+    def get_answer(self, wire: bytes, profile: dict) -> bytes:
+        self.nb_queries += 1
+        query = dns.message.from_wire(wire)
+        answer = dns.message.make_response(query)
+        answer.flags |= dns.flags.RA
+        if len(query.question) > 0:
+            question = query.question[0]
+            rrset = self.get_records(question.name, question.rdtype, profile)
+            if rrset != None:
+                answer.answer.append(rrset)
+            elif self.zone != None and question.name.is_subdomain(self.zone.origin) and question.name not in self.zone.nodes:
+                answer.set_rcode(dns.rcode.NXDOMAIN)
+        # make_response does not pad, even if the query is padded
+        query_padded = any(o.otype == dns.edns.OptionType.PADDING for o in query.options)
+        if query.edns >= 0 and profile.get('padding', 0) > 0 and (query_padded or profile.get('pad_all', False)):
+            answer.use_edns(0, 0, 8192, pad=profile['padding'])
+        return answer.to_wire()
+
+    async def serve_dot(self, stream, profile: dict):
+        """
+        Length-prefixed DNS messages (RFC 7858), as long as the client keeps the connection opened
+        """
+        buf = b""
+        while True:
+            data = await stream.receive_some()
+            if not data:
+                return
+            buf += data
+            while len(buf) >= 2 and len(buf) >= 2 + int.from_bytes(buf[:2], "big"):
+                length = int.from_bytes(buf[:2], "big")
+                wire = self.get_answer(buf[2:2 + length], profile)
+                buf = buf[2 + length:]
+                if profile.get('split_writes', False):
+                    await stream.send_all(len(wire).to_bytes(2, "big"))
+                    await stream.send_all(wire)
+                else:
+                    await stream.send_all(len(wire).to_bytes(2, "big") + wire)
+
+    def get_doh_query(self, method: str, target: str, body: bytes):
+        """
+        RFC 8484: POST with the DNS message as body, or GET with the base64url DNS message in `dns`
+        Returns (status, DNS message or None)
+        """
+        url = urlsplit(target)
+        if url.path != "/dns-query":
+            return 404, None
+        if method == "POST":
+            return 200, bytes(body)
+        if method == "GET":
+            dns_param = parse_qs(url.query).get('dns')
+            if dns_param == None:
+                return 400, None
+            param = dns_param[0]
+            return 200, base64.urlsafe_b64decode(param + "=" * (-len(param) % 4))
+        return 405, None
+
+    async def serve_http1(self, stream, profile: dict):
+        conn = h11.Connection(h11.SERVER)
+        request, body = None, bytearray()
+        while True:
+            event = conn.next_event()
+            if event is h11.NEED_DATA:
+                conn.receive_data(await stream.receive_some())
+                continue
+            if isinstance(event, h11.Request):
+                request, body = event, bytearray()
+            elif isinstance(event, h11.Data):
+                body += event.data
+            elif isinstance(event, h11.EndOfMessage):
+                status, query = self.get_doh_query(request.method.decode(), request.target.decode(), body)
+                wire = self.get_answer(query, profile) if query != None else b""
+                headers = [("content-type", "application/dns-message"), ("content-length", str(len(wire)))]
+                data = conn.send(h11.Response(status_code=status, headers=headers))
+                if profile.get('split_writes', False):
+                    await stream.send_all(data)
+                    data = b""
+                data += conn.send(h11.Data(data=wire)) + conn.send(h11.EndOfMessage())
+                await stream.send_all(data)
+                if conn.our_state is h11.MUST_CLOSE:
+                    return
+                conn.start_next_cycle()
+            elif isinstance(event, h11.ConnectionClosed):
+                return
+
+    async def serve_http2(self, stream, profile: dict):
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        conn.initiate_connection()
+        await stream.send_all(conn.data_to_send())
+        # stream id -> (headers, body)
+        requests = {}
+        while True:
+            data = await stream.receive_some()
+            if not data:
+                return
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    requests[event.stream_id] = (dict(event.headers), bytearray())
+                elif isinstance(event, h2.events.DataReceived):
+                    requests[event.stream_id][1].extend(event.data)
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, body = requests.pop(event.stream_id)
+                    status, query = self.get_doh_query(headers[':method'], headers[':path'], body)
+                    wire = self.get_answer(query, profile) if query != None else b""
+                    conn.send_headers(event.stream_id, [
+                        (":status", str(status)),
+                        ("content-type", "application/dns-message"),
+                        ("content-length", str(len(wire))),
+                    ])
+                    if profile.get('split_writes', False):
+                        await stream.send_all(conn.data_to_send())
+                    conn.send_data(event.stream_id, wire, end_stream=True)
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    await stream.send_all(conn.data_to_send())
+                    return
+            await stream.send_all(conn.data_to_send())
+
+    async def handle(self, tcp_stream, resolver_type: str, profile: dict, ssl_context: ssl.SSLContext):
+        stream = trio.SSLStream(tcp_stream, ssl_context, server_side=True)
+        try:
+            await stream.do_handshake()
+            if resolver_type == "dot":
+                await self.serve_dot(stream, profile)
+            elif stream.selected_alpn_protocol() == "h2":
+                await self.serve_http2(stream, profile)
+            else:
+                await self.serve_http1(stream, profile)
+        except (trio.BrokenResourceError, trio.ClosedResourceError, h11.ProtocolError, dns.exception.DNSException) as e:
+            # the client went away, or sent garbage: only this connection is affected
+            logging.debug(f"Connection error ({resolver_type}): {e!r}")
+        except Exception as e:
+            if _have_h2 and isinstance(e, h2.exceptions.ProtocolError):
+                logging.debug(f"Connection error ({resolver_type}): {e!r}")
+            else:
+                raise
+        finally:
+            await trio.aclose_forcefully(stream)
+
+    async def serve(self, task_status=trio.TASK_STATUS_IGNORED):
+        async with trio.open_nursery() as nursery:
+            for resolver_type in self.resolvers:
+                for r in self.resolvers[resolver_type]:
+                    profile = self.get_profile(resolver_type, r['name'])
+                    if resolver_type == "doh":
+                        port = self.doh_port
+                        alpn = ["h2", "http/1.1"] if _have_h2 and profile.get('http2', True) else ["http/1.1"]
+                    else:
+                        port = self.dot_port
+                        alpn = ["dot"]
+                    ssl_context = self.get_ssl_context(profile, alpn)
+                    handler = lambda s, t=resolver_type, p=profile, c=ssl_context: self.handle(s, t, p, c)
+                    await nursery.start(functools.partial(trio.serve_tcp, handler, port, host=self.addresses[r['name']]))
+                    logging.info(f"--- {r['name']} ({resolver_type}) listening on {self.addresses[r['name']]}:{port}")
+            task_status.started()
+
+
+if __name__ == "__main__":
+    """
+    Answer the DoH/DoT queries of the replay locally:
+
+    python3 LocalResolver.py -rc configs/resolvers.json -orc /tmp/local_resolvers.json
+    python3 PcapReplay.py -rc /tmp/local_resolvers.json -if lo --no-verify ...
+    """
+    parser = argparse.ArgumentParser(description="Local DoH/DoT server standing in for the resolvers of the replay")
+    parser.add_argument('--resolvers_config', '-rc', help='Config file containing the resolvers to stand in for', required=True)
+    parser.add_argument('--local_config', '-lc', help='Config file containing the profiles of the local resolvers', default="configs/local_resolvers.json")
+    parser.add_argument('--output_resolvers_config', '-orc', help='Where to save the resolvers config pointing to the local resolvers (to use for replay and extraction)', required=True)
+    parser.add_argument('--zone', '-z', help='Zone file to answer from (otherwise, synthetic answers)')
+    parser.add_argument('--origin', '-or', help='Origin of the zone file, if it does not have a $ORIGIN')
+    parser.add_argument('--first_address', '-fa', help='Loopback address of the first resolver, the next ones are incremented', default="127.0.1.1")
+    parser.add_argument('--doh_port', '-dohp', help='DoH port (PcapExtract expects 443)', type=int, default=443)
+    parser.add_argument('--dot_port', '-dotp', help='DoT port (PcapExtract expects 853)', type=int, default=853)
+    parser.add_argument('--cert', '-c', help='TLS certificate (default: self-signed, generated for the local addresses)')
+    parser.add_argument('--key', '-k', help='Private key of the TLS certificate')
+
+    args = parser.parse_args()
+    if (args.cert == None) != (args.key == None):
+        parser.error("--cert and --key go together")
+    resolvers_config = read_conf(args.resolvers_config)
+    local_config = read_conf(args.local_config)
+
+    lr = LocalResolver(
+        resolvers_config['resolvers'],
+        local_config,
+        first_address=args.first_address,
+        doh_port=args.doh_port,
+        dot_port=args.dot_port,
+        zone_path=args.zone,
+        origin=args.origin,
+    )
+    lr.set_certificate(args.cert, args.key)
+
+    output_config = deepcopy(resolvers_config)
+    output_config['resolvers'] = lr.get_local_resolvers()
+    with open(args.output_resolvers_config, "w") as f:
+        json.dump(output_config, f, indent=4)
+    logging.info(f"--- Local resolvers config saved in {args.output_resolvers_config}")
+
+    try:
+        trio.run(lr.serve)
+    except KeyboardInterrupt:
+        logging.info(f"--- {lr.nb_queries} queries answered")
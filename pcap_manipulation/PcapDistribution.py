@@ -10,17 +10,17 @@ logging.basicConfig(
     stream=sys.stdout
 )
 
-import glob
 import argparse 
 
 from utils import *
 from PcapHelper import *
 from PcapExtract import *
+from ExtractEngine import *
 
 
 
 
-class PcapDistribution(PcapHelper):
+class PcapDistribution(object):
     def __init__(self,
         resolvers: dict, 
         padding_strategies: dict,
@@ -29,88 +29,49 @@ class PcapDistribution(PcapHelper):
         output_json: str,
         max_nb_query: int, 
         length_multiplier: int,
+        tls_parser: str = "scapy",
+        resolvers_cache: str = None,
+        max_workers: int = 1,
+        partials_dir: str = None,
+        manual_resolvers_IP: bool = True,
     ):
         self.input_glob_clear = input_glob_clear
         self.input_glob_enc = input_glob_enc
-
         self.output_json = output_json 
-        self.resolvers = resolvers 
-        self.padding_strategies = padding_strategies
-        self.max_nb_query = max_nb_query
-        self.length_multiplier = length_multiplier
-
-        self.distributions = {
-            "ALL_RESOLVERS": {
-                "iat": {}
-            }
-        }
-        for resolver_type in self.resolvers: 
-            for resolver_obj in self.resolvers[resolver_type]:
-                resolver = f"{resolver_type}_{resolver_obj['name']}"
-                self.distributions[resolver] = {}
-                for padding_strat in self.padding_strategies: 
-                    self.distributions[resolver][padding_strat] = {}
-
-        # Manually setting the IPs here to avoid DDOS'ing the resolver in the loop :) 
-        self.IPs_to_resolvers = {'1.1.1.1': 'Cloudflare', '8.8.8.8': 'Google', '9.9.9.9': 'Quad9', '149.112.112.112': 'Quad9', '185.228.168.10': 'CleanBrowsing', '185.228.168.168': 'CleanBrowsing', '37.252.225.79': 'NextDNS', '185.10.16.125': 'NextDNS', '94.140.14.140': 'AdGuard', '94.140.14.141': 'AdGuard', '185.228.168.9': 'CleanBrowsing'}
-        self.resolvers_IPs = []            
-        for ip in self.IPs_to_resolvers.keys(): 
-            self.resolvers_IPs.append(ip)
-
-        self.max_time_window = None 
+        self.max_workers = max_workers
+
+        # the features of each pair of files are extracted by the single pass engine, 
+        # the distributions are gathered by its DistributionSink (see ExtractSinks.py)
+        # IPs of the resolvers: resolved once for all the files, the ones saved at replay time (see ResolversCache),
+        # or the hardcoded ones, to avoid DDOS'ing the resolvers in the loop :) 
+        self.sink = DistributionSink(output_json, partials_dir)
+        self.engine = ExtractEngine(
+            resolvers, 
+            padding_strategies,
+            None, 
+            None, 
+            max_nb_query, 
+            length_multiplier,
+            "test_device",
+            [self.sink],
+            manual_resolvers_IP=manual_resolvers_IP,
+            tls_parser=tls_parser,
+            resolvers_cache=resolvers_cache,
+        )
 
     def read_files(self): 
-        self.files_clear = glob(f"{self.input_glob_clear}") 
-        self.files_enc = glob(f"{self.input_glob_enc}") 
-        logging.debug(f"[+] Files (clear): {self.files_clear}")
-        logging.debug(f"[+] Files (enc): {self.files_enc}")
+        # pairing the files by filename (same as PcapExtract)
+        self.pairs = get_glob_pairs(self.input_glob_clear, self.input_glob_enc)
+        logging.debug(f"[+] Files (clear, enc): {self.pairs}")
 
     def loop_through_files(self):
+        """
+        Extracting the features of all the files (only the new ones with a partials_dir), 
+        and saving the distributions into self.output_json
+        """
         logging.debug(f"[+] Looping through files")
-        for i in range(len(self.files_clear)): 
-            f_clear = self.files_clear[i]
-            f_enc = self.files_enc[i]
-            p = PcapExtract(
-                self.resolvers, 
-                self.padding_strategies,
-                f_clear, 
-                f_enc, 
-                self.max_nb_query, 
-                self.length_multiplier,
-                "", 
-                "a", 
-                "test_device",
-                manual_resolvers_IP=True
-            )
-
-            p.IPs_to_resolvers = self.IPs_to_resolvers
-            p.resolvers_IPs = self.resolvers_IPs
-            p.pcap_helper_clear.resolvers_IPs = self.resolvers_IPs
-            p.pcap_helper_enc.resolvers_IPs = self.resolvers_IPs
-
-            p.extract_features_clear()
-            p.extract_features_enc()
-
-            # using the biggest time window to only select the highest features 
-            if self.max_time_window == None: 
-                self.max_time_window = max(p.incremental_seconds.keys())
-
-            increment_values_in_dict(
-                self.distributions["ALL_RESOLVERS"]['iat'], 
-                p.features_clear[self.max_time_window]['iat']
-            )
-
-            for resolver in p.features_enc:                 
-                for padding_strat in self.padding_strategies: 
-                    if padding_strat in p.features_enc[resolver][self.max_time_window]['length']:
-                        increment_values_in_dict(
-                            self.distributions[resolver][padding_strat], 
-                            p.features_enc[resolver][self.max_time_window]['length'][padding_strat]
-                        )
-
-    def save_distributions(self): 
-        with open(self.output_json, 'w') as f:
-            json.dump(self.distributions, f)    
+        self.engine.extract_pairs(self.pairs, self.max_workers)
+        self.distributions = self.sink.distributions
 
 
 if __name__ == "__main__":
@@ -120,6 +81,10 @@ if __name__ == "__main__":
     parser.add_argument('--output_json', '-o', help='Path of the output JSON file containing the distribution data')
     parser.add_argument('--resolvers_config', '-rc', help='Config file containing the IP address of DNS resolvers', required=True)
     parser.add_argument('--extract_config', '-ec', help='Config file containing stable parameters used for extraction', required=True)
+    parser.add_argument('--manual_resolvers_IP', '-mr', help="Use the hardcoded IPs of the resolvers (default), --no-manual_resolvers_IP to resolve them", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--resolvers_cache', '-rca', help="Use the IPs of the resolvers saved at replay time (JSON file of the run, see ResolversCache)")
+    parser.add_argument('--max_workers', '-w', help='Number of worker processes (default: 1, no pool; 0: number of CPUs)', type=int, default=1)
+    parser.add_argument('--partials_dir', '-pd', help='Directory where the distributions of each pair of files are saved: the next runs only extract the new (or modified) files')
 
     args = parser.parse_args()
     
@@ -134,11 +99,14 @@ if __name__ == "__main__":
         args.output_json,
         extract_config["max_nb_query"], 
         extract_config["length_multiplier"],
+        resolvers_cache=args.resolvers_cache,
+        max_workers=None if args.max_workers == 0 else args.max_workers,
+        partials_dir=args.partials_dir,
+        manual_resolvers_IP=args.manual_resolvers_IP,
     )
 
     p.read_files()
     p.loop_through_files()
-    p.save_distributions()
 
 
 
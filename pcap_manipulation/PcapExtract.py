@@ -13,7 +13,10 @@ logging.basicConfig(
 import warnings
 warnings.filterwarnings("ignore", category=RuntimeWarning) 
 
+import os
 import argparse 
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np 
 import scipy as sc
@@ -26,6 +29,27 @@ bind_layers(TCP, TLS, dport=853)
 
 from utils import *
 from PcapHelper import *
+from TlsScanner import *
+from FeatureStore import *
+
+# "scapy": dissecting each TCP payload with Scapy's TLS layer (reference implementation)
+# "native": only reading the TLS record headers when Scapy would find the same records (see scan_app_data_records), 
+# not available from the command line until its features are checked against Scapy's on the replayed captures
+TLS_PARSERS = ["scapy", "native"]
+
+# Layouts of the CSV line, by configuration (see PcapExtract.get_row_layout)
+row_layouts = {}
+
+def format_csv_row(row: np.ndarray) -> str: 
+    """
+    Formatting a row of features as CSV columns, in linear time 
+    (integer values without decimals, eg: lengths, to keep the CSV small)
+    """
+    return ",".join([str(int(v)) if v.is_integer() else repr(v) for v in row.tolist()])
+
+# Batch mode: configuration shared by all the workers of the process pool
+# (set once per worker by init_batch_worker, instead of being pickled for each file)
+batch_worker_conf = {}
 
 class PcapExtract(PcapHelper):
     def __init__(self,
@@ -38,25 +62,33 @@ class PcapExtract(PcapHelper):
         output_csv: str, 
         csv_file_mode: str, 
         device_name: str, 
-        manual_resolvers_IP: bool = False
+        manual_resolvers_IP: bool = False,
+        tls_parser: str = "scapy",
+        resolvers_cache: str = None,
     ):
         PcapHelper.__init__(self, resolvers, padding_strategies, input_pcap_enc)  
+
+        if tls_parser not in TLS_PARSERS: 
+            logging.error(f"Unknown TLS parser: {tls_parser} (available: {TLS_PARSERS})")
+            raise ValueError
+        self.tls_parser = tls_parser
         
-        # These objects are only used a ways to momentarily save packets of the 2 files in memory 
+        # These objects are only used as ways to stream the packets of the 2 files
         self.pcap_helper_clear = PcapHelper(resolvers, padding_strategies, clear_input_pcap)
         self.pcap_helper_enc = PcapHelper(resolvers, padding_strategies, input_pcap_enc)
         
         # a list of the IPs used by all the resolvers
-        if not manual_resolvers_IP: 
+        # (resolvers_cache: the IPs saved at replay time, see ResolversCache)
+        if resolvers_cache != None: 
+            self.set_resolvers_IPs(ResolversCache(resolvers_cache, read_only=True))
+            self.pcap_helper_clear.resolvers_IPs = self.resolvers_IPs
+            self.pcap_helper_enc.resolvers_IPs = self.resolvers_IPs
+        elif not manual_resolvers_IP: 
             self.set_resolvers_IPs()
             self.pcap_helper_clear.resolvers_IPs = self.resolvers_IPs
             self.pcap_helper_enc.resolvers_IPs = self.resolvers_IPs
         else: 
-            # Manually setting the IPs here to avoid DDOS'ing the resolver in the loop :) 
-            self.IPs_to_resolvers = {'1.1.1.1': 'Cloudflare', '8.8.8.8': 'Google', '9.9.9.9': 'Quad9', '149.112.112.112': 'Quad9', '185.228.168.10': 'CleanBrowsing', '185.228.168.168': 'CleanBrowsing', '37.252.225.79': 'NextDNS', '185.10.16.125': 'NextDNS', '94.140.14.140': 'AdGuard', '94.140.14.141': 'AdGuard', '185.228.168.9': 'CleanBrowsing'}
-            self.resolvers_IPs = []     
-            for ip in self.IPs_to_resolvers.keys(): 
-                self.resolvers_IPs.append(ip)
+            self.set_legacy_resolvers_IPs()
 
         self.resolvers_indexes = {}
         for resolver_type in self.resolvers: 
@@ -80,6 +112,9 @@ class PcapExtract(PcapHelper):
             60*5: {},
         }
 
+        # time of the first and of the previous DNS query of the clear-text capture (see add_clear_record)
+        self.clear_ref_time = None
+        self.clear_previous_time = None
         self.features_clear = self.incremental_seconds.copy()
         for time_window in self.features_clear: 
             self.features_clear[time_window]['iat'] = []
@@ -97,61 +132,62 @@ class PcapExtract(PcapHelper):
         self.device_name = device_name
 
         self.stats_columns = self.compute_statistical_aggregates([0]).keys() 
+        self.row_layout = self.get_row_layout()
 
     def extract_features_clear(self):
         """
         Extracting features from the clear-text version of the capture 
         - DNS IAT 
         """
-        self.pcap_helper_clear.read_pcap()
-        ref_time = None
-        previous_time = None
-
-        for pkt in self.pcap_helper_clear.packets: 
-            if DNSQR in pkt and pkt.dport == 53:
-                t = pkt.time
-                if ref_time == None:
-                    ref_time = t 
-                if previous_time != None:
-                    # Rounding the time to keep a 100ms precision
-                    iat = float(round(t - previous_time, 1))
-                    
-                    for time_window in self.incremental_seconds:
-                        if t - ref_time < time_window:
-                            if time_window not in self.features_clear:
-                                self.features_clear[time_window] = {
-                                    'iat': []
-                                }
-                            self.features_clear[time_window]['iat'].append(iat)
-                previous_time = t
+        for record in self.pcap_helper_clear.stream_pcap(): 
+            self.add_clear_record(record)
+
+    def add_clear_record(self, record: PacketRecord):
+        """
+        Adding the IAT of a DNS query of the clear-text capture (the frames must be added in order)
+        """
+        if record.dport == 53 and self.get_dns_qdcount(record) > 0:
+            t = record.ts
+            if self.clear_ref_time == None:
+                self.clear_ref_time = t 
+            if self.clear_previous_time != None:
+                # Rounding the time to keep a 100ms precision
+                iat = round_time_delta(t - self.clear_previous_time, 1)
+                
+                for time_window in self.incremental_seconds:
+                    if t - self.clear_ref_time < time_window:
+                        if time_window not in self.features_clear:
+                            self.features_clear[time_window] = {
+                                'iat': []
+                            }
+                        self.features_clear[time_window]['iat'].append(iat)
+            self.clear_previous_time = t
 
     def extract_features_enc(self):
         """
         Extracting features from the encrypted version of the capture
         - TLS application data lengths
         """
-        self.pcap_helper_enc.read_pcap()
-
-        for pkt in self.pcap_helper_enc.packets:
-            if IP in pkt and TCP in pkt:
+        for record in self.pcap_helper_enc.stream_pcap():
+            if record.proto == PROTO_TCP:
                 if self.first_tcp_time == None: 
-                    self.first_tcp_time = int(pkt.time) 
-                self.add_pkt_to_tcp_session(pkt)
+                    self.first_tcp_time = int(record.ts) 
+                self.add_pkt_to_tcp_session(record)
         self.handle_tcp_sessions()
 
-    def add_pkt_to_tcp_session(self, pkt):
+    def add_pkt_to_tcp_session(self, record: PacketRecord):
         """
         Saves a packet to its corresponding TCP session
         """
-        if pkt[IP].src not in self.resolvers_IPs: # uplinks
-            session = f"{pkt[IP].src}-{pkt[IP].dst}:{pkt[TCP].sport}"
+        if record.src not in self.resolvers_IPs: # uplinks
+            session = f"{record.src}-{record.dst}:{record.sport}"
         else: #downlinks
-            session = f"{pkt[IP].dst}-{pkt[IP].src}:{pkt[TCP].dport}" # NOTE: switching dst/src
+            session = f"{record.dst}-{record.src}:{record.dport}" # NOTE: switching dst/src
         
         if session in self.tcp_sessions:
-            self.tcp_sessions[session].append(pkt)
+            self.tcp_sessions[session].append(record)
         else: 
-            self.tcp_sessions[session] = [pkt] 
+            self.tcp_sessions[session] = [record] 
 
     def handle_tcp_sessions(self): 
         """
@@ -166,57 +202,103 @@ class PcapExtract(PcapHelper):
                 if len(raw_features["length"]) != 0:
                     self.add_features(resolver, session, raw_features)
 
-    def get_resolver(self, pkt):
+    def get_resolver(self, record: PacketRecord):
         """
         Return the resolver used for a given packet
         """
-        if pkt[TCP].sport == 443 or pkt[TCP].dport == 443:
+        if record.sport == 443 or record.dport == 443:
             resolver_type = "doh"
-        elif pkt[TCP].sport == 853 or pkt[TCP].dport == 853: 
+        elif record.sport == 853 or record.dport == 853: 
             resolver_type = "dot"
         else: 
             resolver_type = "unknown"
         
-        if pkt[IP].src in self.IPs_to_resolvers: 
-            resolver_ip = self.IPs_to_resolvers[pkt[IP].src]
-        elif pkt[IP].dst in self.IPs_to_resolvers: 
-            resolver_ip = self.IPs_to_resolvers[pkt[IP].dst]
+        if record.src in self.IPs_to_resolvers: 
+            resolver_ip = self.IPs_to_resolvers[record.src]
+        elif record.dst in self.IPs_to_resolvers: 
+            resolver_ip = self.IPs_to_resolvers[record.dst]
         else:
             resolver_ip = "unknown"
         
         if resolver_ip == "unknown" or resolver_type == "unknown": 
-            print(pkt)
+            print(record)
             raise ValueError 
 
         return f"{resolver_type}_{resolver_ip}"
 
-    def extract_raw_feature_from_session(self, session: str) -> dict:
+    def extract_raw_feature_from_session(self, session: list) -> dict:
         """
         Returns a dict of lengths of TLS application data
         and the epoch time of the first packet in the session
         """
+        if self.tls_parser == "native": 
+            lengths = self.get_app_data_lengths_native(session)
+        else: 
+            lengths = self.get_app_data_lengths_scapy(session)
+            
+        return {"length": lengths, "first_time": session[0].ts, "last_time": session[len(session)-1].ts}
+
+    def get_app_data_lengths_scapy(self, session: list) -> list[int]: 
+        """
+        Lengths of TLS application data (negative for downlinks), using Scapy's TLS layer
+        """
+        return self.get_app_data_lengths(session, self.get_segment_lengths_scapy)
+
+    def get_app_data_lengths_native(self, session: list) -> list[int]: 
+        """
+        Same as get_app_data_lengths_scapy, only reading the TLS record headers of the segments 
+        for which Scapy is known to find the same records (see scan_app_data_records), 
+        the other ones (eg: ChangeCipherSpec + Finished) are still dissected by Scapy
+        """
+        return self.get_app_data_lengths(session, self.get_segment_lengths_native)
+
+    def get_app_data_lengths(self, session: list, get_segment_lengths) -> list[int]: 
         lengths = []
-        first_time = None 
         tcp_seq_numbers = []
         for i in range(len(session)): 
-            pkt = session[i]
-            if TLS in pkt:
+            record = session[i]
+            # TLS is only dissected on the DoH/DoT ports, and only if there is something to dissect
+            if len(record.payload) > 0 and self.is_tls_port(record):
                 # Detecting duplicate TCP messages based on their sequence numbers
                 # We want to avoid counting them twice to correctly select the length of up/downlinks
-                if len(tcp_seq_numbers) < 1 or tcp_seq_numbers[-1] != pkt[TCP].seq:                           
-                    current = pkt[TLS]
-                    while current:
-                        if TLSApplicationData in current:
-                            if pkt[IP].src not in self.resolvers_IPs: 
-                                lengths.append(current.len)
-                            else: 
-                                lengths.append(-current.len)
-                        current = current.getlayer(TLS, 2)
-                    tcp_seq_numbers.append(pkt[TCP].seq)
-            if first_time == None:
-                first_time = pkt.time
-            
-        return {"length": lengths, "first_time": first_time, "last_time": session[len(session)-1].time}
+                if len(tcp_seq_numbers) < 1 or tcp_seq_numbers[-1] != record.seq:                           
+                    for l in get_segment_lengths(record.payload): 
+                        if record.src not in self.resolvers_IPs: 
+                            lengths.append(l)
+                        else: 
+                            lengths.append(-l)
+                    tcp_seq_numbers.append(record.seq)
+        return lengths
+
+    def get_segment_lengths_scapy(self, payload) -> list[int]: 
+        """
+        Lengths of the TLS records of a TCP segment counted as application data, dissecting it with Scapy: 
+        the application data records, and the records followed by one in the segment
+        """
+        lengths = []
+        # dissecting the TCP payload only, not the whole frame
+        try: 
+            current = TLS(bytes(payload))
+        except Exception: 
+            # same as Scapy when dissecting a whole frame: an undissectable payload is not TLS
+            current = None
+        while current:
+            if TLSApplicationData in current:
+                lengths.append(current.len)
+            current = current.getlayer(TLS, 2)
+        return lengths
+
+    def get_segment_lengths_native(self, payload) -> list[int]: 
+        lengths = scan_app_data_records(payload)
+        if lengths == None: 
+            return self.get_segment_lengths_scapy(payload)
+        return lengths
+
+    def is_tls_port(self, record: PacketRecord) -> bool: 
+        """
+        Same ports as the ones bound to TLS in Scapy (443 by default, 853 for DoT) 
+        """
+        return record.sport in (443, 853) or record.dport in (443, 853)
 
     def add_features(self, resolver: str, session: str, raw_features: dict):
         """
@@ -289,40 +371,116 @@ class PcapExtract(PcapHelper):
         
         return res 
 
-    def get_csv_columns(self, max_nb: int, values: list, nan_value) -> str:
+    def compute_prefix_statistical_aggregates(self, values: list, ends: list) -> np.ndarray: 
         """
-        Create csv columns based on values
+        Same as [compute_statistical_aggregates(values[0:end]) for end in ends], 
+        but with one vectorized pass instead of one numpy/scipy call per prefix: 
+        the moments of all the prefixes come from cumulative sums of powers
+
+        Returns an array of shape (len(ends), len(self.stats_columns)), 
+        in the same order as in the CSV header
 
-        If there are not enough values,
-        put specific None/NaN values instead so no column is empty  
+        NOTE: the values are shifted by the first one before computing the powers 
+        (the moments don't change, but there is less cancellation, 
+        and a constant prefix gives a variance of exactly 0, like with np.var)
         """
-        if len(values) > max_nb: 
-            logging.error(f"More values than available space: {len(values)} > {max_nb}")
+        # empty values if there are no values in the prefix, eg when no packet was received before X seconds 
+        res = np.zeros((len(ends), len(self.stats_columns)))
+        if len(values) == 0: 
+            return res
+
+        x = np.asarray(values, dtype=np.float64)
+        # values[0:end] with end > len(values) is the whole list
+        ends = np.minimum(np.asarray(ends), len(x))
+        nb = np.arange(1, len(x)+1)
+
+        d = x - x[0]
+        d2 = d*d
+        s1 = np.cumsum(d) / nb
+        s2 = np.cumsum(d2) / nb
+        s3 = np.cumsum(d2*d) / nb
+        s4 = np.cumsum(d2*d2) / nb
+
+        # same as np.mean (exact sums with integer values)
+        mean = np.cumsum(x) / nb
+        # central moments from the raw moments (of the shifted values)
+        m2 = np.maximum(s2 - s1*s1, 0)
+        m3 = s3 - 3*s1*s2 + 2*s1**3
+        m4 = s4 - 4*s1*s3 + 6*s1*s1*s2 - 3*s1**4
+
+        # same rule as in scipy (1.11): skewness and kurtosis are not computable for a (quasi-)zero variance 
+        # which makes sense, as it's the neutral values for both 
+        zero = m2 <= (np.finfo(np.float64).resolution * mean)**2
+        with np.errstate(all='ignore'): 
+            skewness = np.where(zero, 0, m3 / m2**1.5)
+            kurtosis = np.where(zero, 0, m4 / m2**2 - 3)
 
-        i = 0  
-        columns = ""           
-        while i < max_nb and i < len(values): 
-            columns = f"{columns},{values[i]}"
-            i += 1
-        columns = columns[1:] # removing the first comma
-        
-        while i < max_nb: 
-            columns = f"{columns},{nan_value}"
-            i += 1
-        
-        if columns[0] == ",": 
-            columns = columns[1:]
-        
-        return columns
+        i = ends[ends > 0] - 1
+        # same order as compute_statistical_aggregates
+        res[ends > 0] = np.column_stack((mean[i], m2[i], np.sqrt(m2[i]), skewness[i], kurtosis[i]))
+        return res
+
+    def get_row_layout(self) -> dict: 
+        """
+        Layout of a CSV line (without the label), computed once per configuration: 
+        - "blocks": (resolver, time_window, col_name, start, stop) in the order of the CSV header
+        - "index": (resolver, time_window, col_name) -> (start, stop) 
+        - "template": the row filled with the default values 
+        (-1 for IATs as a negative IAT should not be possible, 
+        0 for everything else: a zero length is an empty message, 
+        can't use negative value because downlinks are negative)
+        """
+        key = (
+            tuple(self.incremental_seconds), 
+            tuple(self.get_resolvers_names()), 
+            tuple(self.columns_order_clear), 
+            tuple(self.columns_order_enc), 
+            self.max_nb_query, 
+            self.max_nb_length, 
+            self.max_nb_iat
+        )
+        if key in row_layouts: 
+            return row_layouts[key]
+
+        blocks = []
+        start = 0
+        for resolver, columns_order in [("ALL_RESOLVERS", self.columns_order_clear)] + [(r, self.columns_order_enc) for r in self.get_resolvers_names()]: 
+            for time_window in self.incremental_seconds: 
+                for col_name in columns_order: 
+                    if "stats" in col_name: 
+                        nb = self.max_nb_query*len(self.stats_columns)
+                    elif "iat" in col_name: 
+                        nb = self.max_nb_iat
+                    else: 
+                        nb = self.max_nb_length
+                    blocks.append((resolver, time_window, col_name, start, start+nb))
+                    start += nb
+
+        template = np.zeros(start)
+        for resolver, time_window, col_name, start, stop in blocks: 
+            if col_name == "columns_iat": 
+                template[start:stop] = -1
+
+        row_layouts[key] = {
+            "blocks": blocks, 
+            "index": {block[:3]: block[3:] for block in blocks}, 
+            "template": template
+        }
+        return row_layouts[key]
 
-    def get_csv_stats_str(self, stats: dict) -> str:
-        res = ""
-        for k in stats:
-            res = f"{res},{stats[k]}"
-        return res[1:]
+    def get_resolvers_names(self) -> list: 
+        """
+        Names of the resolvers (eg: doh_Google), in the order of the config file (and of the CSV)
+        """
+        return [f"{resolver_type}_{resolver_obj['name']}" for resolver_type in self.resolvers for resolver_obj in self.resolvers[resolver_type]]
 
-    def get_csv_statistical_aggregates(self, values: list) -> str: 
-        return self.get_csv_stats_str(self.compute_statistical_aggregates(values))
+    def set_row_values(self, row: np.ndarray, resolver: str, time_window: int, col_name: str, values): 
+        """
+        Copying values at the start of their block of columns, the remaining columns keep their default value
+        """
+        start, stop = self.row_layout["index"][(resolver, time_window, col_name)]
+        values = np.ravel(values)
+        row[start:start+len(values)] = values
 
     def get_csv_from_features(self): 
         """
@@ -334,153 +492,110 @@ class PcapExtract(PcapHelper):
 
         Note: add the label (name of device) at the *start* of the CSV line
         """
-        csv_line = f"{self.device_name}" 
-
-        if len(self.features_enc) != 0: 
-            """
-            1. Add the whole IAT stuff once
-            """
-            tmp_clear = {}
-            for time_window in self.features_clear:
-                # NOTE: selecting only up to the max number the variables
-                # do not contain more than what is authorized
-                iat = self.features_clear[time_window]['iat'][:self.max_nb_iat]
-
-                tmp_clear['columns_iat'] = self.get_csv_columns(
-                    self.max_nb_iat, 
-                    iat, 
-                    -1 # a negative IAT should not be possible
-                )
-
-                tmp_clear['stats_iat'] = ""
-                # starting at 0 is useless as it creates an empty list. 
-                for i in range(1, self.max_nb_iat+1): 
-                    tmp_clear['stats_iat'] += "," + self.get_csv_statistical_aggregates(iat[0:i])
-                
-                # removing the first comma 
-                tmp_clear['stats_iat'] = tmp_clear['stats_iat'][1:]
-
-                for col_name in self.columns_order_clear: 
-                    csv_line = f"{csv_line},{tmp_clear[col_name]}"
-
-            """
-            2. Then add everything relative to resolvers for each 
-            """
-            for resolver_type in self.resolvers: 
-                for resolver_obj in self.resolvers[resolver_type]:
-                    resolver = f"{resolver_type}_{resolver_obj['name']}"
-                    if resolver in self.features_enc:
-                        for time_window in self.features_enc[resolver]: 
-                            tmp_enc = {}
-                            for padding_strat in self.padding_strategies:
-                                try: 
-                                    # trying, because *sometimes* the padding strat is never replayed / bugs in replay 
-                                    # in this case, all the following will be using default/useless values instead of crashing
-                                    tmp_lengths = self.features_enc[resolver][time_window]['length'][padding_strat][:self.max_nb_length]
-                                except: 
-                                    tmp_lengths = []
-
-                                tmp_lengths_up = []
-                                tmp_lengths_down = []
-                                for l in tmp_lengths: 
-                                    if l > 0: 
-                                        tmp_lengths_up.append(l)
-                                    else: 
-                                        tmp_lengths_down.append(l)
-
-                                tmp_enc[f"columns_{padding_strat}_both"] = self.get_csv_columns(
-                                    self.max_nb_length, 
-                                    tmp_lengths, 
-                                    0 # a zero length is an empty message. can't use negative value because downlinks are negative
-                                )
-
-                                tmp_enc[f"columns_{padding_strat}_up"] = self.get_csv_columns(
-                                    self.max_nb_length, 
-                                    tmp_lengths_up, 
-                                    0 # a zero length is an empty message. can't use negative value because downlinks are negative
-                                )
-                                tmp_enc[f"columns_{padding_strat}_down"] = self.get_csv_columns(
-                                    self.max_nb_length, 
-                                    tmp_lengths_down, 
-                                    0 # a zero length is an empty message. can't use negative value because downlinks are negative
-                                )
-
-                                key_str_both = f"stats_{padding_strat}_both"
-                                key_str_up = f"stats_{padding_strat}_up"
-                                key_str_down = f"stats_{padding_strat}_down"
-                                tmp_enc[key_str_both] = ""
-                                tmp_enc[key_str_up] = ""
-                                tmp_enc[key_str_down] = ""
-                                # as we keep `length_multiplier` (2) messages per session,  
-                                # we group them when computing the statistical aggregates
-                                for i in range(self.length_multiplier, self.max_nb_length+1, self.length_multiplier): 
-                                    tmp_enc[key_str_both] += "," + self.get_csv_statistical_aggregates(tmp_lengths[0:i])
-                                    tmp_enc[key_str_up] += "," + self.get_csv_statistical_aggregates(tmp_lengths_up[0:i//2])
-                                    tmp_enc[key_str_down] += "," + self.get_csv_statistical_aggregates(tmp_lengths_down[0:i//2])
-                                
-                                # removing the first comma 
-                                tmp_enc[key_str_both] = tmp_enc[key_str_both][1:]
-                                tmp_enc[key_str_up] = tmp_enc[key_str_up][1:]
-                                tmp_enc[key_str_down] = tmp_enc[key_str_down][1:]
-
-                            for col_name in self.columns_order_enc: 
-                                csv_line = f"{csv_line},{tmp_enc[col_name]}"
-                    else:
-                        logging.error(f"One resolver ({resolver}) is missing! Input file: {self.input_pcap} | Continuing with empty values")
-                        # creating dummy / empty values when the resolver has not been found
-                        for time_window in self.incremental_seconds: 
-                            tmp_enc = {}
-                            for padding_strat in self.padding_strategies:
-                                tmp_lengths = []
-                                tmp_lengths_up = []
-                                tmp_lengths_down = []
-                                tmp_enc[f"columns_{padding_strat}_both"] = self.get_csv_columns(
-                                    self.max_nb_length, 
-                                    tmp_lengths, 
-                                    0 # a zero length is an empty message. can't use negative value because downlinks are negative
-                                )
-
-                                tmp_enc[f"columns_{padding_strat}_up"] = self.get_csv_columns(
-                                    self.max_nb_length, 
-                                    tmp_lengths_up, 
-                                    0 # a zero length is an empty message. can't use negative value because downlinks are negative
-                                )
-                                tmp_enc[f"columns_{padding_strat}_down"] = self.get_csv_columns(
-                                    self.max_nb_length, 
-                                    tmp_lengths_down, 
-                                    0 # a zero length is an empty message. can't use negative value because downlinks are negative
-                                )
-
-                                key_str_both = f"stats_{padding_strat}_both"
-                                key_str_up = f"stats_{padding_strat}_up"
-                                key_str_down = f"stats_{padding_strat}_down"
-                                tmp_enc[key_str_both] = ""
-                                tmp_enc[key_str_up] = ""
-                                tmp_enc[key_str_down] = ""
-                                # as we keep `length_multiplier` (2) messages per session,  
-                                # we group them when computing the statistical aggregates
-                                for i in range(self.length_multiplier, self.max_nb_length+1, self.length_multiplier): 
-                                    tmp_enc[key_str_both] += "," + self.get_csv_statistical_aggregates(tmp_lengths[0:i])
-                                    tmp_enc[key_str_up] += "," + self.get_csv_statistical_aggregates(tmp_lengths_up[0:i//2])
-                                    tmp_enc[key_str_down] += "," + self.get_csv_statistical_aggregates(tmp_lengths_down[0:i//2])
-                                
-                                # removing the first comma 
-                                tmp_enc[key_str_both] = tmp_enc[key_str_both][1:]
-                                tmp_enc[key_str_up] = tmp_enc[key_str_up][1:]
-                                tmp_enc[key_str_down] = tmp_enc[key_str_down][1:]
-                            for col_name in self.columns_order_enc: 
-                                csv_line = f"{csv_line},{tmp_enc[col_name]}"
-        else: 
-            logging.error(f"No feature extracted from (prob. empty file): {self.input_pcap}")
-        
-        logging.debug(f"Number of columns in the CSV line: {len(csv_line.split(','))}")
+        row = self.get_row_from_features()
+        if row is None: 
+            return ""
+        return f"{self.device_name},{format_csv_row(row)}"
 
-        if csv_line == f"{self.device_name}":
+    def get_row_from_features(self) -> np.ndarray: 
+        """
+        Computing the row of features (without the label), in the order of the CSV header 
+        Returns None if no feature was extracted
+        """
+        if len(self.features_enc) == 0: 
+            logging.error(f"No feature extracted from (prob. empty file): {self.input_pcap}")
             with open(self.debug_file, "a") as f:
                 f.write(f"Empty CSV line for: {self.input_pcap}\n")
-            return ""
+            return None
+
+        row = self.row_layout["template"].copy()
+
+        """
+        1. Add the whole IAT stuff once
+        """
+        for time_window in self.features_clear:
+            # NOTE: selecting only up to the max number the variables
+            # do not contain more than what is authorized
+            iat = self.features_clear[time_window]['iat'][:self.max_nb_iat]
+            self.set_row_values(row, "ALL_RESOLVERS", time_window, 'columns_iat', iat)
+            # starting at 0 is useless as it creates an empty list. 
+            self.set_row_values(row, "ALL_RESOLVERS", time_window, 'stats_iat', self.compute_prefix_statistical_aggregates(iat, range(1, self.max_nb_iat+1)))
+
+        """
+        2. Then add everything relative to resolvers for each 
+        """
+        # as we keep `length_multiplier` (2) messages per session,  
+        # we group them when computing the statistical aggregates
+        ends = range(self.length_multiplier, self.max_nb_length+1, self.length_multiplier)
+        ends_one_way = [i//2 for i in ends]
+        for resolver in self.get_resolvers_names(): 
+            if resolver not in self.features_enc:
+                # the default values of the row are used when the resolver has not been found
+                logging.error(f"One resolver ({resolver}) is missing! Input file: {self.input_pcap} | Continuing with empty values")
+                continue
+            for time_window in self.features_enc[resolver]: 
+                for padding_strat in self.padding_strategies:
+                    try: 
+                        # trying, because *sometimes* the padding strat is never replayed / bugs in replay 
+                        # in this case, all the following will be using default/useless values instead of crashing
+                        tmp_lengths = self.features_enc[resolver][time_window]['length'][padding_strat][:self.max_nb_length]
+                    except: 
+                        tmp_lengths = []
+
+                    tmp_lengths_up = [l for l in tmp_lengths if l > 0]
+                    tmp_lengths_down = [l for l in tmp_lengths if l <= 0]
 
-        return csv_line
+                    self.set_row_values(row, resolver, time_window, f"columns_{padding_strat}_both", tmp_lengths)
+                    self.set_row_values(row, resolver, time_window, f"columns_{padding_strat}_up", tmp_lengths_up)
+                    self.set_row_values(row, resolver, time_window, f"columns_{padding_strat}_down", tmp_lengths_down)
+
+                    self.set_row_values(row, resolver, time_window, f"stats_{padding_strat}_both", self.compute_prefix_statistical_aggregates(tmp_lengths, ends))
+                    self.set_row_values(row, resolver, time_window, f"stats_{padding_strat}_up", self.compute_prefix_statistical_aggregates(tmp_lengths_up, ends_one_way))
+                    self.set_row_values(row, resolver, time_window, f"stats_{padding_strat}_down", self.compute_prefix_statistical_aggregates(tmp_lengths_down, ends_one_way))
+
+        logging.debug(f"Number of columns in the CSV line: {len(row)+1}")
+
+        return row
+
+    def extract_batch(self, pairs: list, max_workers: int = None, output_features: str = None): 
+        """
+        Batch mode: extracting the features of multiple (clear, enc) pcap files 
+        with a pool of long-lived processes (imports and resolvers' IPs only done once), 
+        and saving all the CSV lines into self.output_csv 
+        (and into the feature store output_features, if any, see FeatureStore.py)
+
+        The lines are saved in the order of pairs, whatever the order in which the workers finish
+        """
+        conf = {
+            "resolvers": self.resolvers, 
+            "padding_strategies": {p: self.padding_strategies[p]["padding"] for p in self.padding_strategies}, 
+            "max_nb_query": self.max_nb_query, 
+            "length_multiplier": self.length_multiplier, 
+            "device_name": self.device_name, 
+            "tls_parser": self.tls_parser, 
+            "debug_file": self.debug_file, 
+            # already resolved (or set manually) once, here
+            "IPs_to_resolvers": self.IPs_to_resolvers, 
+            "resolvers_IPs": self.resolvers_IPs, 
+            # the rows are only sent back to the main process when they are needed
+            "return_rows": output_features != None, 
+        }
+
+        writer = None
+        if output_features != None: 
+            writer = FeatureStoreWriter(output_features, self.get_csv_header().split(",")[1:]) # removing the 'y'
+
+        logging.debug(f"Batch extraction of {len(pairs)} files ({max_workers} workers)")
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_batch_worker, initargs=(conf,)) as executor: 
+            with open(self.output_csv, self.csv_file_mode) as f:
+                for csv, row in executor.map(extract_csv_line, pairs): 
+                    if csv != "": 
+                        f.write("\n" + csv)
+                        f.write("\n")
+                    if writer != None and row is not None: 
+                        writer.append(row, self.device_name)
+        if writer != None: 
+            writer.close()
 
     def save_csv(self, csv: str): 
         """
@@ -494,64 +609,106 @@ class PcapExtract(PcapHelper):
                 f.write("\n" + csv)
                 f.write("\n")
     
-    def set_dummy_features(self): 
-        """
-        Helper used to generate a fake features dict based on the configuration 
-        instead of parsing a whole pcap file
-        """
-        self.features_clear = self.incremental_seconds.copy()
-
-        for resolver_type in self.resolvers: 
-            for resolver_obj in self.resolvers[resolver_type]: 
-                self.features_enc[f"{resolver_type}_{resolver_obj['name']}"] = self.incremental_seconds.copy()
-
     def get_csv_header(self) -> str: 
         """
-        Generate the CSV header based on the current implementation
+        Generate the CSV header based on the current implementation (see get_row_layout)
         """
-        csv_header = "y"
+        columns = ["y"]
+        for resolver, time_window, col_name, start, stop in self.row_layout["blocks"]: 
+            if "stats" in col_name: 
+                for nb_msg in range(self.max_nb_query): 
+                    for key in self.stats_columns:
+                        columns.append(f"{resolver}-{time_window}-{col_name}-{key}-{nb_msg}")
+            else:
+                for nb_msg in range(stop - start):
+                    columns.append(f"{resolver}-{time_window}-{col_name}-{nb_msg}")
+        csv_header = ",".join(columns)
+        logging.debug(f"Number of columns in the CSV header: {len(columns)}")
+        
+        return csv_header 
 
-        if len(self.features_enc) == 0:
-            self.set_dummy_features()
 
-        resolver_str = ""
-        for time_window in self.features_clear:
-            resolver = "ALL_RESOLVERS"
-            for col_name in self.columns_order_clear: 
-                if "stats" in col_name: 
-                    for nb_msg in range(self.max_nb_query): 
-                        for key in self.stats_columns:
-                            resolver_str = f"{resolver_str},{resolver}-{time_window}-{col_name}-{key}-{nb_msg}"
-                else:
-                    nb = 0 
-                    if "iat" in col_name: 
-                        nb = self.max_nb_iat
-                    else: 
-                        nb = self.max_nb_length
-                    for nb_msg in range(nb):
-                        resolver_str = f"{resolver_str},{resolver}-{time_window}-{col_name}-{nb_msg}"
-        csv_header = f"{csv_header},{resolver_str[1:]}" # removing the first coma
+def init_batch_worker(conf: dict): 
+    """
+    Called once when a worker of the batch process pool starts
+    """
+    global batch_worker_conf
+    batch_worker_conf = conf
+
+
+def extract_csv_line(pair: tuple) -> tuple: 
+    """
+    Extracting the CSV line of one (clear, enc) pair of pcap files, in a worker of the batch process pool
+    Returns the CSV line and the row of features (float32, None if not needed or empty)
+    """
+    input_pcap_clear, input_pcap_enc = pair
+    conf = batch_worker_conf
+    try: 
+        p = PcapExtract(
+            conf["resolvers"], 
+            conf["padding_strategies"], 
+            input_pcap_clear, 
+            input_pcap_enc, 
+            conf["max_nb_query"], 
+            conf["length_multiplier"], 
+            "", 
+            "a", 
+            conf["device_name"], 
+            manual_resolvers_IP=True, 
+            tls_parser=conf["tls_parser"],
+        )
+        p.IPs_to_resolvers = conf["IPs_to_resolvers"]
+        p.resolvers_IPs = conf["resolvers_IPs"]
+        p.debug_file = conf["debug_file"]
 
-        for resolver in self.features_enc: 
-            resolver_str = ""
-            for time_window in self.features_enc[resolver]: 
-                for col_name in self.columns_order_enc: 
-                    if "stats" in col_name: 
-                        for nb_msg in range(self.max_nb_query): 
-                            for key in self.stats_columns:
-                                resolver_str = f"{resolver_str},{resolver}-{time_window}-{col_name}-{key}-{nb_msg}"
-                    else:
-                        nb = 0 
-                        if "iat" in col_name: 
-                            nb = self.max_nb_iat
-                        else: 
-                            nb = self.max_nb_length
-                        for nb_msg in range(nb):
-                            resolver_str = f"{resolver_str},{resolver}-{time_window}-{col_name}-{nb_msg}"
-            csv_header = f"{csv_header},{resolver_str[1:]}" # removing the first coma
-        logging.debug(f"Number of columns in the CSV header: {len(csv_header.split(','))}")
-        
-        return csv_header 
+        p.extract_features_clear()
+        p.extract_features_enc()
+        row = p.get_row_from_features()
+        if row is None: 
+            return "", None
+        csv = f"{p.device_name},{format_csv_row(row)}"
+        if not conf["return_rows"]: 
+            return csv, None
+        return csv, row.astype(np.float32)
+    except Exception as e: 
+        # one broken file should not stop the whole batch (same as when it was one process per file)
+        logging.error(f"Extraction failed for: {input_pcap_enc} ({repr(e)})")
+        if conf["debug_file"] != None: 
+            with open(conf["debug_file"], "a") as f:
+                f.write(f"Extraction failed for: {input_pcap_enc} ({repr(e)})\n")
+        return "", None
+
+
+def get_batch_pairs(input_dir_clear: str, input_dir_enc: str) -> list: 
+    """
+    Pairs each replayed (encrypted) file with the clear-text file of the same name, sorted by filename
+    """
+    pairs = []
+    for filename in sorted(os.listdir(input_dir_enc)): 
+        input_pcap_enc = os.path.join(input_dir_enc, filename)
+        input_pcap_clear = os.path.join(input_dir_clear, filename)
+        if not os.path.isfile(input_pcap_clear): 
+            logging.error(f"No clear-text file for: {input_pcap_enc} (skipping)")
+            continue
+        pairs.append((input_pcap_clear, input_pcap_enc))
+    return pairs
+
+
+def get_glob_pairs(input_glob_clear: str, input_glob_enc: str) -> list: 
+    """
+    Same as get_batch_pairs, with the files matching two glob patterns (eg: "data/dns_only/<device>/*/*")
+    """
+    files_clear = {}
+    for input_pcap_clear in glob(input_glob_clear): 
+        files_clear[os.path.basename(input_pcap_clear)] = input_pcap_clear
+    pairs = []
+    for input_pcap_enc in sorted(glob(input_glob_enc), key=os.path.basename): 
+        filename = os.path.basename(input_pcap_enc)
+        if filename not in files_clear: 
+            logging.error(f"No clear-text file for: {input_pcap_enc} (skipping)")
+            continue
+        pairs.append((files_clear[filename], input_pcap_enc))
+    return pairs
 
 
 if __name__ == "__main__":
@@ -565,6 +722,13 @@ if __name__ == "__main__":
     parser.add_argument('--csv_file_mode', '-cm', help='The mode to write into the CSV file (default: append)', default="a")
     parser.add_argument('--device_name', '-d', help="The device's name (used as label in CSV)", default="generic_device_name")
     parser.add_argument('--debug_file', '-df', help="Sometimes, the console logs are not clear enough")
+    parser.add_argument('--input_dir_clear', '-idc', help='Batch mode: directory of the DNS only input pcap files (same filenames as in --input_dir_enc)')
+    parser.add_argument('--input_dir_enc', '-ide', help='Batch mode: directory of the replayed (encrypted) input pcap files')
+    parser.add_argument('--manifest', '-mf', help='Batch mode: JSON file containing a list of [clear, enc] pcap files')
+    parser.add_argument('--output_features', '-of', help='Batch mode: also save the features into a feature store (directory ending with .features, see FeatureStore.py)')
+    parser.add_argument('--max_workers', '-w', help='Batch mode: number of worker processes (default: number of CPUs)', type=int)
+    parser.add_argument('--manual_resolvers_IP', '-mr', help="Use the hardcoded IPs of the resolvers instead of resolving them", action=argparse.BooleanOptionalAction)
+    parser.add_argument('--resolvers_cache', '-rca', help="Use the IPs of the resolvers saved at replay time (JSON file of the run, see ResolversCache)")
 
     args = parser.parse_args()
     resolvers_config = read_conf(args.resolvers_config)
@@ -579,7 +743,8 @@ if __name__ == "__main__":
         args.output_csv, 
         args.csv_file_mode, 
         args.device_name, 
-        # manual_resolvers_IP = True
+        manual_resolvers_IP=args.manual_resolvers_IP == True,
+        resolvers_cache=args.resolvers_cache,
     )
     
     p.debug_file = args.debug_file
@@ -588,6 +753,12 @@ if __name__ == "__main__":
         with open(args.output_csv, 'w') as f:
             csv = p.get_csv_header()
             f.write(csv + "\n")
+    elif args.manifest != None: 
+        p.extract_batch([tuple(pair) for pair in read_conf(args.manifest)], args.max_workers, args.output_features)
+    elif args.input_dir_enc != None: 
+        if args.input_dir_clear == None: 
+            parser.error("--input_dir_clear is required with --input_dir_enc")
+        p.extract_batch(get_batch_pairs(args.input_dir_clear, args.input_dir_enc), args.max_workers, args.output_features)
     else: 
         p.extract_features_clear()
         p.extract_features_enc()
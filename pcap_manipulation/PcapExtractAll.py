@@ -28,6 +28,45 @@ bind_layers(TCP, TLS, dport=853)
 from utils import *
 from PcapHelper import *
 
+# Class of each device (the ones not listed are "Appliance")
+DEVICE_CLASSES = {
+    "alexa_swan_kettle": "Appliance",
+    "aqara_hubM2": "Hub",
+    "arlo_camera_pro4": "Camera",
+    "blink_mini_camera": "Camera",
+    "boifun_baby": "Baby Monitor",
+    "bose_speaker": "Speaker",
+    "coffee_maker_lavazza": "Appliance",
+    "cosori_air_fryer": "Appliance",
+    "echodot4": "Speaker",
+    "echodot5": "Speaker",
+    "eufy_chime": "Doorbell",
+    "furbo_dog_camera": "Pet",
+    "google_nest_doorbell": "Doorbell",
+    "google_nest_hub": "Hub",
+    "govee_strip_light": "Light",
+    "homepod": "Speaker",
+    "lepro_light": "Light",
+    "lifx_mini": "Light",
+    "meross_garage_door": "Appliance",
+    "nanoleaf_triangles": "Light",
+    "nest_cam": "Camera",
+    "netatmo_weather_station": "Sensor",
+    "petsafe_feeder": "Pet",
+    "reolink_doorbell": "Doorbell",
+    "ring_chime_pro": "Doorbell",
+    "sensibo_sky_sensor": "Sensor",
+    "simplicam": "Camera",
+    "sonos_speaker": "Speaker",
+    "tapo_plug110_38": "Plug",
+    "vtech_baby_camera": "Baby Monitor",
+    "withings_sleep_analyser": "Medical",
+    "wiz_smart_bulb": "Light",
+    "wyze_cam_pan_v2": "Camera",
+    "yeelight_bulb": "Light"
+}
+
+
 class PcapExtractAll(PcapHelper):
     def __init__(self,
         resolvers: dict, 
@@ -38,24 +77,19 @@ class PcapExtractAll(PcapHelper):
         output_csv: str, 
         csv_file_mode: str, 
         device_name: str, 
-        manual_resolvers_IP: bool = False
+        manual_resolvers_IP: bool = False,
+        resolvers_cache: str = None
     ):
         PcapHelper.__init__(self, resolvers, padding_strategies, clear_input_pcap)  
-                        
-               
-        for ip in self.IPs_to_resolvers.keys(): 
-            self.resolvers_IPs.append(ip)
 
         # a list of the IPs used by all the resolvers
-        if not manual_resolvers_IP: 
+        # (resolvers_cache: the IPs saved at replay time, see ResolversCache)
+        if resolvers_cache != None: 
+            self.set_resolvers_IPs(ResolversCache(resolvers_cache, read_only=True))
+        elif not manual_resolvers_IP: 
             self.set_resolvers_IPs()
-            self.resolvers_IPs = self.resolvers_IPs
         else: 
-            # Manually setting the IPs here to avoid DDOS'ing the resolver in the loop :) 
-            self.IPs_to_resolvers = {'1.1.1.1': 'Cloudflare', '8.8.8.8': 'Google', '9.9.9.9': 'Quad9', '149.112.112.112': 'Quad9', '185.228.168.10': 'CleanBrowsing', '185.228.168.168': 'CleanBrowsing', '37.252.225.79': 'NextDNS', '185.10.16.125': 'NextDNS', '94.140.14.140': 'AdGuard', '94.140.14.141': 'AdGuard', '185.228.168.9': 'CleanBrowsing'}
-            self.resolvers_IPs = []     
-            for ip in self.IPs_to_resolvers.keys(): 
-                self.resolvers_IPs.append(ip)
+            self.set_legacy_resolvers_IPs()
 
         self.max_nb_query = max_nb_query
         self.max_nb_length = self.max_nb_query*length_multiplier
@@ -67,44 +101,9 @@ class PcapExtractAll(PcapHelper):
         self.csv_file_mode = csv_file_mode
         self.device_name = device_name
 
-        self.device_classes = {
-            "alexa_swan_kettle": "Appliance",
-            "aqara_hubM2": "Hub",
-            "arlo_camera_pro4": "Camera",
-            "blink_mini_camera": "Camera",
-            "boifun_baby": "Baby Monitor",
-            "bose_speaker": "Speaker",
-            "coffee_maker_lavazza": "Appliance",
-            "cosori_air_fryer": "Appliance",
-            "echodot4": "Speaker",
-            "echodot5": "Speaker",
-            "eufy_chime": "Doorbell",
-            "furbo_dog_camera": "Pet",
-            "google_nest_doorbell": "Doorbell",
-            "google_nest_hub": "Hub",
-            "govee_strip_light": "Light",
-            "homepod": "Speaker",
-            "lepro_light": "Light",
-            "lifx_mini": "Light",
-            "meross_garage_door": "Appliance",
-            "nanoleaf_triangles": "Light",
-            "nest_cam": "Camera",
-            "netatmo_weather_station": "Sensor",
-            "petsafe_feeder": "Pet",
-            "reolink_doorbell": "Doorbell",
-            "ring_chime_pro": "Doorbell",
-            "sensibo_sky_sensor": "Sensor",
-            "simplicam": "Camera",
-            "sonos_speaker": "Speaker",
-            "tapo_plug110_38": "Plug",
-            "vtech_baby_camera": "Baby Monitor",
-            "withings_sleep_analyser": "Medical",
-            "wiz_smart_bulb": "Light",
-            "wyze_cam_pan_v2": "Camera",
-            "yeelight_bulb": "Light"
-        }
+        self.device_classes = DEVICE_CLASSES
 
-        # if you modify these, also change scripts/raw_features_analysis.py
+        # if you modify these, also change scripts/raw_features_analysis.py (and RecordsSink in ExtractSinks.py)
         self.features = {
             "device_name": [],
             "device_class": [],
@@ -185,6 +184,8 @@ if __name__ == "__main__":
     parser.add_argument('--csv_file_mode', '-cm', help='The mode to write into the CSV file (default: append)', default="a")
     parser.add_argument('--device_name', '-d', help="The device's name (used as label in CSV)", default="generic_device_name")
     parser.add_argument('--debug_file', '-df', help="Sometimes, the console logs are not clear enough")
+    parser.add_argument('--manual_resolvers_IP', '-mr', help="Use the hardcoded IPs of the resolvers instead of resolving them", action=argparse.BooleanOptionalAction)
+    parser.add_argument('--resolvers_cache', '-rca', help="Use the IPs of the resolvers saved at replay time (JSON file of the run, see ResolversCache)")
 
     args = parser.parse_args()
     resolvers_config = read_conf(args.resolvers_config)
@@ -197,7 +198,9 @@ if __name__ == "__main__":
         extract_config["length_multiplier"],
         args.output_csv, 
         args.csv_file_mode, 
-        args.device_name
+        args.device_name, 
+        manual_resolvers_IP=args.manual_resolvers_IP == True,
+        resolvers_cache=args.resolvers_cache
     )
     
     p.debug_file = args.debug_file
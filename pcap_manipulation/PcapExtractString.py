@@ -10,10 +10,12 @@ logging.basicConfig(
     stream=sys.stdout
 )
 
+import os
 import json
 import glob
 import argparse 
 import binascii
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np 
 import scipy as sc
@@ -22,6 +24,8 @@ import dpkt
 
 from utils import *
 from PcapHelper import *
+from QnameIndex import *
+from QnameStore import *
 
 class PcapExtractString(object):
     def __init__(self,
@@ -44,15 +48,11 @@ class PcapExtractString(object):
         # - complete: abc.0.pool.ntp.org
         # - 4: 0.pool.ntp.org
         # - 3: pool.ntp.org
+        # (any number of labels can be used as a qname type, see QnameIndex.get_view)
         self.qname_types = qname_types
-        self.dns = {}
-        for qt in self.qname_types: 
-            self.dns[qt] = {
-                "unique": set(),
-                "indexes": {}, 
-                "empty_line": []
-            }
-        self.devices_data = {}
+        self.qname_types_nb_labels = {qt: None if qt == "complete" else int(qt) for qt in self.qname_types}
+        # vocabulary IDs given on the fly, rows kept as sparse IDs (see QnameStore.py)
+        self.encoder = QnameEncoder(self.qname_types)
     
     @property
     def mac_address(self):
@@ -97,125 +97,136 @@ class PcapExtractString(object):
 
     def loop_through(self): 
         for pcap_file in self.pcap_files:
-            self.read_pcap(pcap_file)
-            # extract the name of the current device 
-            # ./data/dns_only/<device_name>/*.pcap
-            tmp_s = pcap_file.split("/")
-            current_device = tmp_s[tmp_s.index('dns_only')+1]
-
-            if current_device not in self.mac_addresses: 
-                logging.error(f"Unknown device -> mac_address ({current_device})")
-                raise ValueError
-            
-            self.mac_address = self.mac_addresses[current_device]
-
-            if current_device not in self.devices_data: 
-                self.devices_data[current_device] = []
-
-            self.deal_with_packets(current_device)
-
-        for qt in self.qname_types: 
-            logging.info(f"Number of unique DNS qname ({qt}) {len(self.dns[qt]['unique'])}")
-        
-        for qt in self.qname_types: 
-            self.set_index_qnames(qt)
-            self.set_empty_line(qt)
+            self.deal_with_file(pcap_file)
+        self.log_vocabulary()
 
-    def set_index_qnames(self, qname_type: str): 
+    def loop_through_parallel(self, max_workers: int = None, shard_size: int = None): 
         """
-        Create a hash table with an index corresponding to the place of a qname in the CSV line 
-
+        Same as loop_through (same vocabulary, same rows), with a pool of processes (map-reduce): 
+        - map: each worker encodes a shard (consecutive files) with its own vocabulary (see extract_qnames_shard)
+        - reduce: the vocabularies are merged in the order of the shards, the rows are appended with the merged IDs
         """
-        i = 0 
-        for d in sorted(self.dns[qname_type]['unique']): 
-            self.dns[qname_type]['indexes'][d] = i
-            i += 1
-
-    def set_empty_line(self, qname_type: str): 
-        for d in sorted(self.dns[qname_type]['unique']): 
-            self.dns[qname_type]['empty_line'].append(0)
+        if max_workers == None: 
+            max_workers = os.cpu_count()
+        if shard_size == None: 
+            # a few shards per worker, so they are all busy until the end
+            shard_size = max(1, -(-len(self.pcap_files) // (max_workers * 8)))
+        shards = [self.pcap_files[i:i+shard_size] for i in range(0, len(self.pcap_files), shard_size)]
+
+        conf = {
+            "max_nb_query": self.max_nb_query, 
+            "mac_addresses": self.mac_addresses, 
+            "qname_types": self.qname_types, 
+        }
+        logging.debug(f"Parallel extraction of {len(self.pcap_files)} files ({len(shards)} shards, {max_workers} workers)")
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_shard_worker, initargs=(conf,)) as executor: 
+            for encoder in executor.map(extract_qnames_shard, shards): 
+                self.encoder.merge(encoder)
+        self.log_vocabulary()
+
+    def log_vocabulary(self): 
+        for qt in self.qname_types: 
+            logging.info(f"Number of unique DNS qname ({qt}) {len(self.encoder.vocabulary[qt])}")
+
+    def deal_with_file(self, pcap_file: str): 
+        self.read_pcap(pcap_file)
+        # extract the name of the current device 
+        # ./data/dns_only/<device_name>/*.pcap
+        tmp_s = pcap_file.split("/")
+        current_device = tmp_s[tmp_s.index('dns_only')+1]
+
+        if current_device not in self.mac_addresses: 
+            logging.error(f"Unknown device -> mac_address ({current_device})")
+            raise ValueError
+        
+        self.mac_address = self.mac_addresses[current_device]
 
+        self.deal_with_packets(current_device)
 
     def deal_with_packets(self, current_device: str): 
         """
         Detect DNS queries and save their qname 
         """
-        qname_list_complete = []
-        qname_list_4 = []
-        qname_list_3 = []
+        index = self.encoder.index
+        # the complete qnames, as nodes of the index
+        nodes = []
         try: 
             for ts, buf in self.packets: 
-                eth = dpkt.ethernet.Ethernet(buf)
-                # only replaying relevant packets
-                if eth.src == self.mac_address: 
-                    if isinstance(eth.data, dpkt.ip.IP):
-                        ip = eth.data
-                        
-                        if type(ip.data) == dpkt.udp.UDP:
-                            udp = ip.data
-                            try:
-                                d = dpkt.dns.DNS(udp.data)
-                            except:
-                                pass 
-                            else:
-                                # https://dpkt.readthedocs.io/en/latest/_modules/dpkt/dns.html
-                                if d.opcode == dpkt.dns.DNS_QUERY: 
-                                    qname = d.qd[0].name
-
-                                    logging.debug(f"[-] Complete qname: {qname}")
-                                    # Only keeping the 2nd level 
-                                    # 0.pool.ntp.org -> pool.ntp.org
-                                    qname = qname.lower()
-                                    qname_4 = '.'.join(qname.split(".")[-4:])
-                                    qname_3 = '.'.join(qname.split(".")[-3:])
-
-                                    logging.debug(f"[-] Converted to: {qname} | {qname_4} | {qname_3}")
-
-                                    self.dns['complete']['unique'].add(qname) 
-                                    self.dns['4']['unique'].add(qname_4) 
-                                    self.dns['3']['unique'].add(qname_3) 
-
-                                    qname_list_complete.append(qname)
-                                    qname_list_4.append(qname_4)
-                                    qname_list_3.append(qname_3)
+                # (not dissecting the frames of the other devices)
+                if len(buf) >= 14 and buf[6:12] != self.mac_address: 
+                    continue
+                if len(buf) >= 14 and buf[12:14] == ETH_TYPE_IPV4: 
+                    udp_data = get_udp_payload(buf[14:])
+                else: 
+                    # (eg: VLAN tags)
+                    udp_data = None
+                    eth = dpkt.ethernet.Ethernet(buf)
+                    if eth.src == self.mac_address and isinstance(eth.data, dpkt.ip.IP) and type(eth.data.data) == dpkt.udp.UDP: 
+                        udp_data = eth.data.data.data
+                if udp_data == None: 
+                    continue
+                try:
+                    d = dpkt.dns.DNS(udp_data)
+                except:
+                    pass 
+                else:
+                    # https://dpkt.readthedocs.io/en/latest/_modules/dpkt/dns.html
+                    if d.opcode == dpkt.dns.DNS_QUERY: 
+                        qname = d.qd[0].name
+                        logging.debug(f"[-] Complete qname: {qname}")
+                        # lowercased and split once per distinct qname
+                        nodes.append(index.get_id(qname))
         except dpkt.dpkt.NeedData:
             # if the pcap file is not complete, need to ignore the exception else it crashes
             # for eg, this happens with: ./data/raw/boifun_baby/ctrl/2023-08-18_17.26.34_10.12.0.40.pcap
             pass
 
-        if len(qname_list_complete) != 0: 
-            self.devices_data[current_device].append({
-                "complete": qname_list_complete[:self.max_nb_query], 
-                "4": qname_list_4[:self.max_nb_query],
-                "3": qname_list_3[:self.max_nb_query],
-            })
+        # Only keeping the last labels 
+        # 0.pool.ntp.org -> pool.ntp.org
+        qnames = {}
+        for qt in self.qname_types: 
+            qnames[qt] = [index.get_view(node, self.qname_types_nb_labels[qt]) for node in nodes]
+        # all the qnames are in the vocabulary, even the ones after max_nb_query
+        for qt in self.qname_types: 
+            self.encoder.add_qnames(qt, qnames[qt][self.max_nb_query:])
+        if len(nodes) != 0: 
+            self.encoder.append(current_device, {qt: qnames[qt][:self.max_nb_query] for qt in self.qname_types})
 
 
     def get_csv_data(self):
         """
         For each device, go through their list of dns queries 
-        for each dns query, use the index helper to put a 1 and only 0 elsewhere
+        for each dns query, put a 1 at the place of the qname in the (sorted) header and only 0 elsewhere
         """
+        # ID of a qname -> its place in the CSV line
+        places = {}
+        rows = {}
+        for qt in self.qname_types: 
+            names = self.encoder.get_names(qt)
+            places[qt] = [0] * len(names)
+            for i, qname_id in enumerate(sorted(range(len(names)), key=names.__getitem__)): 
+                places[qt][qname_id] = i
+            rows[qt] = list(self.encoder.get_rows(qt))
+
+        labels = self.encoder.get_new_labels()
+        # the lines of a device are grouped (devices in the order they were first seen)
+        devices = {device: i for i, device in enumerate(dict.fromkeys(labels))}
+        order = sorted(range(len(labels)), key=lambda i: devices[labels[i]])
+
         all_lines = []
-        total = 0
-
-        for device_name, qnames_types in self.devices_data.items(): 
-            for i in range(len(self.devices_data[device_name])):
-                line = f"{device_name}"
-                for qname_t, qnames in self.devices_data[device_name][i].items(): 
-                    list_line = self.dns[qname_t]['empty_line'].copy()
-
-                    for qname in qnames:  
-                        index = self.dns[qname_t]['indexes'][qname]
-                        list_line[index] = 1
-                    # print("list_line", list_line)
-                    line += ","
-                    line += ','.join(str(x) for x in list_line)
-                all_lines.append(line)
+        for i in order: 
+            line = f"{labels[i]}"
+            for qt in self.qname_types: 
+                list_line = ["0"] * len(places[qt])
+                for qname_id in rows[qt][i]: 
+                    list_line[places[qt][qname_id]] = "1"
+                line += ","
+                line += ','.join(list_line)
+            all_lines.append(line)
         return all_lines
 
     def add_dns_to_header(self, header: str, qname_type): 
-        for d in sorted(self.dns[qname_type]['indexes']): 
+        for d in sorted(self.encoder.get_names(qname_type)): 
             header += f",{d}"
         return header 
 
@@ -241,12 +252,54 @@ class PcapExtractString(object):
     def update_extract_config(self, init_config, config_file): 
         logging.debug(f"Updating config file: {config_file}")
         for qt in self.qname_types: 
-                init_config["qname_types"][qt] = len(self.dns[qt]['unique'])
+                init_config["qname_types"][qt] = len(self.encoder.vocabulary[qt])
 
         with open(config_file, "w") as f: 
             json.dump(init_config, f, indent=2)   
 
 
+ETH_TYPE_IPV4 = b'\x08\x00'
+
+
+def get_udp_payload(ip: bytes) -> bytes: 
+    """
+    Payload of an IPv4/UDP packet, None for any other packet 
+    Reading the headers directly instead of dissecting the whole frame with dpkt (same result as dpkt)
+    """
+    if len(ip) < 20 or ip[9] != dpkt.ip.IP_PROTO_UDP: 
+        return None
+    header_length = (ip[0] & 0xf) << 2
+    if header_length < 20: 
+        return None
+    # (dpkt does not dissect fragments, except the first one)
+    if (ip[6] & 0x1f) << 8 | ip[7] != 0: 
+        return None
+    total_length = ip[2] << 8 | ip[3]
+    # total_length is 0 with TCP segmentation offload
+    udp = ip[header_length:total_length] if total_length else ip[header_length:]
+    if len(udp) < 8: 
+        return None
+    return udp[8:]
+
+
+def init_shard_worker(conf: dict): 
+    """
+    Called once when a worker of the process pool starts (see loop_through_parallel)
+    """
+    global shard_worker
+    shard_worker = PcapExtractString(None, conf["max_nb_query"], None, conf["mac_addresses"], conf["qname_types"], None, None)
+
+
+def extract_qnames_shard(pcap_files: list) -> QnameEncoder: 
+    """
+    Encoding the qnames of a shard of files, in a worker of the process pool, with a new vocabulary
+    """
+    shard_worker.encoder = QnameEncoder(shard_worker.qname_types)
+    for pcap_file in pcap_files: 
+        shard_worker.deal_with_file(pcap_file)
+    return shard_worker.encoder
+
+
 def read_bash_conf(filename): 
     mac_addresses = {}
     with open(filename) as f: 
@@ -265,6 +318,9 @@ if __name__ == "__main__":
     parser.add_argument('--output_csv', '-o', help='Path of the output CSV file containing the ML data')
     parser.add_argument('--save_header', '-sh', help='Save the header (and only the header) in the CSV file', action=argparse.BooleanOptionalAction)
     parser.add_argument('--csv_file_mode', '-cm', help='The mode to write into the CSV file (default: append)', default="a")
+    parser.add_argument('--output_sparse', '-os', help='Also save the one-hot encoded qnames as sparse matrices (directory ending with .dns_str, see QnameStore.py)')
+    parser.add_argument('--max_workers', '-w', help='Extract the files with a pool of processes (default: one process, 0: number of CPUs)', type=int)
+    parser.add_argument('--append', '-ap', help='Append the rows to the existing --output_sparse, keeping its vocabulary (eg: a new run)', action=argparse.BooleanOptionalAction, default=False)
 
     args = parser.parse_args()
     extract_config = read_conf(args.extract_config)
@@ -284,7 +340,17 @@ if __name__ == "__main__":
         with open(args.output_csv, 'w') as f:
             f.write(p.get_csv_header())
     else: 
+        if args.output_sparse != None and not is_qname_store(args.output_sparse): 
+            parser.error(f"--output_sparse must end with {QNAME_STORE_EXTENSION}")
+        if args.append and args.output_sparse != None and os.path.isdir(args.output_sparse): 
+            p.encoder.load(args.output_sparse)
         p.get_all_files()
-        p.loop_through()
-        p.save_csv(p.get_csv_header(), p.get_csv_data())
+        if args.max_workers != None: 
+            p.loop_through_parallel(args.max_workers if args.max_workers > 0 else None)
+        else: 
+            p.loop_through()
+        if args.output_csv != None: 
+            p.save_csv(p.get_csv_header(), p.get_csv_data())
+        if args.output_sparse != None: 
+            p.encoder.save(args.output_sparse)
         p.update_extract_config(extract_config, args.extract_config)
\ No newline at end of file
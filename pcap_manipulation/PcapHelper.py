@@ -9,9 +9,15 @@ logging.basicConfig(
 
 import json
 import socket
+import struct
 from re import findall
+from collections import namedtuple
 
-import dns.resolver
+
+from ResolversCache import *
+
+# using dpkt instead of Scapy for performance
+import dpkt
 
 from scapy.all import *
 load_layer("tls")
@@ -19,6 +25,43 @@ load_layer("tls")
 bind_layers(TCP, TLS, sport=853) 
 bind_layers(TCP, TLS, dport=853)
 
+# Lightweight view of an IPv4 TCP/UDP frame (see PcapHelper.stream_pcap)
+# - ts: epoch time (float)
+# - src/dst: IPv4 addresses as strings (same format as in self.resolvers_IPs)
+# - proto: IP protocol number (6: TCP, 17: UDP)
+# - seq: TCP sequence number (None for UDP)
+# - payload: memoryview on the transport payload of the original frame (no copy)
+PacketRecord = namedtuple("PacketRecord", ["ts", "src", "dst", "proto", "sport", "dport", "seq", "payload"])
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+# Fields of a DNS message used by PcapExtractAll (see PcapHelper.get_dns_message)
+# - length: length of the DNS layer (with the length prefix for DNS over TCP)
+# - qtype: type of the first question
+# - ancount: number of answers
+# - has_rr: a record of the message would be dissected as DNSRR by Scapy (the "DNSRR in pkt" test)
+DnsMessage = namedtuple("DnsMessage", ["length", "qtype", "ancount", "has_rr"])
+
+# Types of the records dissected by Scapy with their own class instead of DNSRR 
+# (SOA, MX, SRV, OPT, DS, RRSIG, NSEC, DNSKEY, NSEC3, NSEC3PARAM, TSIG, DLV: scapy.layers.dns.DNSRR_DISPATCHER)
+SCAPY_NOT_DNSRR_TYPES = (6, 15, 33, 41, 43, 46, 47, 48, 50, 51, 250, 32769)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = 0x8100
+DLT_RAW_VALUES = (12, 14, 101) # raw IP, depending on the platform/file format
+
+PROTO_ICMP = 1
+PROTO_ICMPV6 = 58
+# ICMP errors quoting the packet that caused them (dissected as IPerror/UDPerror... by Scapy)
+ICMP_ERROR_TYPES = (3, 4, 5, 11, 12)
+ICMPV6_ERROR_TYPES = (1, 2, 3, 4)
+
+# Manually set IPs of the resolvers, used to avoid DDOS'ing the resolvers when extracting in a loop :) 
+# (before the resolvers cache, see ResolversCache: only for data replayed without one)
+LEGACY_IPS_TO_RESOLVERS = {'1.1.1.1': 'Cloudflare', '8.8.8.8': 'Google', '9.9.9.9': 'Quad9', '149.112.112.112': 'Quad9', '185.228.168.10': 'CleanBrowsing', '185.228.168.168': 'CleanBrowsing', '37.252.225.79': 'NextDNS', '185.10.16.125': 'NextDNS', '94.140.14.140': 'AdGuard', '94.140.14.141': 'AdGuard', '185.228.168.9': 'CleanBrowsing'}
+
 
 class PcapHelper(object):
     def __init__(self, resolvers: dict, padding_strategies: dict, input_pcap: str): 
@@ -43,11 +86,15 @@ class PcapHelper(object):
             ]
             i += 1
 
-        try: 
-            self.device_ipv4 = findall(r'(?:\d{1,3}\.)+(?:\d{1,3})', self.input_pcap)[-1]
-        except: 
-            logging.error("No IPv4 in filename (to detect a specific device)") # possibly: exit?
+        if self.input_pcap == None: 
+            # no file (yet), eg: the parent of the workers in batch mode
             self.device_ipv4 = "127.0.0.1"
+        else: 
+            try: 
+                self.device_ipv4 = findall(r'(?:\d{1,3}\.)+(?:\d{1,3})', self.input_pcap)[-1]
+            except: 
+                logging.error("No IPv4 in filename (to detect a specific device)") # possibly: exit?
+                self.device_ipv4 = "127.0.0.1"
 
         self.resolvers_IPs = []
         # a IP -> resolver name hash table to avoid looking for the name every time we have an IP
@@ -69,20 +116,38 @@ class PcapHelper(object):
             self.columns_order_enc.append(f"stats_{padding_strat}_up")
             self.columns_order_enc.append(f"stats_{padding_strat}_down")
     
-    def set_resolvers_IPs(self): 
+    def set_resolvers_IPs(self, resolvers_cache: ResolversCache = None): 
         """
         When possible, we use the IP of the resolver. But sometimes, resolver only give us
         an URI (eg: https://doh.cleanbrowsing.org/doh/security-filter/)
         We need the IP for BP filters, and the URI for HTTP/TLS request.
+
+        With a resolvers_cache (see ResolversCache), the IPs are the ones saved at replay time
+        (read only and no cache file: the run was replayed before the resolvers cache, using the hardcoded IPs)
         """
+        if resolvers_cache != None and resolvers_cache.read_only and resolvers_cache.missing: 
+            self.set_legacy_resolvers_IPs()
+            return
         for resolver_type in self.resolvers: 
             for i in range(len(self.resolvers[resolver_type])): 
                 r = self.resolvers[resolver_type][i]
                 if 'ips' not in r or len(r['ips']) == 0: 
-                    r['ips'] = self.get_ips_from_resolver(r['endpoint'])
-                    self.resolvers_IPs += r['ips']
-                    for ip in r['ips']: 
-                        self.IPs_to_resolvers[ip] = r['name']
+                    if resolvers_cache != None: 
+                        r['ips'] = resolvers_cache.get_ips(r['endpoint'])
+                    else: 
+                        r['ips'] = self.get_ips_from_resolver(r['endpoint'])
+                # (the resolvers dict can be shared, eg: the IPs were set by a previous instance)
+                for ip in r['ips']: 
+                    if ip not in self.IPs_to_resolvers: 
+                        self.resolvers_IPs.append(ip)
+                    self.IPs_to_resolvers[ip] = r['name']
+
+    def set_legacy_resolvers_IPs(self): 
+        """
+        The IPs of the resolvers when the data was first collected (no resolvers cache at the time)
+        """
+        self.IPs_to_resolvers = dict(LEGACY_IPS_TO_RESOLVERS)
+        self.resolvers_IPs = list(self.IPs_to_resolvers.keys())
 
     def get_ips_from_resolver(self, endpoint: str) -> str:
         """
@@ -90,21 +155,14 @@ class PcapHelper(object):
         For example, CleanBrowsing uses 185.228.168.10 and 185.228.168.168.
         We don't want to miss any of the packets so all IPs must be used in the BPF.
         """
-        try:
-            # if the endpoint is already an IP address, no need to do much
-            socket.inet_aton(endpoint)
-            ips = [endpoint]
-        except socket.error:
-            endpoint = endpoint.replace('https://', '')
-            endpoint = endpoint.split('/')[0] 
-            records = dns.resolver.resolve(endpoint, 'a')
-            ips = [i.to_text() for i in records]
+        ips, _ = resolve_endpoint(endpoint)
         logging.debug(f"[-] get_ips_from_resolver {endpoint} -> {ips}")
         return ips
 
     def read_pcap(self): 
         """
         Loading all frames in memory at once, *using Scapy* 
+        (prefer stream_pcap when the Scapy dissection is not needed)
         """
         start = time.time()
         logging.debug("[-] Reading pcap")
@@ -115,6 +173,241 @@ class PcapHelper(object):
             # if the pcap file is empty, ignoring
             self.packets = []
         
+    def open_pcap_reader(self, pcap_file: str):
+        """
+        Returns a dpkt reader (pcapng, or pcap as a fallback) and the underlying file 
+        """
+        try: 
+            file = open(pcap_file,'rb')
+            return dpkt.pcapng.Reader(file), file
+        except (ValueError, dpkt.dpkt.NeedData):
+            file.close()
+            # *some* unidentified files may not use the pcapng format
+            # reverting to pcap in these cases 
+            # NOTE: getting the file pointer locally each time because pcapng.Reader 
+            # reads *some* of the buffer before crashing, thus screwing up the
+            # following call of pcap.Reader (misaligned file pointer) 
+            try: 
+                file = open(pcap_file,'rb')
+                return dpkt.pcap.Reader(file), file
+            except (ValueError, dpkt.dpkt.NeedData):
+                # empty file, or not a capture at all: ignoring
+                file.close()
+                return None, None
+
+    def stream_pcap(self, pcap_file: str = None):
+        """
+        Lazily yields the IPv4 TCP/UDP frames of a pcap file as PacketRecord, *using dpkt*
+
+        Contrary to read_pcap, nothing is kept in memory: the frames are read one at a time
+        and only the headers we actually use are decoded (no Scapy object tree)
+        """
+        for ts, buf, linktype in self.stream_frames(pcap_file): 
+            record = self.get_packet_record(ts, buf, linktype)
+            if record != None: 
+                yield record
+
+    def stream_frames(self, pcap_file: str = None):
+        """
+        Lazily yields the raw frames of a pcap file: (epoch time, memoryview on the frame, link type)
+        (see get_packet_record and get_dns_record to decode them)
+        """
+        if pcap_file == None: 
+            pcap_file = self.input_pcap
+        reader, file = self.open_pcap_reader(pcap_file)
+        if reader == None: 
+            return
+
+        with file:
+            linktype = reader.datalink()
+            try: 
+                for ts, buf in reader: 
+                    yield ts, memoryview(buf), linktype
+            except dpkt.dpkt.NeedData:
+                # if the pcap file is not complete, need to ignore the exception else it crashes
+                pass 
+
+    def get_packet_record(self, ts: float, buf: memoryview, linktype: int):
+        """
+        Decodes the Ethernet/IPv4/(TCP|UDP) headers of a raw frame by hand
+        Returns None for anything else (ARP, IPv6, ICMP, non-first IP fragments, truncated frames...)
+        """
+        try: 
+            if linktype == dpkt.pcap.DLT_EN10MB: 
+                ethertype, = struct.unpack_from("!H", buf, 12)
+                offset = 14
+                if ethertype == ETHERTYPE_VLAN: 
+                    ethertype, = struct.unpack_from("!H", buf, 16)
+                    offset = 18
+            elif linktype == dpkt.pcap.DLT_LINUX_SLL: 
+                ethertype, = struct.unpack_from("!H", buf, 14)
+                offset = 16
+            elif linktype in DLT_RAW_VALUES: 
+                ethertype = ETHERTYPE_IPV4 if buf[0] >> 4 == 4 else None
+                offset = 0
+            else: 
+                return None
+
+            if ethertype != ETHERTYPE_IPV4: 
+                return None
+
+            ihl = (buf[offset] & 0x0f) * 4
+            total_length, fragment = struct.unpack_from("!H2xH", buf, offset + 2)
+            if fragment & 0x1fff != 0: 
+                # no transport header in the following fragments
+                return None
+            proto = buf[offset + 9]
+            src = socket.inet_ntoa(buf[offset + 12:offset + 16])
+            dst = socket.inet_ntoa(buf[offset + 16:offset + 20])
+            # using the IP total length to ignore the Ethernet padding (0 when offloading is used)
+            end = offset + total_length if total_length != 0 else len(buf)
+            l4 = offset + ihl
+
+            if proto == PROTO_TCP: 
+                sport, dport, seq = struct.unpack_from("!HHI", buf, l4)
+                data_offset = (buf[l4 + 12] >> 4) * 4
+                return PacketRecord(ts, src, dst, proto, sport, dport, seq, buf[l4 + data_offset:end])
+            if proto == PROTO_UDP: 
+                sport, dport = struct.unpack_from("!HH", buf, l4)
+                return PacketRecord(ts, src, dst, proto, sport, dport, None, buf[l4 + 8:end])
+        except (struct.error, IndexError): 
+            # truncated frame
+            pass 
+        return None
+
+    def get_dns_record(self, ts: float, buf: memoryview, linktype: int) -> PacketRecord: 
+        """
+        Decodes the frames dissected as DNS by Scapy (port 53), including the ones ignored by get_packet_record: 
+        DNS over IPv6, and DNS messages quoted in ICMP errors (eg: port unreachable)
+        Returns None for anything else
+
+        Same as Scapy, the payload goes up to the end of the frame (see get_dns_message)
+        """
+        try: 
+            if linktype == dpkt.pcap.DLT_EN10MB: 
+                ethertype, = struct.unpack_from("!H", buf, 12)
+                offset = 14
+                if ethertype == ETHERTYPE_VLAN: 
+                    ethertype, = struct.unpack_from("!H", buf, 16)
+                    offset = 18
+            elif linktype == dpkt.pcap.DLT_LINUX_SLL: 
+                ethertype, = struct.unpack_from("!H", buf, 14)
+                offset = 16
+            elif linktype in DLT_RAW_VALUES: 
+                ethertype = ETHERTYPE_IPV4 if buf[0] >> 4 == 4 else ETHERTYPE_IPV6
+                offset = 0
+            else: 
+                return None
+
+            src, dst, proto, l4 = self.get_ip_header(buf, offset, ethertype)
+            if proto in (PROTO_ICMP, PROTO_ICMPV6): 
+                icmp_type = buf[l4]
+                if proto == PROTO_ICMP and icmp_type not in ICMP_ERROR_TYPES: 
+                    return None
+                if proto == PROTO_ICMPV6 and icmp_type not in ICMPV6_ERROR_TYPES: 
+                    return None
+                # the quoted packet, after the 8 bytes of the ICMP header
+                ethertype = ETHERTYPE_IPV4 if buf[l4 + 8] >> 4 == 4 else ETHERTYPE_IPV6
+                src, dst, proto, l4 = self.get_ip_header(buf, l4 + 8, ethertype)
+
+            if proto == PROTO_UDP: 
+                sport, dport = struct.unpack_from("!HH", buf, l4)
+                payload = buf[l4 + 8:]
+                seq = None
+            elif proto == PROTO_TCP: 
+                sport, dport, seq = struct.unpack_from("!HHI", buf, l4)
+                payload = buf[l4 + (buf[l4 + 12] >> 4) * 4:]
+            else: 
+                return None
+            if sport == 53 or dport == 53: 
+                return PacketRecord(ts, src, dst, proto, sport, dport, seq, payload)
+        except (struct.error, IndexError, ValueError): 
+            # truncated frame
+            pass 
+        return None
+
+    def get_ip_header(self, buf: memoryview, offset: int, ethertype: int) -> tuple: 
+        """
+        Source, destination, protocol and offset of the transport header of an IPv4/IPv6 packet 
+        (IPv6: without extension headers)
+        """
+        if ethertype == ETHERTYPE_IPV4: 
+            fragment, = struct.unpack_from("!H", buf, offset + 6)
+            if fragment & 0x1fff != 0: 
+                raise ValueError("No transport header in the following fragments")
+            ihl = (buf[offset] & 0x0f) * 4
+            src = socket.inet_ntoa(buf[offset + 12:offset + 16])
+            dst = socket.inet_ntoa(buf[offset + 16:offset + 20])
+            return src, dst, buf[offset + 9], offset + ihl
+        if ethertype == ETHERTYPE_IPV6: 
+            src = socket.inet_ntop(socket.AF_INET6, buf[offset + 8:offset + 24])
+            dst = socket.inet_ntop(socket.AF_INET6, buf[offset + 24:offset + 40])
+            return src, dst, buf[offset + 6], offset + 40
+        raise ValueError(f"Not an IP packet (ethertype: {ethertype})")
+
+    def get_dns_qdcount(self, record: PacketRecord) -> int: 
+        """
+        Returns the number of questions of a DNS message, read directly from its header 
+        (0 if the payload is too short to be DNS)
+        """
+        payload = record.payload
+        if record.proto == PROTO_TCP: 
+            # DNS over TCP is prefixed by the length of the message
+            payload = payload[2:]
+        if len(payload) < 12: 
+            return 0
+        return struct.unpack_from("!H", payload, 4)[0]
+
+    def get_dns_message(self, record: PacketRecord) -> DnsMessage: 
+        """
+        Reads the fields used by PcapExtractAll directly from the header and the records of a DNS message, 
+        without dissecting the names and the data of the records
+        Returns None if there is no question (or if the message is too short to be DNS)
+        """
+        payload = record.payload
+        length = len(payload)
+        if record.proto == PROTO_TCP: 
+            # DNS over TCP is prefixed by the length of the message
+            payload = payload[2:]
+        try: 
+            qdcount, ancount, nscount, arcount = struct.unpack_from("!4H", payload, 4)
+            if qdcount == 0: 
+                return None
+            offset = self.skip_dns_name(payload, 12)
+            qtype, = struct.unpack_from("!H", payload, offset)
+            offset += 4
+            for i in range(qdcount - 1): 
+                offset = self.skip_dns_name(payload, offset) + 4
+        except (struct.error, IndexError): 
+            return None
+
+        has_rr = False
+        try: 
+            for i in range(ancount + nscount + arcount): 
+                offset = self.skip_dns_name(payload, offset)
+                rr_type, rd_length = struct.unpack_from("!H6xH", payload, offset)
+                if rr_type not in SCAPY_NOT_DNSRR_TYPES: 
+                    has_rr = True
+                    break
+                offset += 10 + rd_length
+        except (struct.error, IndexError): 
+            # truncated records: keeping the ones before
+            pass 
+        return DnsMessage(length, qtype, ancount, has_rr)
+
+    def skip_dns_name(self, payload: memoryview, offset: int) -> int: 
+        """
+        Offset of the end of the (possibly compressed) name starting at offset
+        """
+        while True: 
+            n = payload[offset]
+            if n == 0: 
+                return offset + 1
+            if n & 0xc0 == 0xc0: 
+                # pointer to a previous name: end of this one
+                return offset + 2
+            offset += n + 1
+
     def get_padding_strategy_from_port(self, port: int) -> str: 
         for padding_strat in self.padding_strategies:
             min_port = self.padding_strategies[padding_strat]['ports'][0]
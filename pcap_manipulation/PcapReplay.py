@@ -11,13 +11,11 @@ logging.basicConfig(
     stream=sys.stdout
 )
 
-import time
+import os
 import random
 random.seed(42)
 import socket
-import signal
 
-from pathlib import Path
 
 # using trio instead of asyncio because dnspython does not support local_port settings when using asyncio as a backend
 # https://github.com/rthalley/dnspython/blob/a9634b09c647c58ce6ba049ad6a15b9b397bb6e3/dns/_asyncio_backend.py#L143 
@@ -27,7 +25,6 @@ from datetime import datetime, timedelta
 
 import binascii
 import sslkeylog
-import subprocess
 
 # using dpkt instead of Scapy for performance
 import dpkt
@@ -41,10 +38,15 @@ logging.getLogger('httpx').setLevel(logging.WARN)
 
 from utils import *
 from PcapHelper import * 
+from ReplayCapture import *
+from ReplayScheduler import *
+from ReplayPool import *
+from ReplayManifest import *
+from ReplayBatch import *
 
 
 class PcapReplay(PcapHelper):
-    def __init__(self, resolvers: dict, padding_strategies: dict, input_pcap: str, mac_address: str, output_pcap: str, iface: str, sslkeylog_path: str, max_nb_replayed: int, max_nb_retries: int, output_features: str = None):
+    def __init__(self, resolvers: dict, padding_strategies: dict, input_pcap: str, mac_address: str, output_pcap: str, iface: str, sslkeylog_path: str, max_nb_replayed: int, max_nb_retries: int, output_features: str = None, resolver_rate: float = 5, resolver_burst: int = 1, pooled: bool = False, speedup: float = None, asap: bool = False, verify: bool = True, resume: bool = True, manifest_dir: str = None, resolvers_cache: str = None):
         PcapHelper.__init__(self, resolvers, padding_strategies, input_pcap) 
         self.sslkeylog_path = sslkeylog_path
         self.mac_address = mac_address
@@ -52,6 +54,24 @@ class PcapReplay(PcapHelper):
         self.iface = iface
         self.max_nb_replayed = max_nb_replayed
         self.max_nb_retries = max_nb_retries
+        # maximum number of queries per second sent to a given resolver (see TokenBucket)
+        self.resolver_rate = resolver_rate
+        self.resolver_burst = resolver_burst
+        # "pooled" mode: reusing warm connections across queries (see ReplayPool)
+        self.pooled = pooled
+        self.pool = None
+        # checking the certificates of the resolvers (not possible with LocalResolver's self-signed one)
+        self.verify = verify
+        # replay clock: by default, each query is replayed at its original time of the day (up to 24h later)
+        # - speedup: the original timeline (starting now) is compressed by this factor
+        # - asap: everything is replayed right away (in the original order)
+        # in all cases, the timestamps of the replayed packets are put back on the original timeline (see rebase_sessions)
+        self.speedup = speedup
+        self.asap = asap
+        # resuming an interrupted replay of the same file (see ReplayManifest)
+        self.resume = resume
+        self.manifest_dir = manifest_dir
+        self.manifest = None
 
         logging.debug(f"New {self.__class__.__name__} with config:\n\
             Resolvers: {self.resolvers}\n\
@@ -64,13 +84,12 @@ class PcapReplay(PcapHelper):
 
         sslkeylog.set_keylog(self.sslkeylog_path)
 
-        # removing all content from the output pcap as we use append mode
-        # (we do not want duplication when running the script again)
-        open(self.output_pcap, 'w').close()
-
         self.replay_queries = []
+        # single capture for all the replayed queries (see replay_all)
+        self.capture = None
         self.set_nb_resolvers() 
-        self.set_resolvers_IPs()
+        # saving the IPs of the resolvers for the extraction (see ResolversCache)
+        self.set_resolvers_IPs(None if resolvers_cache == None else ResolversCache(resolvers_cache))
     
     @property
     def mac_address(self):
@@ -151,7 +170,16 @@ class PcapReplay(PcapHelper):
 
     def replay_all(self):
         """
-        Programming the replay of packets in the following 24 hours
+        Replay of this file only (see ReplayBatch to replay several files at once)
+        """
+        ReplayBatch([self]).replay_all()
+
+    def get_schedule(self) -> list:
+        """
+        Programming the replay of packets in the following 24 hours 
+        (or sooner, see self.speedup and self.asap)
+
+        Returns the (delay, index of the query) of the queries not replayed yet, see run_at_offsets
         """
         midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         now = datetime.now()
@@ -161,10 +189,26 @@ class PcapReplay(PcapHelper):
 
         nb_replay_queries = len(self.replay_queries)
         logging.debug(f"Number of queries to replay: {nb_replay_queries}")
-        threads = [None] * nb_replay_queries
+        # (delay, index of the query), see run_at_offsets
+        schedule = []
         self.replay_ports = {}
         
-        self.results = [None] * nb_replay_queries
+        if nb_replay_queries > 0: 
+            first_ts = min(ts for ts, qname, qtype in self.replay_queries[:self.max_nb_replayed+1])
+
+        # the replayed queries are saved as soon as they are done (see replay_single_pkt)
+        self.manifest = ReplayManifest(self.output_pcap, self.manifest_dir)
+        nb_planned_queries = min(nb_replay_queries, self.max_nb_replayed + 1)
+        if self.resume: 
+            self.manifest.load(self.input_pcap, nb_planned_queries)
+        else: 
+            self.manifest.reset(self.input_pcap, nb_planned_queries)
+        if self.manifest.complete: 
+            logging.info(f"--- Already replayed: {self.output_pcap}")
+            return schedule
+        # (we do not want an outdated output if the replay does not finish)
+        open(self.output_pcap, 'w').close()
+
         debug_i = 0 
         for i in range(nb_replay_queries): 
             ts, qname, qtype = self.replay_queries[i]
@@ -173,7 +217,12 @@ class PcapReplay(PcapHelper):
             # of replay
             q_dt = datetime.fromtimestamp(int(ts))
             q_relative_seconds = get_relative_seconds(q_dt)
-            if q_relative_seconds > current_relative_seconds: 
+            if self.asap: 
+                # (the queries with the same delay are started in the order of the schedule)
+                delay = 0
+            elif self.speedup != None: 
+                delay = (ts - first_ts) / self.speedup
+            elif q_relative_seconds > current_relative_seconds: 
                 delay = q_relative_seconds - current_relative_seconds
             else:
                 # if the packets is to be sent after midnight
@@ -185,44 +234,43 @@ class PcapReplay(PcapHelper):
             logging.info(f"--- at: {now + timedelta(seconds=delay)} (packet datetime: {q_dt})")
             
             # DEBUG: using a really small delay to check if it works correctly
-            # threads[i] = threading.Timer(debug_i*5, self.replay_single_pkt, [self.replay_queries[i], i])
-            threads[i] = threading.Timer(delay, self.replay_single_pkt, [self.replay_queries[i], i])
-            threads[i].start()
+            # schedule.append((debug_i*5, i))
+            if not self.manifest.is_done(i): 
+                schedule.append((delay, i))
 
             if i == self.max_nb_replayed: 
                 break 
             # if debug_i == 1: 
             #     break 
             debug_i += 1
-        for i in range(nb_replay_queries): 
-            if threads[i] != None: # required if we're debugging and breaking the previous loop before intiializing all the threads
-                threads[i].join()
+        return schedule
 
-        logging.debug("[-] Replay is finished, writting everything in one file now")
+    def write_output(self): 
+        logging.debug(f"[-] Replay is finished, writting everything in one file now ({self.output_pcap})")
         
-        # save all the results at once
+        # save all the queries at once, in chronological order
         with open(self.output_pcap, "wb") as of:
             output_pcap_writer = dpkt.pcapng.Writer(of)
-            for pkts in self.results: 
-                if pkts != None: 
-                    for ts, buf in pkts: 
-                        output_pcap_writer.writepkt(buf, ts)
-
-    def reorder_pkts(self, to_reorder_file: str): 
-        rnd_letters = get_rnd_chars(10)
-        popen = subprocess.run(["reordercap", to_reorder_file, f"/tmp/reordered_{rnd_letters}.pcap"])
-        popen = subprocess.run(["mv", f"/tmp/reordered_{rnd_letters}.pcap", to_reorder_file])
+            for ts, buf in self.manifest.get_packets(): 
+                output_pcap_writer.writepkt(buf, ts)
+        self.manifest.finish()
 
     def get_bpf(self, ports: list=None) -> str:
         """
         Create a Berkeley Packet Filter to only save packets going to and coming from DNS resolvers 
         https://biot.com/capstats/bpf.html
+        Without ports, all the ports used by the padding strategies are kept
         """
         # starting with the port to optimize the filter
         ports_bpf = ""
         if ports != None: 
             for p in ports: 
                 ports_bpf = f"{ports_bpf} or (port {p})"
+        else: 
+            for padding_strat in self.padding_strategies: 
+                min_port, max_port = self.padding_strategies[padding_strat]['ports']
+                # (the max port is excluded, see get_opened_socket_in_range)
+                ports_bpf = f"{ports_bpf} or (portrange {min_port}-{max_port - 1})"
 
         resolvers_bpf = ""
         for resolver_type in self.resolvers: 
@@ -232,137 +280,47 @@ class PcapReplay(PcapHelper):
         # removing the first " or "
         return f"({ports_bpf[4:]}) and ({resolvers_bpf[4:]})"
 
-    def replay_single_pkt(self, qtuple: tuple, index: int):
+    async def replay_single_pkt(self, index: int):
         """
-        The idea is to start a tshark sniffer used *only* for the current pkt. 
-        To do so, we create a BPF using the IP addresses of the resolvers but also 
-        the (local) ports that will be used for the TCP connection. 
-
-        Thus, if two threads of replay_single_pkt are fired at the same time, 
-        each tshark instance will only save the packets to their relative pkt. 
+        The packets of all the queries (of all the files of a ReplayBatch) are sniffed by a single capture (self.capture). 
+        To know which packets belong to the current query, we register 
+        the (local) ports used for the TCP connections (see send). 
 
-        Once the replay is done and the packets are saved, we change the timing 
-        of the new packets relatively to the original pkt. 
+        Thus, if two replay_single_pkt tasks are fired at the same time, 
+        the packets are still dispatched to their relative pkt. 
 
-        Finally, the index is used to put the newly generated packet inside the self.results 
-        shared memory without having data destroyed by other threads.
+        Once the query is done, we change the timing of the new packets 
+        relatively to the original pkt (see rebase_sessions), and save them (see ReplayManifest). 
         """ 
-        qts, qname, qtype = qtuple
+        qts, qname, qtype = self.replay_queries[index]
         logging.debug(f"[+] Replaying query: {qname} ({qtype}) [{qts}]")
-        logging.debug(f"--- Sniffing: {self.iface}")
-
-        # generating source ports so we can re-identify packets in the flow
-        source_ports = {}
-        source_ports_list = []
-        opened_sockets = {}
-        
-        i = 0 
-        for padding_strat in self.padding_strategies: 
-            for resolver_type in self.resolvers: 
-                for resolver in self.resolvers[resolver_type]:
-                    # using the port number to classify the packets based on the padding strategy 
-                    # did we just recreate a covert channel attack
-                    s = get_opened_socket_in_range(self.padding_strategies[padding_strat]['ports'])
-                    current_socket_key = f"{padding_strat}_{resolver_type}_{resolver['name']}"
-                    opened_sockets[current_socket_key] = s
-                    reserved_port = get_socket_port(s)
-
-                    source_ports_list.append(reserved_port)
-                    source_ports[current_socket_key] = reserved_port
-            i += 1 
-        f = self.get_bpf(ports = source_ports_list)
-        logging.info(f"--- Filter: {f} | {self.input_pcap}")
-        
-        # Starting tshark subprocess using BPF here 
-        # using /tmp/ to be sure to be able to write in the temporary file
-        # thus, name must be random (so one thread does not overwrite another)
-        rnd_letters = get_rnd_chars(10)
-        tmp_pcap = f"/tmp/tshark_{rnd_letters}.pcap"
-        tshark_call = ["tshark", "-i", self.iface, "-f", f, "-w", tmp_pcap]        
-        popen = subprocess.Popen(tshark_call)
-        time.sleep(1)
-        trio.run(self.send_dns, (qname, qtype), source_ports, opened_sockets)
-        time.sleep(1) # waiting for every packet to be written in the tshark file, breathe.
-        
-        # (using this instead of popen.kill to avoid `dumpcap` processes staying there for no reason)
-        os.kill(popen.pid, signal.SIGTERM) 
 
-        logging.debug(f"--- Saved packets using tshark, reading them again from {tmp_pcap}.")
-        
-        # re-ordering packets here as well so everything is less of a mess
-        self.reorder_pkts(tmp_pcap)
+        # (the ports are reserved by send, once the query can be sent to the resolver)
+        await self.send_dns((qname, qtype), (self.input_pcap, index))
 
-        # NOTE: using the pcapng reader, not the pcap one because tshark saves its capture as in pcapng format
-        pcap_reader = dpkt.pcapng.Reader(open(tmp_pcap,'rb'))
+        # waiting for the last packets of the query (eg: closing the connections)
+        await trio.sleep(self.capture.flush_delay)
+        self.manifest.append(index, merge_sessions(rebase_sessions(qts, self.capture.pop_packets((self.input_pcap, index)))))
 
-        # At this point, we have sniffed all the new packets
-        # We still need to make them start at the right time, 
-        # using the first packet for a specific port as point of reference
-        original_time = qts
-        
-        # NOTE: using only the first packet (eg: res[0].time) does not yield correct results 
-        # because there *IS* a time shift between each query, and at the end, the last query 
-        # may produce false data (eg: an IAT of 1 instead of 0) 
-        reference_times = {}
-
-        res = []
-        first_time = None
-        for (ts, buf) in pcap_reader: 
-            if first_time == None: 
-                first_time = ts
-            eth = dpkt.ethernet.Ethernet(buf)
-            if isinstance(eth.data, dpkt.ip.IP):
-                ip = eth.data
-                if type(ip.data) == dpkt.tcp.TCP:
-                    tcp = ip.data
-                    # setting the reference time for the first packet using the port
-                    if tcp.sport in source_ports_list and tcp.sport not in reference_times:
-                        reference_times[tcp.sport] = ts
-
-                    if tcp.sport in source_ports_list: 
-                        ref_time = reference_times[tcp.sport]
-                    elif tcp.dport in source_ports_list:
-                        if tcp.dport in reference_times:
-                            ref_time = reference_times[tcp.dport]
-                        else: 
-                            # if somehow the first message encountered is using dport
-                            # it's not in reference_times yet, so we can not know
-                            # this should not happen as we specifically reorder the packets 
-                            # before this loop
-                            ref_time = first_time
-                    else: 
-                        logging.error(f"Unknown port found in captured replay packet. What the hell happened there? {tcp.sport} | {self.input_pcap}")
-                        # raise RuntimeError 
-
-                    res.append((original_time + ts - ref_time, buf))
-        self.results[index] = res
-
-        # Deleting the temporary file as it may flood the /tmp partition on some servers (e.g.: g5k)
-        # Note: this is *NOT* perfect, because it lets some files stay somehow. 
-        # I guess it's some kind of race condition,
-        # but it's currently enough to not completely fill the partition
-        Path(tmp_pcap).unlink(missing_ok=True)
-
-    async def send_dns(self, qtuple, source_ports: dict, opened_sockets: dict):
+    async def send_dns(self, qtuple, capture_key):
         qname, qtype = qtuple
         
         # awaiting all the send calls at once so it doesn't take too much time
         # https://stackoverflow.com/a/34377364
+        async with trio.open_nursery() as nursery:
+            for padding_strat in self.padding_strategies:
+                if len(self.padding_strategies[padding_strat]['ports']) > 1:
+                    # picking a random block padding size if there are multiple values available
+                    padding = random.choice(self.padding_strategies[padding_strat]['padding'])
+                else:  
+                    padding = self.padding_strategies[padding_strat]['padding'][0]
+                logging.debug(f"Using padding: {padding} {padding_strat}")
+                for resolver_type in self.resolvers: 
+                    if resolver_type == "doh": 
+                        callback = dns.asyncquery.https
+                    if resolver_type == "dot":
+                        callback = dns.asyncquery.tls
 
-        for padding_strat in self.padding_strategies:
-            if len(self.padding_strategies[padding_strat]['ports']) > 1:
-                # picking a random block padding size if there are multiple values available
-                padding = random.choice(self.padding_strategies[padding_strat]['padding'])
-            else:  
-                padding = self.padding_strategies[padding_strat]['padding'][0]
-            logging.debug(f"Using padding: {padding} {padding_strat}")
-            for resolver_type in self.resolvers: 
-                if resolver_type == "doh": 
-                    callback = dns.asyncquery.https
-                if resolver_type == "dot":
-                    callback = dns.asyncquery.tls
-
-                async with trio.open_nursery() as nursery:
                     for resolver in self.resolvers[resolver_type]:
                         if resolver_type == "doh": 
                             endpoint = resolver['endpoint']
@@ -376,63 +334,102 @@ class PcapReplay(PcapHelper):
                             padding,
                             qname, 
                             qtype, 
-                            source_ports[tmp_key], 
-                            opened_sockets[tmp_key], 
-                            callback
+                            self.padding_strategies[padding_strat]['ports'], 
+                            callback,
+                            # Trying to fire 12 requests at (virtually) once against a DNS resolver
+                            # may be detected as DDOS attempt and blocked. 
+                            # As packets are re-ordered and shifted afterwards, we can wait
+                            self.resolvers_buckets[f"{resolver_type}_{resolver['name']}"],
+                            tmp_key,
+                            capture_key,
                         )
-                        # Trying to fire 12 requests at (virtually) once against a DNS resolver
-                        # may be detected as DDOS attempt and blocked. 
-                        # As 1) packets are re-ordered and shifted afterwards, 
-                        # and 2) generated inside a subprocess, we can wait
-                        time.sleep(0.2)
-                time.sleep(0.2)
-
-    async def send(self, endpoint: str, padding: int, qname: str, qtype: int, source_port: int, opened_socket, cb):
+
+    async def send(self, endpoint: str, padding: int, qname: str, qtype: int, ports_range: list, cb, bucket: TokenBucket = None, pool_key: str = None, capture_key = None):
         """
-        Send a DNS query (qname, qtype) to a resolver (can be DoH or DoT)
+        Send a DNS query (qname, qtype) to a resolver (can be DoH or DoT), from a port of ports_range
+        The packets of the port are captured for capture_key (see ReplayCapture) from the moment the query is sent
+
+        The port is only reserved once the query can be sent (see bucket), so the queries waiting
+        for their turn (eg: all of them with --asap) do not hold ports in the meantime
+
+        In pooled mode, the connection of pool_key is used (see ReplayPool): as all the queries share its port,
+        it is used by one query at a time, else the packets of a query would go to the last one registered
         """
+        if bucket != None: 
+            await bucket.acquire()
+        if self.pool != None: 
+            async with self.pool.get_lock(pool_key): 
+                # same port (connection) for all queries
+                source_port = self.pool.get_port(pool_key, ports_range)
+                self.capture.register(capture_key, [source_port])
+                await self.query(endpoint, padding, qname, qtype, source_port, None, cb, pool_key)
+                # the last packets of the exchange (eg: the ACK of the answer) still belong to this query
+                await trio.sleep(self.pool.settle_delay)
+        else: 
+            # using the port number to classify the packets based on the padding strategy 
+            # did we just recreate a covert channel attack
+            s = get_opened_socket_in_range(ports_range)
+            source_port = get_socket_port(s)
+            try: 
+                self.capture.register(capture_key, [source_port])
+                await self.query(endpoint, padding, qname, qtype, source_port, s, cb, pool_key)
+            finally: 
+                s.close()
+                # the connection is closed: other queries/replays can use the port after TIME_WAIT
+                release_port_lease(source_port)
+
+    async def query(self, endpoint: str, padding: int, qname: str, qtype: int, source_port: int, opened_socket, cb, pool_key: str = None):
         logging.debug(f"[-] Resolving {qname} ({qtype}) via {endpoint} from port {source_port} (cb: {cb})") 
-        transport = httpx.AsyncHTTPTransport(retries=self.max_nb_retries)
 
-        async with httpx.AsyncClient(transport=transport) as client:
-            if padding != 0: 
-                # use_edns is required for the padding to be taken into account
-                q = dns.message.make_query(qname, qtype, use_edns=True, pad=padding)
+        if padding != 0: 
+            # use_edns is required for the padding to be taken into account
+            q = dns.message.make_query(qname, qtype, use_edns=True, pad=padding)
+        else: 
+            q = dns.message.make_query(qname, qtype)
+
+        try:
+            if self.pool != None: 
+                if cb == dns.asyncquery.https: 
+                    a = await self.pool.https(pool_key, q, endpoint)
+                else: 
+                    a = await self.pool.tls(pool_key, q, endpoint)
             else: 
-                q = dns.message.make_query(qname, qtype)
-
-            opened_socket.close() # closing the socket so the port is not bound now 
-            try:
+                opened_socket.close() # closing the socket so the port is not bound now 
+                if cb == dns.asyncquery.https: 
+                    kwargs = {"verify": self.verify}
+                else: 
+                    kwargs = {"ssl_context": get_dot_ssl_context(self.verify)}
                 a = await cb(
                     q, 
                     endpoint, 
                     source=get_ip_address(self.iface), 
-                    source_port=source_port
+                    source_port=source_port,
+                    **kwargs
                 )
-                logging.debug(a.to_text())
-            except OSError: 
-                # Sometimes, the port used is already re-assigned / unavailable.
-                # Should not happen, or very rarely. 
-                logging.error(f"OSErr with: {source_port} | {qname} | {qtype} | {endpoint} | {self.input_pcap}")
-            except httpx.ConnectError: 
-                # If we spam a bit much, the resolvers block us.
-                # Should not happen, or very rarely. 
-                logging.error(f"ConnectErr with: {qname} | {qtype} | {endpoint} | {self.input_pcap}")
-            except EOFError: 
-                # CleanBrowsing (DoT) servers are MESSED UP, so sometimes they answer, somestimes they don't. 
-                # the resulting pcap contains the DNS query, but not the answer. :)
-                logging.error(f"EOFErr with: {source_port} | {qname} | {qtype} | {endpoint} | {self.input_pcap}")
-            except dns.resolver.NoNameservers:
-                logging.error(f"NoNameservers with: {source_port} | {qname} | {qtype} | {endpoint} | {self.input_pcap}")
-            except ValueError as ve: 
-                logging.error(ve)
-            except Exception as e:
-                # sometimes, something unexpected happens. 
-                # e.g.: the connection times out. 
-                # it's ok. we have volume, ignoring.
-                # https://docs.python.org/3.12/library/exceptions.html#exception-hierarchy
-                logging.error(e) 
-            # we only care about sending the packet. the actual answer is irrelevant
+            logging.debug(a.to_text())
+        except OSError: 
+            # Sometimes, the port used is already re-assigned / unavailable.
+            # Should not happen, or very rarely. 
+            logging.error(f"OSErr with: {source_port} | {qname} | {qtype} | {endpoint} | {self.input_pcap}")
+        except httpx.ConnectError: 
+            # If we spam a bit much, the resolvers block us.
+            # Should not happen, or very rarely. 
+            logging.error(f"ConnectErr with: {qname} | {qtype} | {endpoint} | {self.input_pcap}")
+        except EOFError: 
+            # CleanBrowsing (DoT) servers are MESSED UP, so sometimes they answer, somestimes they don't. 
+            # the resulting pcap contains the DNS query, but not the answer. :)
+            logging.error(f"EOFErr with: {source_port} | {qname} | {qtype} | {endpoint} | {self.input_pcap}")
+        except dns.resolver.NoNameservers:
+            logging.error(f"NoNameservers with: {source_port} | {qname} | {qtype} | {endpoint} | {self.input_pcap}")
+        except ValueError as ve: 
+            logging.error(ve)
+        except Exception as e:
+            # sometimes, something unexpected happens. 
+            # e.g.: the connection times out. 
+            # it's ok. we have volume, ignoring.
+            # https://docs.python.org/3.12/library/exceptions.html#exception-hierarchy
+            logging.error(e) 
+        # we only care about sending the packet. the actual answer is irrelevant
 
 
 if __name__ == "__main__":
@@ -448,30 +445,75 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Replay a pcap file, saving only DHCP and DNS-converted-to-DoH packets")
     parser.add_argument('--resolvers_config', '-rc', help='Config file containing the IP address of DNS resolvers', required=True)
     parser.add_argument('--replay_config', '-rplc', help='Config file containing stable parameters used for replay', required=True)
-    parser.add_argument('--input_pcap', '-i', help='Pcap file containing the IP of the device in its name', required=True)
-    parser.add_argument('--mac_address', '-mac', help='The MAC address of the device we want to replay frames of', required=True)
-    parser.add_argument('--output_pcap', '-o', help='Where to save the new packets', required=True)
+    parser.add_argument('--input_pcap', '-i', help='Pcap file containing the IP of the device in its name')
+    parser.add_argument('--input_dir', '-id', help='Batch mode: directory of pcap files, all replayed by this process (repeat -id/-mac/-od/-md for each device, see ReplayBatch)', action='append')
+    parser.add_argument('--mac_address', '-mac', help='The MAC address of the device we want to replay frames of (one per -id in batch mode)', action='append', required=True)
+    parser.add_argument('--output_pcap', '-o', help='Where to save the new packets')
+    parser.add_argument('--output_dir', '-od', help='Batch mode: where to save the replayed files of the -id directory (same filenames)', action='append')
     parser.add_argument('--iface', '-if', help='The interface used to sniff replayed packets', required=True)
     parser.add_argument('--sslkeylog_path', '-s', help='The SSLkeylog file where to save the decryption keys', default="./sslkeylog.log")
+    parser.add_argument('--speedup', '-x', help='Replay the queries on a timeline compressed by this factor, starting now (default: at their original time of the day)', type=float)
+    parser.add_argument('--asap', '-a', help='Replay all the queries right away, in their original order', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--pooled', '-pl', help='Reuse one warm connection per (padding strategy, resolver) for all queries (bulk/load runs, the TLS sessions are not the ones of a real device)', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--resume', '-rs', help='Only replay the queries missing from a previous, interrupted replay of the file (see ReplayManifest)', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--manifest_dir', '-md', help='Where to save the checkpoints of the replay (default: next to the output, one per -id in batch mode)', action='append')
+    parser.add_argument('--verify', '-v', help='Check the certificates of the resolvers (--no-verify for LocalResolver)', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--resolvers_cache', '-rca', help='Where to save the IPs of the resolvers used by this run, for the extraction (JSON file, see ResolversCache)')
 
     args = parser.parse_args()
+    if args.speedup != None and args.speedup <= 0: 
+        parser.error("--speedup must be positive")
+    if (args.input_pcap == None) == (args.input_dir == None): 
+        parser.error("either --input_pcap or --input_dir")
+
+    # (input pcap, mac address, output pcap, manifest dir)
+    jobs = []
+    if args.input_pcap != None: 
+        if args.output_pcap == None or len(args.mac_address) != 1 or len(args.manifest_dir or [None]) != 1: 
+            parser.error("--input_pcap requires one --output_pcap, --mac_address (and --manifest_dir)")
+        jobs.append((args.input_pcap, args.mac_address[0], args.output_pcap, (args.manifest_dir or [None])[0]))
+    else: 
+        manifest_dirs = args.manifest_dir or [None] * len(args.input_dir)
+        if not (len(args.input_dir) == len(args.mac_address) == len(args.output_dir or []) == len(manifest_dirs)): 
+            parser.error("each --input_dir requires one --output_dir, --mac_address (and --manifest_dir)")
+        for input_dir, mac_address, output_dir, manifest_dir in zip(args.input_dir, args.mac_address, args.output_dir, manifest_dirs): 
+            for filename in sorted(os.listdir(input_dir)): 
+                if os.path.isfile(os.path.join(input_dir, filename)): 
+                    jobs.append((os.path.join(input_dir, filename), mac_address, os.path.join(output_dir, filename), manifest_dir))
+
     resolvers_config = read_conf(args.resolvers_config)
 
     replay_config = read_conf(args.replay_config)
 
-    pr = PcapReplay(
-        resolvers_config['resolvers'], 
-        resolvers_config['padding_strategies'],
-        args.input_pcap, 
-        args.mac_address,
-        args.output_pcap, 
-        args.iface, 
-        args.sslkeylog_path,
-        replay_config['max_nb_replayed'],
-        replay_config['max_nb_retries']
-    )
-    pr.read_pcap()
-    pr.loop_through()
-    pr.replay_all()
-    pr.reorder_pkts(pr.output_pcap)
-
+    replays = []
+    for input_pcap, mac_address, output_pcap, manifest_dir in jobs: 
+        if args.resume and ReplayManifest(output_pcap, manifest_dir).is_complete(): 
+            logging.info(f"--- Already replayed: {output_pcap}")
+            continue
+        pr = PcapReplay(
+            # (shared by all the files: the IPs of the resolvers are only resolved once)
+            resolvers_config['resolvers'], 
+            resolvers_config['padding_strategies'],
+            input_pcap, 
+            mac_address,
+            output_pcap, 
+            args.iface, 
+            args.sslkeylog_path,
+            replay_config['max_nb_replayed'],
+            replay_config['max_nb_retries'],
+            resolver_rate=replay_config.get('resolver_rate', 5),
+            resolver_burst=replay_config.get('resolver_burst', 1),
+            pooled=args.pooled,
+            speedup=args.speedup,
+            asap=args.asap,
+            verify=args.verify,
+            resume=args.resume,
+            manifest_dir=manifest_dir,
+            resolvers_cache=args.resolvers_cache,
+        )
+        pr.read_pcap()
+        pr.loop_through()
+        # only the queries are needed from now on (closing the file)
+        pr.packets = []
+        replays.append(pr)
+    ReplayBatch(replays).replay_all()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import mmap
+import time
+import fcntl
+import socket
+import logging
+from contextlib import contextmanager
+
+NB_PORTS = 65536
+# Linux keeps closed connections in TIME_WAIT for 60 seconds (TCP_TIMEWAIT_LEN):
+# connecting again from the same port to the same resolver fails in the meantime
+TIME_WAIT = 60
+
+
+class PortLeases(object):
+    """
+    Per-host allocator of the local ports used by the replay, shared by all the replay processes
+
+    The lease table is a small file mapped in memory (one expiry time and one owner PID per port,
+    plus one cursor per port range), protected by an flock: ports are handed out round-robin
+    in each range (the port after the cursor is usually the one released first, so O(1)),
+    and only come back TIME_WAIT seconds after being released, or when their owner process is dead
+    (eg: a crashed replay does not keep its ports forever)
+    """
+    def __init__(self, path: str, time_wait: float = TIME_WAIT):
+        self.path = path
+        self.time_wait = time_wait
+        self.pid = os.getpid()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        size = NB_PORTS * (8 + 4 + 4)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # port -> time until which it is leased (0: never leased, inf: until released)
+        self.expiries = memoryview(self.map)[:NB_PORTS * 8].cast('d')
+        # port -> PID of the process holding the lease (0: released)
+        self.owners = memoryview(self.map)[NB_PORTS * 8:NB_PORTS * 12].cast('i')
+        # first port of a range -> offset of the next port to try in the range
+        self.cursors = memoryview(self.map)[NB_PORTS * 12:].cast('I')
+
+    @contextmanager
+    def locked(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def is_leased(self, port: int, now: float) -> bool:
+        if self.expiries[port] <= now:
+            return False
+        owner = self.owners[port]
+        if owner == 0 or owner == self.pid:
+            return True
+        try:
+            os.kill(owner, 0)
+        except ProcessLookupError:
+            # the owner died without releasing its ports
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def acquire(self, r: list[int]) -> socket.socket:
+        """
+        Lease a port in [r[0], r[1]) and return a socket bound to it, until release(port)
+        """
+        min_port, max_port = r
+        size = max_port - min_port
+        with self.locked():
+            now = time.time()
+            offset = self.cursors[min_port] % size
+            for _ in range(size):
+                port = min_port + offset
+                offset = (offset + 1) % size
+                if self.is_leased(port, now):
+                    continue
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                try:
+                    s.bind(('', port))
+                except OSError:
+                    # used by something else than the replay
+                    s.close()
+                    continue
+                self.expiries[port] = float('inf')
+                self.owners[port] = self.pid
+                self.cursors[min_port] = offset
+                return s
+        logging.error(f"No port available in [{min_port};{max_port}[ (all leased or in TIME_WAIT)")
+        raise RuntimeError
+
+    def release(self, port: int):
+        """
+        The connection using the port is closed: it can be leased again once out of TIME_WAIT
+        """
+        with self.locked():
+            if self.owners[port] == self.pid:
+                self.expiries[port] = time.time() + self.time_wait
+                self.owners[port] = 0
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+ROOT = 0
+
+
+class QnameIndex(object):
+    """
+    Interning table of qnames: each distinct qname gets an integer ID, once (lowercased and split once)
+
+    The IDs are the nodes of a trie of the reversed labels (org -> ntp -> pool -> 0 for 0.pool.ntp.org),
+    so the N-label view of a qname (eg: pool.ntp.org for N=3, see PcapExtractString) is an ancestor of its node,
+    and the node of a suffix is the same as the one of the suffix as a qname (pool.ntp.org): all the views
+    share the same IDs, and the names are only built back when needed (get_name)
+    """
+    def __init__(self):
+        # node -> label, parent, number of labels, children (label -> node)
+        self.labels = [None]
+        self.parents = [None]
+        self.depths = [0]
+        self.children = [{}]
+        # qname (as queried) -> node
+        self.ids = {}
+        # N -> node -> node of its N-label view
+        self.views = {}
+        # node -> qname (lowercased), see get_name
+        self.names = [None]
+
+    def __len__(self) -> int:
+        return len(self.labels) - 1
+
+    def get_id(self, qname: str) -> int:
+        node = self.ids.get(qname)
+        if node != None:
+            return node
+        node = ROOT
+        for label in reversed(qname.lower().split(".")):
+            child = self.children[node].get(label)
+            if child == None:
+                child = len(self.labels)
+                self.labels.append(label)
+                self.parents.append(node)
+                self.depths.append(self.depths[node] + 1)
+                self.children.append({})
+                self.names.append(None)
+                self.children[node][label] = child
+            node = child
+        self.ids[qname] = node
+        return node
+
+    def get_view(self, node: int, nb_labels: int) -> int:
+        """
+        Node of the last nb_labels labels of the qname (same as '.'.join(qname.split(".")[-nb_labels:])),
+        the qname itself if nb_labels is None
+        """
+        if nb_labels == None:
+            return node
+        if nb_labels not in self.views:
+            self.views[nb_labels] = {}
+        views = self.views[nb_labels]
+        view = views.get(node)
+        if view == None:
+            view = node
+            while self.depths[view] > nb_labels:
+                view = self.parents[view]
+            views[node] = view
+        return view
+
+    def get_name(self, node: int) -> str:
+        name = self.names[node]
+        if name == None:
+            parent = self.parents[node]
+            name = self.labels[node] if parent == ROOT else f"{self.labels[node]}.{self.get_name(parent)}"
+            self.names[node] = name
+        return name
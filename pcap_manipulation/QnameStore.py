@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import logging
+
+import numpy as np
+import scipy.sparse
+
+from QnameIndex import *
+
+# A qname store is a directory (eg: data/csv/<RUN_ID>/dns_str.dns_str) containing
+# the one-hot encoded qnames of PcapExtractString, as sparse matrices:
+# - X_<qname_type>.npz: one CSR matrix per qname type (complete/4/3), one row per pcap file,
+#   one column per qname of the vocabulary (1 if the qname was queried)
+# - y.npy: the label of each row, as an index in the categories
+# - meta.json: {"qname_types": [...], "vocabulary": {"<qname_type>": [qnames, in the order of their IDs]}, "categories": [...]}
+# The IDs are given on the fly and never change: new runs are appended without rebuilding the vocabulary
+# (the columns of the new qnames are added at the end, empty for the previous rows)
+# See ml/utils.py (Dataset) for the reading part
+QNAME_STORE_EXTENSION = ".dns_str"
+
+
+def is_qname_store(path: str) -> bool:
+    return path.rstrip("/").endswith(QNAME_STORE_EXTENSION)
+
+
+class QnameEncoder(object):
+    """
+    Streaming one-hot encoder of the qnames queried in each pcap file
+    (each row only keeps the IDs of its qnames, no dense line the width of the vocabulary)
+
+    The qnames are the nodes of a QnameIndex: the vocabularies of the qname types (complete, 4, 3)
+    are lists of nodes, the names are only used when saving
+    """
+    def __init__(self, qname_types: list):
+        self.qname_types = list(qname_types)
+        self.index = QnameIndex()
+        self.categories = []
+        self.labels = []
+        # qname type -> node -> ID (= index of the column)
+        self.indexes = {}
+        # qname type -> nodes, in the order of their IDs
+        self.vocabulary = {}
+        # qname type -> CSR buffers (column IDs of all the rows, start of each row in indices)
+        self.indices = {}
+        self.indptr = {}
+        # rows loaded from an existing store, see load
+        self.previous = {}
+        self.nb_previous_rows = 0
+        for qt in self.qname_types:
+            self.indexes[qt] = {}
+            self.vocabulary[qt] = []
+            self.indices[qt] = []
+            self.indptr[qt] = [0]
+
+    def get_index(self, qname_type: str, node: int) -> int:
+        indexes = self.indexes[qname_type]
+        if node not in indexes:
+            indexes[node] = len(self.vocabulary[qname_type])
+            self.vocabulary[qname_type].append(node)
+        return indexes[node]
+
+    def get_names(self, qname_type: str) -> list:
+        """
+        The qnames of the vocabulary, in the order of their IDs
+        """
+        return [self.index.get_name(node) for node in self.vocabulary[qname_type]]
+
+    def add_qnames(self, qname_type: str, nodes: list):
+        """
+        Only adding qnames to the vocabulary (eg: queries after max_nb_query, not in the row)
+        """
+        for node in nodes:
+            self.get_index(qname_type, node)
+
+    def append(self, label: str, nodes: dict):
+        """
+        New row: nodes is a qname type -> list of qnames (nodes of self.index) dict
+        """
+        if label not in self.categories:
+            self.categories.append(label)
+        self.labels.append(self.categories.index(label))
+        for qt in self.qname_types:
+            ids = {self.get_index(qt, node) for node in nodes[qt]}
+            self.indices[qt] += sorted(ids)
+            self.indptr[qt].append(len(self.indices[qt]))
+
+    def merge(self, other):
+        """
+        Appending the rows of another encoder (eg: encoded by another process), with the IDs of this vocabulary
+        (the qnames of other are added in the order of its IDs: same vocabulary as if its rows were appended here)
+        """
+        for qt in self.qname_types:
+            ids = [self.get_index(qt, self.index.get_id(qname)) for qname in other.get_names(qt)]
+            for row in other.get_rows(qt):
+                self.indices[qt] += sorted(ids[i] for i in row)
+                self.indptr[qt].append(len(self.indices[qt]))
+        for label in other.get_new_labels():
+            if label not in self.categories:
+                self.categories.append(label)
+            self.labels.append(self.categories.index(label))
+
+    def get_matrix(self, qname_type: str) -> scipy.sparse.csr_matrix:
+        nb_columns = len(self.vocabulary[qname_type])
+        nb_new_rows = len(self.indptr[qname_type]) - 1
+        X = scipy.sparse.csr_matrix(
+            (
+                np.ones(len(self.indices[qname_type]), dtype=np.uint8),
+                np.array(self.indices[qname_type], dtype=np.int32),
+                np.array(self.indptr[qname_type], dtype=np.int64),
+            ),
+            shape=(nb_new_rows, nb_columns)
+        )
+        if qname_type not in self.previous:
+            return X
+        previous = self.previous[qname_type].copy()
+        # the new qnames are empty for the previous rows
+        previous.resize((previous.shape[0], nb_columns))
+        return scipy.sparse.vstack([previous, X], format="csr")
+
+    def get_new_labels(self) -> list:
+        """
+        Labels of the rows appended since the creation/load of the encoder
+        """
+        return [self.categories[y] for y in self.labels[self.nb_previous_rows:]]
+
+    def get_rows(self, qname_type: str):
+        """
+        IDs of the qnames of each row (only the ones appended since the creation/load of the encoder)
+        """
+        indptr = self.indptr[qname_type]
+        indices = self.indices[qname_type]
+        for i in range(len(indptr) - 1):
+            yield indices[indptr[i]:indptr[i+1]]
+
+    def load(self, path: str):
+        """
+        Appending to an existing store: keeping its vocabulary (and thus its IDs), categories and rows
+        """
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["qname_types"] != self.qname_types:
+            logging.error(f"The qname types of {path} are not the same: {meta['qname_types']} != {self.qname_types}")
+            raise ValueError
+        self.categories = list(meta["categories"])
+        self.labels = [int(y) for y in np.load(os.path.join(path, "y.npy"))]
+        self.nb_previous_rows = len(self.labels)
+        for qt in self.qname_types:
+            for qname in meta["vocabulary"][qt]:
+                self.get_index(qt, self.index.get_id(qname))
+            self.previous[qt] = scipy.sparse.load_npz(os.path.join(path, f"X_{qt}.npz")).tocsr()
+        logging.debug(f"Qname store loaded: {path} ({len(self.labels)} rows)")
+
+    def save(self, path: str):
+        # (writing everything in a new directory, in case the save is interrupted)
+        tmp_path = path.rstrip("/") + ".tmp"
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for qt in self.qname_types:
+            scipy.sparse.save_npz(os.path.join(tmp_path, f"X_{qt}.npz"), self.get_matrix(qt))
+        np.save(os.path.join(tmp_path, "y.npy"), np.array(self.labels, dtype=np.int32))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            vocabulary = {qt: self.get_names(qt) for qt in self.qname_types}
+            json.dump({"qname_types": self.qname_types, "vocabulary": vocabulary, "categories": self.categories}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        logging.debug(f"Qname store saved: {path} ({len(self.labels)} rows)")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import logging
+
+import trio
+
+from utils import *
+from ReplayCapture import *
+from ReplayScheduler import *
+from ReplayPool import *
+
+
+class ReplayBatch(object):
+    """
+    Replay of several files (eg: all the files of a run) by a single process:
+    the queries of all the files go in one global schedule, sharing the capture,
+    the rate limiters of the resolvers and the connection pool (the ports are leased
+    by the process, and the IPs of the resolvers are resolved once if the replays share the resolvers)
+
+    Each file still gets its own replayed pcap, written as soon as all its queries are done
+    (all the replays of a batch must use the same resolvers and replay settings)
+    """
+    def __init__(self, replays: list):
+        self.replays = replays
+        # index of the replay -> number of its queries still to replay
+        self.nb_remaining = {}
+        # index of the replay -> number of its queries which failed (replayed again when resuming)
+        self.nb_failed = {}
+        # maximum number of queries replayed at the same time (see get_max_in_flight)
+        self.limiter = None
+
+    def replay_all(self):
+        schedule = []
+        for i in range(len(self.replays)):
+            replay_schedule = self.replays[i].get_schedule()
+            if self.replays[i].manifest.complete:
+                continue
+            self.nb_remaining[i] = len(replay_schedule)
+            self.nb_failed[i] = 0
+            schedule += [(delay, (i, index)) for delay, index in replay_schedule]
+        if len(self.nb_remaining) == 0:
+            return
+        logging.info(f"--- Replaying {len(schedule)} queries from {len(self.nb_remaining)} files")
+
+        # sniffing all the replayed queries at once, see PcapReplay.replay_single_pkt
+        first = self.replays[0]
+        capture = ReplayCapture(first.iface, first.get_bpf())
+        for replay in self.replays:
+            replay.capture = capture
+        capture.start()
+        # a single event loop for all the queries (instead of one thread + event loop per query)
+        trio.run(self.replay_scheduled, schedule)
+        capture.stop()
+
+    def get_max_in_flight(self) -> int:
+        """
+        While it is sent, each query holds a port per resolver in the range of each padding strategy (see PcapReplay.send):
+        keeping half of the smallest range for the ports in TIME_WAIT (eg: with --asap, all the queries are due at once)
+        """
+        first = self.replays[0]
+        min_range_size = min(r[1] - r[0] for r in (first.padding_strategies[p]['ports'] for p in first.padding_strategies))
+        return max(1, min_range_size // first.nb_resolvers // 2)
+
+    async def replay_scheduled(self, schedule: list):
+        first = self.replays[0]
+        # (also needs to be created inside the event loop)
+        self.limiter = trio.CapacityLimiter(self.get_max_in_flight())
+        # the rate limiters need to be created inside the event loop
+        resolvers_buckets = {}
+        for resolver_type in first.resolvers:
+            for resolver in first.resolvers[resolver_type]:
+                resolvers_buckets[f"{resolver_type}_{resolver['name']}"] = TokenBucket(first.resolver_rate, first.resolver_burst)
+        pool = None
+        if first.pooled:
+            pool = ReplayPool(get_ip_address(first.iface), first.max_nb_retries, verify=first.verify)
+        for replay in self.replays:
+            replay.resolvers_buckets = resolvers_buckets
+            replay.pool = pool
+
+        # files with nothing left to replay (eg: interrupted once all the queries were saved)
+        for i in self.nb_remaining:
+            if self.nb_remaining[i] == 0:
+                await trio.to_thread.run_sync(self.replays[i].write_output)
+        await run_at_offsets(schedule, self.replay_query)
+        if pool != None:
+            await pool.aclose()
+
+    async def replay_query(self, item: tuple):
+        i, index = item
+        replay = self.replays[i]
+        async with self.limiter:
+            try:
+                await replay.replay_single_pkt(index)
+            except Exception as e:
+                # eg: no port available, one query should not stop the whole batch
+                # (not checkpointed: replayed again when resuming, see ReplayManifest)
+                logging.error(f"Replay failed for query {index} of {replay.input_pcap} ({repr(e)})")
+                replay.capture.pop_packets((replay.input_pcap, index))
+                self.nb_failed[i] += 1
+        self.nb_remaining[i] -= 1
+        if self.nb_remaining[i] == 0:
+            if self.nb_failed[i] > 0:
+                logging.error(f"{self.nb_failed[i]} queries failed, run again to resume the replay of {replay.input_pcap}")
+                return
+            # (in a thread, so the other queries are still fired on time)
+            await trio.to_thread.run_sync(replay.write_output)
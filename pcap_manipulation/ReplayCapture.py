@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import sys
+import logging
+
+# required before other imports (yes; see: https://stackoverflow.com/a/20280587)
+logging.basicConfig(
+    format='%(message)s',
+    level=logging.INFO,
+    stream=sys.stdout
+)
+
+import time
+import heapq
+import bisect
+import signal
+import threading
+import subprocess
+
+# using dpkt instead of Scapy for performance
+import dpkt
+
+
+class ReplayCapture(object):
+    """
+    A single tshark capture for a whole replay (instead of one per replayed query)
+
+    tshark writes the packets on its standard output, they are read by a thread
+    and dispatched in memory to the replayed queries using their source ports:
+    each query registers the ports reserved for it when it uses them (see PcapReplay.send),
+    and a packet goes to the last query which registered its port before the packet was captured
+    (ports are picked randomly, so the same port may be reused by another query later on)
+    """
+    def __init__(self, iface: str, bpf: str, flush_delay: float = 1):
+        self.iface = iface
+        self.bpf = bpf
+        # waiting for the last packets to be written by tshark before stopping it
+        self.flush_delay = flush_delay
+
+        self.lock = threading.Lock()
+        # port -> ([registration times], [keys]), in chronological order
+        self.registrations = {}
+        # key -> [(ts, buf, local port, is the local port the source), ...]
+        self.packets = {}
+        self.nb_unknown_packets = 0
+        # keys whose packets were already taken (see pop_packets)
+        self.closed_keys = set()
+        self.nb_late_packets = 0
+
+        self.process = None
+        self.reader_thread = None
+
+    def get_capture_call(self) -> list:
+        # "-F pcap" as dpkt.pcap.Reader is able to read a stream (pcapng blocks are not written as a stream)
+        # "-l" to flush each packet, the packets of a query are taken as soon as it is done (see pop_packets)
+        return ["tshark", "-i", self.iface, "-f", self.bpf, "-w", "-", "-F", "pcap", "-q", "-l"]
+
+    def start(self):
+        logging.info(f"--- Capturing on {self.iface} with filter: {self.bpf}")
+        self.process = subprocess.Popen(self.get_capture_call(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # tshark tells us when it's actually capturing (instead of sleeping for a while)
+        for line in self.process.stderr:
+            if b"Capturing on" in line:
+                break
+        else:
+            logging.error(f"The capture did not start ({self.get_capture_call()})")
+            raise RuntimeError
+        self.reader_thread = threading.Thread(target=self.read, daemon=True)
+        self.reader_thread.start()
+
+    def stop(self):
+        time.sleep(self.flush_delay)
+        if self.process.poll() == None:
+            # (using this instead of popen.kill to avoid `dumpcap` processes staying there for no reason)
+            self.process.send_signal(signal.SIGTERM)
+        self.reader_thread.join()
+        self.process.wait()
+        if self.nb_unknown_packets > 0:
+            logging.error(f"{self.nb_unknown_packets} captured packets do not belong to any replayed query")
+        if self.nb_late_packets > 0:
+            logging.error(f"{self.nb_late_packets} captured packets arrived after their query was saved")
+
+    def register(self, key, ports: list):
+        """
+        The packets captured from now on, using one of the ports (as source or destination) belong to key
+        """
+        now = time.time()
+        with self.lock:
+            self.packets.setdefault(key, [])
+            for port in ports:
+                times, keys = self.registrations.setdefault(port, ([], []))
+                times.append(now)
+                keys.append(key)
+
+    def get_key(self, port: int, ts: float):
+        if port not in self.registrations:
+            return None
+        times, keys = self.registrations[port]
+        i = bisect.bisect_right(times, ts)
+        if i == 0:
+            return None
+        return keys[i-1]
+
+    def dispatch(self, ts: float, buf: bytes):
+        eth = dpkt.ethernet.Ethernet(buf)
+        if not isinstance(eth.data, dpkt.ip.IP) or type(eth.data.data) != dpkt.tcp.TCP:
+            return
+        tcp = eth.data.data
+        with self.lock:
+            port, is_up = tcp.sport, True
+            key = self.get_key(port, ts)
+            if key == None:
+                port, is_up = tcp.dport, False
+                key = self.get_key(port, ts)
+            if key == None:
+                self.nb_unknown_packets += 1
+                return
+            if key in self.closed_keys:
+                self.nb_late_packets += 1
+                return
+            self.packets[key].append((ts, buf, port, is_up))
+
+    def read(self):
+        try:
+            for ts, buf in dpkt.pcap.Reader(self.process.stdout):
+                self.dispatch(ts, buf)
+        except (dpkt.dpkt.NeedData, ValueError):
+            # the capture was stopped while writing a packet (or before writing anything)
+            pass
+
+    def get_packets(self, key) -> list:
+        with self.lock:
+            return self.packets.get(key, [])
+
+    def pop_packets(self, key) -> list:
+        """
+        Same as get_packets, for a query which is done: the packets are not kept in memory anymore,
+        and the ones captured afterwards are dropped
+        """
+        with self.lock:
+            self.closed_keys.add(key)
+            return self.packets.pop(key, [])
+
+
+def rebase_sessions(original_time: float, packets: list) -> list:
+    """
+    Groups the packets of a replayed query (see ReplayCapture.get_packets) by session (local port)
+    and makes each session start at original_time, using its first packet as point of reference
+
+    NOTE: using only the first packet of the query does not yield correct results
+    because there *IS* a time shift between each session, and at the end, the last session
+    may produce false data (eg: an IAT of 1 instead of 0)
+
+    Returns one list of (ts, buf) per session, each sorted by time
+    """
+    if len(packets) == 0:
+        return []
+    first_time = min(p[0] for p in packets)
+
+    sessions = {}
+    for p in packets:
+        sessions.setdefault(p[2], []).append(p)
+
+    res = []
+    for port in sessions:
+        ref_time = None
+        rebased = []
+        # the capture is mostly, but not always, in chronological order (sort is stable)
+        for ts, buf, _, is_up in sorted(sessions[port], key=lambda p: p[0]):
+            # setting the reference time for the first packet sent from the port
+            if is_up and ref_time == None:
+                ref_time = ts
+            if ref_time == None:
+                # if somehow the first message encountered is an answer, the session did not start yet:
+                # using the first packet of the query instead
+                rebased.append((original_time + ts - first_time, buf))
+            else:
+                rebased.append((original_time + ts - ref_time, buf))
+        rebased.sort(key=lambda p: p[0])
+        res.append(rebased)
+    return res
+
+
+def merge_sessions(sessions: list):
+    """
+    k-way merge (heap) of time-ordered sessions into a single time-ordered stream of (ts, buf)
+    """
+    return heapq.merge(*sessions, key=lambda p: p[0])
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import heapq
+import struct
+import logging
+
+# classic pcap headers, see https://wiki.wireshark.org/Development/LibpcapFileFormat
+PCAP_FILE_HEADER = struct.Struct("<IHHiIII")
+PCAP_PKT_HEADER = struct.Struct("<IIII")
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_ETHERNET = 1
+
+
+class ReplayManifest(object):
+    """
+    Checkpoints of a replay, so an interrupted replay only replays the missing queries
+
+    - `<output>.part`: the (rebased) packets of each replayed query, appended as soon as it is done (pcap)
+    - `<output>.manifest`: one JSON line per replayed query, with the size of the .part file once appended
+    (first line: the input file and the number of queries to replay, last line once the output is written: complete)
+
+    The manifest line is written after the packets: if the replay stops in between,
+    the .part file is truncated back to the last recorded size when resuming
+
+    Both files are next to the output, or in manifest_dir (eg: to keep the directory of the replayed files clean)
+    """
+    def __init__(self, output_pcap: str, manifest_dir: str = None):
+        if manifest_dir != None:
+            output_pcap = os.path.join(manifest_dir, os.path.basename(output_pcap))
+        self.manifest_path = f"{output_pcap}.manifest"
+        self.part_path = f"{output_pcap}.part"
+        # index of the query -> (start, end) of its packets in the .part file
+        self.done = {}
+        self.complete = False
+        self.part_file = None
+        self.manifest_file = None
+
+    def is_complete(self) -> bool:
+        """
+        Without loading the manifest (eg: to skip a file before reading it)
+        """
+        if not os.path.exists(self.manifest_path):
+            return False
+        with open(self.manifest_path) as f:
+            lines = f.read().splitlines()
+        return len(lines) > 0 and lines[-1] == json.dumps({"complete": True})
+
+    def load(self, input_pcap: str, nb_queries: int):
+        """
+        Resume from the existing manifest, if it is about the same replay (otherwise, starting over)
+        """
+        lines = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in f:
+                    try:
+                        lines.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # the last line was being written
+                        break
+        if len(lines) == 0 or lines[0] != {"input": input_pcap, "nb_queries": nb_queries}:
+            self.reset(input_pcap, nb_queries)
+            return
+
+        size = PCAP_FILE_HEADER.size
+        for entry in lines[1:]:
+            if entry.get('complete', False):
+                self.complete = True
+            else:
+                self.done[entry['index']] = (size, entry['size'])
+                size = entry['size']
+        logging.info(f"--- Resuming replay: {len(self.done)}/{nb_queries} queries already replayed ({self.manifest_path})")
+        if self.complete:
+            return
+        if not os.path.exists(self.part_path):
+            logging.error(f"{self.part_path} is missing, starting over")
+            self.done = {}
+            self.reset(input_pcap, nb_queries)
+            return
+        # dropping what was written after the last checkpoint
+        with open(self.part_path, "r+b") as f:
+            f.truncate(size)
+        # rewriting the manifest without the possibly truncated last line
+        with open(self.manifest_path, "w") as f:
+            for entry in lines:
+                f.write(json.dumps(entry) + "\n")
+        self.open()
+
+    def reset(self, input_pcap: str, nb_queries: int):
+        with open(self.manifest_path, "w") as f:
+            f.write(json.dumps({"input": input_pcap, "nb_queries": nb_queries}) + "\n")
+        with open(self.part_path, "wb") as f:
+            f.write(PCAP_FILE_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, 262144, LINKTYPE_ETHERNET))
+        self.open()
+
+    def open(self):
+        self.part_file = open(self.part_path, "ab")
+        self.manifest_file = open(self.manifest_path, "a")
+
+    def is_done(self, index: int) -> bool:
+        return index in self.done
+
+    def append(self, index: int, packets):
+        """
+        Checkpoint a replayed query: packets is an iterable of (ts, buf), in chronological order
+        """
+        start = self.part_file.tell()
+        for ts, buf in packets:
+            sec = int(ts)
+            usec = min(round((ts - sec) * 1e6), 999999)
+            self.part_file.write(PCAP_PKT_HEADER.pack(sec, usec, len(buf), len(buf)))
+            self.part_file.write(buf)
+        self.part_file.flush()
+        os.fsync(self.part_file.fileno())
+        end = self.part_file.tell()
+        self.manifest_file.write(json.dumps({"index": index, "size": end}) + "\n")
+        self.manifest_file.flush()
+        os.fsync(self.manifest_file.fileno())
+        self.done[index] = (start, end)
+
+    def read_query(self, data: bytes, start: int, end: int) -> list:
+        packets = []
+        while start < end:
+            sec, usec, caplen, _ = PCAP_PKT_HEADER.unpack_from(data, start)
+            start += PCAP_PKT_HEADER.size
+            packets.append((sec + usec / 1e6, data[start:start + caplen]))
+            start += caplen
+        return packets
+
+    def get_packets(self):
+        """
+        k-way merge of the checkpointed queries (each in chronological order): all the packets, in chronological order
+        """
+        with open(self.part_path, "rb") as f:
+            data = f.read()
+        queries = [self.read_query(data, start, end) for start, end in self.done.values()]
+        return heapq.merge(*queries, key=lambda p: p[0])
+
+    def finish(self):
+        """
+        To call once the output is written: the replay of the file is complete, the .part file is not needed anymore
+        """
+        self.part_file.close()
+        self.manifest_file.write(json.dumps({"complete": True}) + "\n")
+        self.manifest_file.close()
+        os.remove(self.part_path)
+        self.complete = True
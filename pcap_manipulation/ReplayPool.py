@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import ssl
+import socket
+
+import trio
+import httpx
+
+import dns.inet
+import dns.asyncquery
+import dns.asyncbackend
+from dns.query import _have_http2
+
+from utils import *
+
+
+def get_dot_ssl_context(verify: bool = True) -> ssl.SSLContext:
+    """
+    Same TLS context as dns.asyncquery.tls, without checking the certificate if not verify
+    (eg: self-signed certificate of LocalResolver)
+    """
+    ssl_context = ssl.create_default_context()
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    ssl_context.check_hostname = False
+    if not verify:
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+class ReplayPool(object):
+    """
+    Warm connections reused by all the replayed queries ("pooled" replay mode, see PcapReplay)
+
+    There is one connection per (padding strategy, resolver), always bound to the same local port,
+    reserved once in the range of the padding strategy: the flows are still tagged by their port
+    (see PcapHelper.padding_strategies), but the TCP/TLS handshakes are only done once
+    (which is not what a real device would do: only use it for bulk/load runs)
+    """
+    def __init__(self, source: str, max_nb_retries: int, verify: bool = True, settle_delay: float = 0.25):
+        self.source = source
+        self.max_nb_retries = max_nb_retries
+        # verifying the certificates of the DoH resolvers
+        self.verify = verify
+        # key -> reserved local port
+        self.ports = {}
+        # key -> opened socket keeping the port reserved until the connection is made
+        self.reserved_sockets = {}
+        # key -> httpx.AsyncClient (DoH) or connected TLS socket (DoT)
+        self.clients = {}
+        self.sockets = {}
+        # a connection is only used by one query at a time (see get_lock)
+        self.locks = {}
+        # time the connection stays with a query after its answer (Linux delays the ACKs up to 200ms)
+        self.settle_delay = settle_delay
+
+    def get_port(self, key: str, ports_range: list) -> int:
+        if key not in self.ports:
+            s = get_opened_socket_in_range(ports_range)
+            self.reserved_sockets[key] = s
+            self.ports[key] = get_socket_port(s)
+        return self.ports[key]
+
+    def release_port(self, key: str):
+        # closing the socket so the port is not bound anymore (the connection is about to use it)
+        if key in self.reserved_sockets:
+            self.reserved_sockets.pop(key).close()
+
+    def get_lock(self, key: str) -> trio.Lock:
+        """
+        To hold while a query uses the connection of key: the captured packets are dispatched
+        to the queries by local port (see ReplayCapture), which is the same for all the queries of the connection
+        (also, DoT sockets can only be used by one query at a time)
+        """
+        return self.locks.setdefault(key, trio.Lock())
+
+    def get_client(self, key: str) -> httpx.AsyncClient:
+        if key not in self.clients:
+            self.release_port(key)
+            transport = dns.asyncbackend.get_backend("trio").get_transport_class()(
+                local_address=self.source,
+                local_port=self.ports[key],
+                http1=True,
+                http2=_have_http2,
+                retries=self.max_nb_retries,
+                verify=self.verify,
+                # a single connection (a single local port), kept opened between queries
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1, keepalive_expiry=None),
+            )
+            self.clients[key] = httpx.AsyncClient(http1=True, http2=_have_http2, verify=self.verify, transport=transport)
+        return self.clients[key]
+
+    async def https(self, key: str, q, endpoint: str):
+        return await dns.asyncquery.https(q, endpoint, client=self.get_client(key))
+
+    async def tls(self, key: str, q, where: str, port: int = 853):
+        """
+        (the caller holds the lock of key, see get_lock)
+        """
+        if key not in self.sockets:
+            self.release_port(key)
+            self.sockets[key] = await dns.asyncbackend.get_backend("trio").make_socket(
+                dns.inet.af_for_address(where),
+                socket.SOCK_STREAM,
+                0,
+                (self.source, self.ports[key]),
+                (where, port),
+                None,
+                get_dot_ssl_context(self.verify),
+            )
+        try:
+            return await dns.asyncquery.tls(q, where, port=port, sock=self.sockets[key])
+        except Exception:
+            # eg: the resolver closed the (idle) connection, it is opened again by the next query
+            await self.sockets.pop(key).close()
+            raise
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        for s in self.sockets.values():
+            await s.close()
+        for s in self.reserved_sockets.values():
+            s.close()
+        for port in self.ports.values():
+            release_port_lease(port)
+        self.clients = {}
+        self.sockets = {}
+        self.reserved_sockets = {}
+        self.ports = {}
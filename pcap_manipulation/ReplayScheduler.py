@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import heapq
+
+import trio
+
+
+class TokenBucket(object):
+    """
+    Async rate limiter: at most `rate` acquisitions per second on average,
+    with bursts of at most `burst` acquisitions
+    (eg: so a DNS resolver does not see the replay as a DDOS attempt)
+
+    The waiting tasks are served in order (trio.Lock is fair)
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = None
+        self.lock = trio.Lock()
+
+    def refill(self):
+        now = trio.current_time()
+        if self.last != None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self):
+        if not self.rate:
+            # no limit
+            return
+        async with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                await trio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+
+async def run_at_offsets(schedule: list, fx, *args):
+    """
+    Single event loop scheduler (heap): for each (offset, item) in schedule,
+    starts fx(item, *args) as a new task `offset` seconds after the call,
+    and returns once all the tasks are done
+    """
+    heap = list(schedule)
+    heapq.heapify(heap)
+    start = trio.current_time()
+    async with trio.open_nursery() as nursery:
+        while len(heap) > 0:
+            offset, item = heapq.heappop(heap)
+            await trio.sleep_until(start + offset)
+            nursery.start_soon(fx, item, *args)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import socket
+import logging
+
+import dns.resolver
+
+
+def resolve_endpoint(endpoint: str) -> tuple:
+    """
+    IPs of the endpoint of a resolver (an IP, a hostname or an URI), with the TTL of the DNS answer
+    (None if the endpoint is already an IP address)
+    """
+    try:
+        socket.inet_aton(endpoint)
+        return [endpoint], None
+    except socket.error:
+        hostname = endpoint.replace('https://', '').split('/')[0]
+        answer = dns.resolver.resolve(hostname, 'a')
+        return [i.to_text() for i in answer], answer.rrset.ttl
+
+
+class ResolversCache(object):
+    """
+    IPs of the endpoints of the resolvers, saved in one JSON file per run (eg: data/resolvers_ips/<RUN_ID>.json)
+
+    Written at replay time: an endpoint is only resolved again once the TTL of its DNS answer is over
+    (eg: when the replay of the run is resumed the next day), and all the IPs it had during the run are kept.
+    Loaded read only by the extractors: they use exactly the IPs that were live during the replay,
+    without any DNS lookup (only an endpoint missing from the file is resolved, with an error;
+    without the file, eg: a run replayed before the resolvers cache, see PcapHelper.set_resolvers_IPs)
+
+    {"<endpoint>": {"ips": [all the IPs seen], "current": [IPs of the last answer], "resolved_at": epoch, "expires": epoch}}
+    """
+    def __init__(self, path: str, read_only: bool = False, min_ttl: int = 60):
+        self.path = path
+        self.read_only = read_only
+        # (some resolvers answer with a TTL of a few seconds)
+        self.min_ttl = min_ttl
+        self.entries = {}
+        self.missing = not os.path.exists(path)
+        if not self.missing:
+            with open(path) as f:
+                self.entries = json.load(f)
+        elif read_only:
+            logging.warning(f"No resolvers cache in {path} (using the hardcoded IPs of the resolvers)")
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname != "":
+            os.makedirs(dirname, exist_ok=True)
+        # (not leaving a half written file if interrupted)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get_ips(self, endpoint: str) -> list:
+        """
+        Read only: all the IPs the endpoint had during the replay
+        Otherwise: its current IPs, from the cache until the TTL is over
+        """
+        entry = self.entries.get(endpoint)
+        if self.read_only and entry != None:
+            return entry['ips']
+        now = time.time()
+        if entry != None and entry['expires'] > now:
+            return entry['current']
+
+        ips, ttl = resolve_endpoint(endpoint)
+        logging.debug(f"[-] ResolversCache {endpoint} -> {ips} (ttl: {ttl})")
+        if ttl == None:
+            # an IP address, nothing to cache
+            return ips
+        if self.read_only:
+            logging.error(f"{endpoint} not in the resolvers cache {self.path}, resolved: {ips}")
+            return ips
+        previous_ips = [] if entry == None else entry['ips']
+        self.entries[endpoint] = {
+            "ips": sorted(set(previous_ips + ips)),
+            "current": ips,
+            "resolved_at": now,
+            "expires": now + max(ttl, self.min_ttl),
+        }
+        self.save()
+        return ips
@@ -0,0 +1,48 @@
+import struct
+
+TLS_RECORD_HEADER_LENGTH = 5
+TLS_APPLICATION_DATA = 23
+# change_cipher_spec, alert, handshake, application_data (the ones known by Scapy)
+TLS_CONTENT_TYPES = (20, 21, 22, 23)
+# major version of TLS (and SSLv3): 3.x
+TLS_MAJOR_VERSION = 3
+
+
+def scan_app_data_records(payload) -> list[int]:
+    """
+    Lengths of the TLS application data records of a TCP segment (any bytes-like object),
+    without decrypting nor dissecting anything: only the 5-byte record headers are read
+    (content type, version, length), the record bodies are skipped.
+
+    Only done when Scapy is known to find the same records (see PcapExtract.get_app_data_lengths_scapy,
+    which dissects each segment on its own), ie: when the segment is either
+    - a chain of complete application data records (eg: all the segments after the handshake)
+    - or a chain of other records, the last one possibly continued in the next segments
+    (eg: ClientHello, ServerHello + Certificate...), in which case there is no application data
+    Returns None for any other segment, which has to be dissected by Scapy:
+    - other records followed by application data (Scapy also counts them, eg: ChangeCipherSpec + Finished),
+    or application data following a ServerHello (Scapy does not count them in TLS 1.3)
+    - application data records spanning multiple segments, or a segment which does not start with a record
+    - empty application data records (not always counted by Scapy, eg: at the end of a segment)
+    """
+    size = len(payload)
+    lengths = []
+    other_records = False
+    offset = 0
+    while offset < size:
+        if size - offset < TLS_RECORD_HEADER_LENGTH:
+            return None
+        content_type = payload[offset]
+        if content_type not in TLS_CONTENT_TYPES or payload[offset + 1] != TLS_MAJOR_VERSION:
+            return None
+        record_length, = struct.unpack_from("!H", payload, offset + 3)
+        offset += TLS_RECORD_HEADER_LENGTH + record_length
+        if content_type == TLS_APPLICATION_DATA:
+            if offset > size or record_length == 0:
+                return None
+            lengths.append(record_length)
+        else:
+            other_records = True
+    if other_records and len(lengths) > 0:
+        return None
+    return lengths
@@ -22,10 +22,13 @@ logging.basicConfig(
 
 import time
 import json
+from decimal import Decimal
 from datetime import datetime
 
 from scapy.all import *
 
+from PortLeases import PortLeases
+
 ######################################
 # Meta 
 ######################################
@@ -76,30 +79,37 @@ def get_ip_address(ifname: str) -> str:
     )[20:24])
 
 
+# shared by all the replay processes of the host (see PortLeases)
+PORT_LEASES_PATH = "/tmp/doh_iot_port_leases"
+port_leases = None
+
+def get_port_leases() -> PortLeases: 
+    global port_leases
+    if port_leases == None: 
+        port_leases = PortLeases(PORT_LEASES_PATH)
+    return port_leases
+
+
 def get_opened_socket_in_range(r: list[int]):
     """
     Return an opened socket in the range specified in parameters
 
-    NOTE: this *will* create an infinite loop if no port is available
+    The port is leased (see PortLeases) until release_port_lease is called:
+    other replay processes do not get it in the meantime
     """
     if len(r) != 2: 
         logging.error(f"Do you know what a range is ({r} should have 2 values only)")
         raise ValueError
-    min_port = r[0]
-    max_port = r[1]
 
-    logging.debug(f"--- Socket potential range: [{min_port};{max_port}]")
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    not_found = True 
-    while not_found:
-        try:
-            port = unseeded_random_generator.randrange(min_port, max_port)
-            s.bind(('', port))
-            not_found = False
-        except OSError:
-            pass 
-    return s 
+    logging.debug(f"--- Socket potential range: [{r[0]};{r[1]}]")
+    return get_port_leases().acquire(r)
+
+
+def release_port_lease(port: int): 
+    """
+    To call once the connection using the port is closed
+    """
+    get_port_leases().release(port)
 
 
 def get_opened_socket(): 
@@ -142,6 +152,15 @@ def get_relative_seconds(d: datetime) -> int:
     return d.hour * 3600 + d.minute * 60 + d.second 
 
 
+def round_time_delta(delta: float, ndigits: int = 1) -> float:
+    """
+    Rounds a difference of (float) timestamps exactly like Scapy does with its decimal timestamps:
+    the float noise is removed by going back to the microsecond precision of the capture,
+    then the value is rounded half to even 
+    """
+    return float(round(Decimal(f"{delta:.6f}"), ndigits))
+
+
 def get_rnd_chars(n): 
     return ''.join(unseeded_random_generator.choice(string.ascii_uppercase + string.digits) for _ in range(n))
 
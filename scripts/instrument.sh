@@ -62,6 +62,22 @@ conda activate ucl_trio
 
 # by default, setting ONLINE to false if it's not set by config files
 if [ -z ${ONLINE+x} ]; then ONLINE=false; fi
+# by default, only the CSV files are generated (set FEATURE_STORE to true to also use the binary feature stores)
+if [ -z ${FEATURE_STORE+x} ]; then FEATURE_STORE=false; fi
+# by default, extractfeatures, extractall and distrib read each pair of files once, all together (see ExtractEngine)
+# set SINGLE_PASS to false to run PcapExtract, PcapExtractAll and PcapDistribution separately
+if [ -z ${SINGLE_PASS+x} ]; then SINGLE_PASS=true; fi
+# number of seeds run in parallel by each ML process, and if the seeds reuse the hyperparameters search of the first one 
+if [ -z ${MAX_PARALLEL_SEEDS+x} ]; then MAX_PARALLEL_SEEDS=1; fi
+if [ -z ${SHARE_SEARCH+x} ]; then SHARE_SEARCH=false; fi
+# set FORCE_SEARCH to true to ignore the results of previous hyperparameters searches (see HYPERPARAMETERS_CACHE_PATH)
+if [ -z ${FORCE_SEARCH+x} ]; then FORCE_SEARCH=false; fi
+# set REPLAY_POOLED to true to reuse warm connections across replayed queries (bulk/load runs only, see ReplayPool)
+if [ -z ${REPLAY_POOLED+x} ]; then REPLAY_POOLED=false; fi
+# replay clock: by default, the queries are replayed at their original time of the day (up to 24h)
+# set REPLAY_SPEEDUP (eg: 60) to compress the timeline, or REPLAY_ASAP to true to replay everything right away
+if [ -z ${REPLAY_SPEEDUP+x} ]; then REPLAY_SPEEDUP=""; fi
+if [ -z ${REPLAY_ASAP+x} ]; then REPLAY_ASAP=false; fi
 
 
 DEBUG_FILE="debug_$RUN_ID.log"
@@ -71,6 +87,8 @@ DNS_ONLY_REMOTE_PATH="/home/samuel/doh_inria/dns_only/" # path on the remote ser
 RAW_PATH="data/raw/$RUN_ID/"
 DNS_ONLY_PATH="data/dns_only/"
 REPLAYED_PATH="data/replayed/"
+REPLAY_MANIFESTS_PATH="data/replay_manifests/"
+RESOLVERS_CACHE="data/resolvers_ips/$RUN_ID.json" # IPs of the resolvers during the replay of the run (see ResolversCache.py)
 
 RESOLVERS_CONFIG="pcap_manipulation/configs/resolvers.json"
 REPLAY_CONFIG="pcap_manipulation/configs/replay.json"
@@ -84,11 +102,14 @@ CSV_PATH="data/csv/"
 CSV_PATH_WITH_ID="$CSV_PATH$RUN_ID/"
 CSV_FINAL_FILE="$CSV_PATH_WITH_ID"all.csv
 CSV_FINAL_FILE_DNS_STR="$CSV_PATH_WITH_ID"dns_str.csv
+FEATURES_FINAL_FILE="$CSV_PATH_WITH_ID"all.features
 RESULTS_PATH="data/results/$RUN_ID/"
 MODELS_PATH="data/models/$RUN_ID/"
 MODELS_PATH_PREV_RUN_ID="data/models/$REF_RUN_ID/"
 HYPERPARAMETERS_PATH="data/hyperparameters/$RUN_ID/"
+HYPERPARAMETERS_CACHE_PATH="data/hyperparameters/cache/" # shared by all runs
 DISTRIB_PATH="data/distributions/$RUN_ID/"
+DISTRIB_PARTIALS_PATH="data/distributions/partials/" # distributions of each pair of files, reused by the next runs (shared by all runs)
 
 mkdir -p "$CSV_PATH_WITH_ID"
 mkdir -p "$RESULTS_PATH"
@@ -186,36 +207,19 @@ retrieve_files()
 }
 
 
-replay_pcap_files() 
-{   
+set_resolvers_args()
+{
     #
-    # Replay all pcap files corresponding to 1 device
+    # IPs of the resolvers for the extraction: the ones saved at replay time (see ResolversCache.py), 
+    # or the hardcoded ones for the runs replayed before the resolvers cache (no DNS lookups in both cases)
     #
-    DEV="$1"
-
-    REPLAY_COUNT=0
-    for INPUT in "$DNS_ONLY_PATH$DEV/$RUN_ID/"*; do
-        [ -e "$INPUT" ] || continue
-        # creating the directory if necessary
-        mkdir -p "$REPLAYED_PATH$DEV/$RUN_ID"
-        echo "$INPUT"
-        # removing the start of the path, only keeping the filename
-        OUTPUT="$REPLAYED_PATH$DEV/"${INPUT#"$DNS_ONLY_PATH$DEV/"}
-
-        MAC_ADDRESS="${MAC_ADDRESSES[$DEV]}"
-        python3 ./pcap_manipulation/PcapReplay.py -i "$INPUT" -o "$OUTPUT" -rc "$RESOLVERS_CONFIG" -rplc "$REPLAY_CONFIG" -if "$IFACE" -s "$RUN_ID-sslkeylog.log" -mac "$MAC_ADDRESS" &
-        sleep 5 # letting the server breathe
-
-        n=$(($REPLAY_COUNT%"$MAX_PARALLEL_REPLAY"))
-        if [ "$n" -eq $(("$MAX_PARALLEL_REPLAY"-1)) ];then 
-            wait 
-        fi 
-        REPLAY_COUNT=$(("$REPLAY_COUNT"+1))
-    done
-    wait
+    if [ -f "$RESOLVERS_CACHE" ] ; then
+        RESOLVERS_ARGS=(-rca "$RESOLVERS_CACHE")
+    else
+        RESOLVERS_ARGS=(-mr)
+    fi
 }
 
-
 extract_features()
 {
     #
@@ -223,35 +227,73 @@ extract_features()
     # and save them all into one single file, with header
     #
     DEV="$1"
+    set_resolvers_args
     
     CSV_FILE="$CSV_PATH$RUN_ID/$DEV.csv"    
     # 1. Resetting the CSV file to be sure we don't append to already existing data 
     cat /dev/null > "$CSV_FILE"
     
-    # 2. Extract and save the features as CSV
-    COUNT=0
-    for INPUT_ENC in "$REPLAYED_PATH$DEV/$RUN_ID/"*; do
-        [ -e "$INPUT_ENC" ] || continue
-        
-        # removing the start of the path, only keeping the filename
-        INPUT_CLEAR="$DNS_ONLY_PATH$DEV/"${INPUT_ENC#"$REPLAYED_PATH$DEV/"}
+    # also saving the features in a binary feature store (see FeatureStore.py)
+    FEATURE_STORE_ARGS=()
+    if [ "$FEATURE_STORE" = true ] ; then
+        FEATURE_STORE_ARGS=(-of "$CSV_PATH$RUN_ID/$DEV.features")
+    fi
 
-        python3 ./pcap_manipulation/PcapExtract.py \
-            -rc "$RESOLVERS_CONFIG" \
-            -ec "$EXTRACT_CONFIG" \
-            -ie "$INPUT_ENC" \
-            -ic "$INPUT_CLEAR" \
-            -o "$CSV_FILE" \
-            -d "$DEV" \
-            -df "$DEBUG_FILE" &
-        n=$(($COUNT%"$MAX_PARALLEL_EXTRACT"))
-        
-        if [ "$n" -eq $(("$MAX_PARALLEL_EXTRACT"-1)) ];then 
-            wait 
-        fi 
-        COUNT=$(("$COUNT"+1))
-    done
-    wait
+    # 2. Extract and save the features as CSV 
+    # (one process pool per device, the files are paired by filename)
+    python3 ./pcap_manipulation/PcapExtract.py \
+        -rc "$RESOLVERS_CONFIG" \
+        -ec "$EXTRACT_CONFIG" \
+        -ide "$REPLAYED_PATH$DEV/$RUN_ID/" \
+        -idc "$DNS_ONLY_PATH$DEV/$RUN_ID/" \
+        -o "$CSV_FILE" \
+        -d "$DEV" \
+        "${RESOLVERS_ARGS[@]}" \
+        -w "$MAX_PARALLEL_EXTRACT" \
+        "${FEATURE_STORE_ARGS[@]}" \
+        -df "$DEBUG_FILE"
+}
+
+extract_single_pass()
+{
+    #
+    # Extract the features (EXTRACT_FEATURES), *ALL* the features (EXTRACT_FEATURES_ALL) 
+    # and/or the distributions (DISTRIB) from all the replay files corresponding to 1 device, 
+    # reading each pair of files only once 
+    #
+    DEV="$1"
+    set_resolvers_args
+
+    OUTPUT_ARGS=()
+    if [ "$EXTRACT_FEATURES" = true ] ; then
+        # resetting the CSV files to be sure we don't append to already existing data 
+        CSV_FILE="$CSV_PATH$RUN_ID/$DEV.csv"
+        cat /dev/null > "$CSV_FILE"
+        OUTPUT_ARGS+=(-o "$CSV_FILE")
+        if [ "$FEATURE_STORE" = true ] ; then
+            OUTPUT_ARGS+=(-of "$CSV_PATH$RUN_ID/$DEV.features")
+        fi
+    fi
+    if [ "$EXTRACT_FEATURES_ALL" = true ] ; then
+        CSV_FILE_ALL="$CSV_PATH$RUN_ID/$DEV-all.csv"
+        cat /dev/null > "$CSV_FILE_ALL"
+        OUTPUT_ARGS+=(-oa "$CSV_FILE_ALL")
+    fi
+    if [ "$DISTRIB" = true ] ; then
+        OUTPUT_ARGS+=(-od "$DISTRIB_PATH$DEV.json" -pd "$DISTRIB_PARTIALS_PATH$DEV/")
+    fi
+
+    # (one process pool per device, the files are paired by filename)
+    python3 ./pcap_manipulation/ExtractEngine.py \
+        -rc "$RESOLVERS_CONFIG" \
+        -ec "$EXTRACT_CONFIG" \
+        -ide "$REPLAYED_PATH$DEV/$RUN_ID/" \
+        -idc "$DNS_ONLY_PATH$DEV/$RUN_ID/" \
+        -d "$DEV" \
+        "${RESOLVERS_ARGS[@]}" \
+        -w "$MAX_PARALLEL_EXTRACT" \
+        "${OUTPUT_ARGS[@]}" \
+        -df "$DEBUG_FILE"
 }
 
 extract_features_all()
@@ -262,6 +304,7 @@ extract_features_all()
     # and save them all into one single file, with header
     #
     DEV="$1"
+    set_resolvers_args
     
     CSV_FILE="$CSV_PATH$RUN_ID/$DEV-all.csv"    
     # 1. Resetting the CSV file to be sure we don't append to already existing data 
@@ -281,6 +324,7 @@ extract_features_all()
             -ic "$INPUT_CLEAR" \
             -o "$CSV_FILE" \
             -d "$DEV" \
+            "${RESOLVERS_ARGS[@]}" \
             -df "$DEBUG_FILE" &
         n=$(($COUNT%"$MAX_PARALLEL_EXTRACT"))
         if [ "$n" -eq $(("$MAX_PARALLEL_EXTRACT"-1)) ];then 
@@ -369,10 +413,44 @@ fi
 
 if [ "$REPLAY" = true ] ; then
     echo "[REPLAY]"
+    # a single replay process for all the files of all the devices (see ReplayBatch):
+    # one schedule, one capture, and the files already replayed are skipped (see ReplayManifest)
+    REPLAY_ARGS=("--no-pooled")
+    if [ "$REPLAY_POOLED" = true ] ; then
+        REPLAY_ARGS=("--pooled")
+    fi
+    if [ "$REPLAY_ASAP" = true ] ; then
+        REPLAY_ARGS+=("--asap")
+    elif [ -n "$REPLAY_SPEEDUP" ] ; then
+        REPLAY_ARGS+=("-x" "$REPLAY_SPEEDUP")
+    fi
+    NB_REPLAYED_DEVICES=0
+    for DEV in "${DEVICES[@]}"
+    do  
+        [ -d "$DNS_ONLY_PATH$DEV/$RUN_ID" ] || continue
+        # creating the directories if necessary
+        mkdir -p "$REPLAYED_PATH$DEV/$RUN_ID" "$REPLAY_MANIFESTS_PATH$DEV/$RUN_ID"
+        REPLAY_ARGS+=(
+            "-id" "$DNS_ONLY_PATH$DEV/$RUN_ID/" 
+            "-mac" "${MAC_ADDRESSES[$DEV]}" 
+            "-od" "$REPLAYED_PATH$DEV/$RUN_ID/" 
+            "-md" "$REPLAY_MANIFESTS_PATH$DEV/$RUN_ID/"
+        )
+        NB_REPLAYED_DEVICES=$(("$NB_REPLAYED_DEVICES"+1))
+    done
+    if [ "$NB_REPLAYED_DEVICES" -gt 0 ] ; then
+        python3 ./pcap_manipulation/PcapReplay.py -rc "$RESOLVERS_CONFIG" -rplc "$REPLAY_CONFIG" -if "$IFACE" -s "$RUN_ID-sslkeylog.log" -rca "$RESOLVERS_CACHE" "${REPLAY_ARGS[@]}"
+    fi
+fi
+ 
+
+if [ "$SINGLE_PASS" = true ] && ( [ "$EXTRACT_FEATURES" = true ] || [ "$EXTRACT_FEATURES_ALL" = true ] || [ "$DISTRIB" = true ] ) ; then
+    echo "[EXTRACT_SINGLE_PASS]"
+
     COUNT=0
     for DEV in "${DEVICES[@]}"
     do  
-        replay_pcap_files "$DEV" &
+        extract_single_pass "$DEV" &
         n=$(($COUNT%"$MAX_PARALLEL_DEVICE"))
         if [ "$n" -eq $(("$MAX_PARALLEL_DEVICE"-1)) ];then 
             wait 
@@ -380,8 +458,13 @@ if [ "$REPLAY" = true ] ; then
         COUNT=$(("$COUNT"+1))
     done
     wait 
-fi
- 
+
+    # everything is done: skipping the separate passes below
+    EXTRACT_FEATURES=false
+    EXTRACT_FEATURES_ALL=false
+    DISTRIB=false
+fi 
+
 
 if [ "$EXTRACT_FEATURES" = true ] ; then
     echo "[EXTRACT_FEATURES]"
@@ -445,51 +528,105 @@ if [ "$MERGE_CSV" = true ] ; then
     sed -i '/^$/d' "$CSV_FINAL_FILE"
     echo "Final number of lines in CSV:"
     wc -l "$CSV_FINAL_FILE"
+
+    if [ "$FEATURE_STORE" = true ] ; then
+        # merging the feature stores of the devices if they are all there, 
+        # else converting the final CSV (same rows, in the same order)
+        FEATURE_STORES=()
+        MISSING_FEATURE_STORE=false
+        for DEV in "${ALL_DEVICES[@]}"
+        do
+            if [ -f "$CSV_PATH_WITH_ID$DEV.csv" ]; then
+                if [ -d "$CSV_PATH_WITH_ID$DEV.features" ]; then
+                    FEATURE_STORES+=("$CSV_PATH_WITH_ID$DEV.features")
+                else
+                    MISSING_FEATURE_STORE=true
+                fi
+            fi
+        done 
+        if [ "$MISSING_FEATURE_STORE" = false ] && [ "${#FEATURE_STORES[@]}" -gt 0 ]; then
+            python3 ./pcap_manipulation/FeatureStore.py -i "${FEATURE_STORES[@]}" -o "$FEATURES_FINAL_FILE"
+        else
+            python3 ./pcap_manipulation/FeatureStore.py -ic "$CSV_FINAL_FILE" -o "$FEATURES_FINAL_FILE"
+        fi
+    fi
 fi  
 
 
+# with FEATURE_STORE, the ML uses the feature store instead of the CSV file (same data, faster to load)
+ML_INPUT="$CSV_FINAL_FILE"
+if [ "$FEATURE_STORE" = true ] ; then
+    ML_INPUT="$FEATURES_FINAL_FILE"
+    if [ "$ML" = true ] || [ "$ML_RERUN" = true ] ; then
+        # the nodes only receive all.csv (see orchestrator_pipeline.sh): converting it once if needed
+        if [ "$CSV_FINAL_FILE" -nt "$FEATURES_FINAL_FILE" ]; then
+            python3 ./pcap_manipulation/FeatureStore.py -ic "$CSV_FINAL_FILE" -o "$FEATURES_FINAL_FILE"
+        fi
+    fi
+fi
+
 if [ "$ML" = true ] ; then
     echo "[ML]"
 
     cd ml # because relative imports in python are a MESS 
     COUNT=0
-    
+
+    # all the seeds are run by the same process (the dataset is only loaded once)
+    SEEDS=""
     for i in $(seq 0 "$SEED_RUNS")
     do
         # current_hostname_index + (SEED_SHIFT * $iSEED_RUNS)
-        SEED=$(("$HOST_INDEX" + "$SEED_SHIFT" * "$i"))
-        for M in "${ALL_MODES[@]}"
-        do  
-            if [[ " ${DNS_STR_MODES[*]} " =~ " ${M} " ]];then  
-                python3 -m sklearnex main.py \
-                    -i "../$CSV_FINAL_FILE_DNS_STR" \
-                    -o "../$RESULTS_PATH" \
-                    -oh "../$HYPERPARAMETERS_PATH$M-$SEED.json" \
-                    -md "../$MODELS_PATH" \
-                    -ec "../$EXTRACT_CONFIG" \
-                    -rc "../$RESOLVERS_CONFIG" \
-                    -dc "../$DEVICES_CONFIG" \
-                    -r "$SEED" \
-                    -m "$M" \
-                    -ds &
-            else
-                python3 -m sklearnex main.py \
-                    -i "../$CSV_FINAL_FILE" \
-                    -o "../$RESULTS_PATH" \
-                    -oh "../$HYPERPARAMETERS_PATH$M-$SEED.json" \
-                    -md "../$MODELS_PATH" \
-                    -ec "../$EXTRACT_CONFIG" \
-                    -rc "../$RESOLVERS_CONFIG" \
-                    -dc "../$DEVICES_CONFIG" \
-                    -r "$SEED" \
-                    -m "$M" &
-            fi 
-            n=$(($COUNT%"$MAX_PARALLEL_ML"))
-            if [ "$n" -eq $(("$MAX_PARALLEL_ML"-1)) ];then 
-                wait 
-            fi 
-            COUNT=$(("$COUNT"+1))
-        done
+        SEEDS="$SEEDS$(("$HOST_INDEX" + "$SEED_SHIFT" * "$i")),"
+    done
+    SEEDS="${SEEDS%,}"
+    SHARE_SEARCH_ARG="--no-share_search"
+    if [ "$SHARE_SEARCH" = true ] ; then
+        SHARE_SEARCH_ARG="--share_search"
+    fi
+    FORCE_SEARCH_ARG="--no-force_search"
+    if [ "$FORCE_SEARCH" = true ] ; then
+        FORCE_SEARCH_ARG="--force_search"
+    fi
+
+    for M in "${ALL_MODES[@]}"
+    do  
+        if [[ " ${DNS_STR_MODES[*]} " =~ " ${M} " ]];then  
+            python3 -m sklearnex main.py \
+                -i "../$CSV_FINAL_FILE_DNS_STR" \
+                -o "../$RESULTS_PATH" \
+                -oh "../$HYPERPARAMETERS_PATH$M-{seed}.json" \
+                -md "../$MODELS_PATH" \
+                -ec "../$EXTRACT_CONFIG" \
+                -rc "../$RESOLVERS_CONFIG" \
+                -dc "../$DEVICES_CONFIG" \
+                -r "$SEEDS" \
+                -sj "$MAX_PARALLEL_SEEDS" \
+                "$SHARE_SEARCH_ARG" \
+                -hc "../$HYPERPARAMETERS_CACHE_PATH" \
+                "$FORCE_SEARCH_ARG" \
+                -m "$M" \
+                -ds &
+        else
+            python3 -m sklearnex main.py \
+                -i "../$ML_INPUT" \
+                -o "../$RESULTS_PATH" \
+                -oh "../$HYPERPARAMETERS_PATH$M-{seed}.json" \
+                -md "../$MODELS_PATH" \
+                -ec "../$EXTRACT_CONFIG" \
+                -rc "../$RESOLVERS_CONFIG" \
+                -dc "../$DEVICES_CONFIG" \
+                -r "$SEEDS" \
+                -sj "$MAX_PARALLEL_SEEDS" \
+                "$SHARE_SEARCH_ARG" \
+                -hc "../$HYPERPARAMETERS_CACHE_PATH" \
+                "$FORCE_SEARCH_ARG" \
+                -m "$M" &
+        fi 
+        n=$(($COUNT%"$MAX_PARALLEL_ML"))
+        if [ "$n" -eq $(("$MAX_PARALLEL_ML"-1)) ];then 
+            wait 
+        fi 
+        COUNT=$(("$COUNT"+1))
     done 
     wait 
     cd - 
@@ -526,7 +663,7 @@ if [ "$ML_RERUN" = true ] ; then
                 # ignoring all by_* files (takes too long)
                 if [[ "$INPUT" != *"by_"* ]]; then
                     python3 -m sklearnex main.py \
-                        -i "../$CSV_FINAL_FILE" \
+                        -i "../$ML_INPUT" \
                         -o "../$RESULTS_PATH" \
                         -md "../$MODELS_PATH" \
                         -ec "../$EXTRACT_CONFIG" \
@@ -551,10 +688,12 @@ fi
 
 if [ "$DISTRIB" = true ] ; then
     echo "[DISTRIBUTIONS]"
+    set_resolvers_args
     COUNT=0
     for DEV in "${DEVICES[@]}"
     do  
-        python3 ./pcap_manipulation/PcapDistribution.py -rc "$RESOLVERS_CONFIG" -ec "$EXTRACT_CONFIG" -ic "$DNS_ONLY_PATH/$DEV/$RUN_ID/*" -ie "$REPLAYED_PATH/$DEV/$RUN_ID/*" -o "$DISTRIB_PATH$DEV.json" &
+        # (the files are paired by filename, only the new ones are extracted, see DISTRIB_PARTIALS_PATH)
+        python3 ./pcap_manipulation/PcapDistribution.py -rc "$RESOLVERS_CONFIG" -ec "$EXTRACT_CONFIG" -ic "$DNS_ONLY_PATH/$DEV/$RUN_ID/*" -ie "$REPLAYED_PATH/$DEV/$RUN_ID/*" -o "$DISTRIB_PATH$DEV.json" "${RESOLVERS_ARGS[@]}" -w "$MAX_PARALLEL_EXTRACT" -pd "$DISTRIB_PARTIALS_PATH$DEV/" &
         n=$(($COUNT%"$MAX_PARALLEL_DEVICE"))
         if [ "$n" -eq $(("$MAX_PARALLEL_DEVICE"-1)) ];then 
             wait 